@@ -0,0 +1 @@
+# Custom scrapy commands, registered through COMMANDS_MODULE in settings.py
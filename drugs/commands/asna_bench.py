@@ -0,0 +1,157 @@
+import json
+import pathlib
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.http import HtmlResponse
+
+from drugs.spiders.asna import AsnaTransformer
+from drugs.utils.base_transformer import Transformer
+
+
+class CssAsnaTransformer(Transformer):
+    # the transformer as it was before the single scan, one css query over the page per field
+
+    def get_transformed_item(self):
+        return {
+            **self.title(),
+            **self.is_receipt(),
+            **self.price(),
+            **self.images(),
+            **self.info(),
+            **self.instructions()
+        }
+
+    def title(self):
+        return {'title': self.item.css('.product-title h1::text').get().strip()}
+
+    def info(self):
+        def param_text(li):
+            result = li.css('.param-text::text').get().strip()
+            if not result:
+                result = li.css('.param-text a::text').get().strip()
+            return result
+
+        if not (info_list := self.item.css('.infos')):
+            return {'info': None}
+
+        return {
+            'info': [
+                {
+                    'label': li.css('.param::text').get().strip(),
+                    'value': param_text(li)
+                } for li in info_list[0].css('li')
+            ]
+        }
+
+    def instructions(self):
+        def extract_tag_value(tag):
+            if tag.root.tag == 'p':
+                return tag.css('::text').get(default='').strip()
+
+            return '\t{}'.format('\n\t'.join(
+                text.strip().replace('\n', ' ')
+                for li in tag.css('li')
+                if (text := li.css('::text').get()) is not None
+            ))
+
+        return {
+            'instructions': [
+                {
+                    'label': title.strip(),
+                    'value': '\n'.join(filter(
+                        lambda x: x,
+                        map(extract_tag_value, div.css('p, ul'))
+                    ))
+                } for div in self.item.css('div.product-information__info__content__block')
+                if (title := div.css('h3::text').get()) is not None
+            ]
+        }
+
+    def price(self):
+        price = self.item.css('link[itemprop=price]::attr(content)').get()
+        return {'price': float(price.strip()) if price else None}
+
+    def images(self):
+        def extract_images(img):
+            return {
+                'size_{}'.format(index): img_url
+                for index, attr_name
+                in enumerate(('src', 'data-main1', 'data-main2'), start=1)
+                if (img_url := img.attrib.get(attr_name)) is not None
+            }
+
+        images = list(map(
+            extract_images,
+            self.item.css('.js-photos-item-zoom')
+        ))
+
+        if not images:
+            images = [extract_images(self.item.css('.js-main-item-photo'))]
+
+        return {'images': images}
+
+    def is_receipt(self):
+        return {'is_receipt': bool(self.item.css('.item-recipe-line'))}
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {
+        'LOG_ENABLED': False,
+    }
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Measure asna product pages/sec of the css and the single scan transformer'
+
+    def long_desc(self):
+        return (
+            'Runs the transformer as it was, one css query per field, and the current one over the '
+            'saved asna product pages, extraction only on parsed pages and with the html parsing '
+            'of every page included. The outputs of both must be the same.'
+        )
+
+    def add_options(self, parser):
+        super(Command, self).add_options(parser)
+        parser.add_argument('-n', '--repeat', type=int, default=500, help='runs over every page')
+        parser.add_argument('--pages-dir', default='tests/fixtures/asna', help='directory of the *.html pages')
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+        if not (pages := sorted(pathlib.Path(opts.pages_dir).glob('*.html'))):
+            raise UsageError('No *.html pages in {}'.format(opts.pages_dir), print_help=False)
+
+        bodies = [(page.name, page.read_bytes()) for page in pages]
+        parsed = [self._get_response(name, body) for name, body in bodies]
+        for response in parsed:
+            css, scan = (transformer(response).get_transformed_item() for transformer in (CssAsnaTransformer, AsnaTransformer))
+            if json.dumps(css, ensure_ascii=False) != json.dumps(scan, ensure_ascii=False):
+                raise RuntimeError('The transformers disagree about {}'.format(response.url))
+
+        for label, transformer in (('css', CssAsnaTransformer), ('single scan', AsnaTransformer)):
+            extraction = self._get_rate(lambda: [transformer(response).get_transformed_item() for response in parsed], opts)
+            parsing = self._get_rate(lambda: [
+                transformer(self._get_response(name, body)).get_transformed_item() for name, body in bodies
+            ], opts)
+            print('{}:\t{:.0f} pages/sec extraction only\t{:.0f} pages/sec with parsing\t({} pages)'.format(
+                label, extraction * len(bodies), parsing * len(bodies), len(bodies)
+            ))
+
+    @staticmethod
+    def _get_response(name, body):
+        response = HtmlResponse('https://www.asna.ru/cards/{}'.format(name), body=body, encoding='utf-8')
+        # the selector parses the page once and is cached on the response
+        response.selector
+        return response
+
+    @staticmethod
+    def _get_rate(run_pages, opts):
+        started = time.perf_counter()
+        for _ in range(opts.repeat):
+            run_pages()
+        return opts.repeat / (time.perf_counter() - started)
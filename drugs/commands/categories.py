@@ -0,0 +1,37 @@
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from drugs.db import db
+from drugs.utils import utils
+from drugs.utils.categories import CategoryTree
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {
+        'LOG_ENABLED': False,
+        'MIGRATION_BATCH_SIZE': 5000,
+    }
+
+    def short_desc(self):
+        return 'Rebuild the category and drug_category tables from the breadcrumbs in oz_drug'
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+
+        started = time.perf_counter()
+        sqlalchemy = db.SQLAlchemy(utils.get_db_url(self.settings), **utils.get_db_options(self.settings))
+        tree = CategoryTree()
+        tree.create_tables(sqlalchemy.engine)
+
+        session = sqlalchemy.session
+        drugs, links = tree.rebuild(session, self.settings.getint('MIGRATION_BATCH_SIZE'))
+        categories = session.query(tree.db_model).count()
+        sqlalchemy.close()
+
+        print('drugs:\t{}'.format(drugs))
+        print('categories:\t{}\t{} links'.format(categories, links))
+        print('rebuild:\t{:.2f}s'.format(time.perf_counter() - started))
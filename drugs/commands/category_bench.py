@@ -0,0 +1,100 @@
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from sqlalchemy import func, select
+
+from drugs.commands.oz_bench import get_in_category
+from drugs.db import db, models
+from drugs.utils import synthetic, utils
+from drugs.utils.categories import CategoryTree
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {
+        'LOG_ENABLED': False,
+        'MIGRATION_BATCH_SIZE': 5000,
+    }
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Time "drugs under a category" through the category tree against scanning oz_drug'
+
+    def long_desc(self):
+        return (
+            'Fills an empty oz_drug in DB_URL with --rows synthetic products in a 1220 node catalogue and '
+            'rebuilds the category tables from them. The drugs under a top level, a middle and a leaf '
+            'category, cheapest first, are then read by decoding the categories json of every row, '
+            'by a json scan in SQL and through drug_category, and the per batch upkeep of the tree is timed.'
+        )
+
+    def add_options(self, parser):
+        super(Command, self).add_options(parser)
+        parser.add_argument('-r', '--rows', type=int, default=100000, help='synthetic products to fill with')
+        parser.add_argument('-n', '--repeat', type=int, default=10, help='runs of every indexed lookup')
+        parser.add_argument('--batches', type=int, default=100, help='100 drug batches to time the upkeep on')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+
+        sqlalchemy = db.SQLAlchemy(utils.get_db_url(self.settings), **utils.get_db_options(self.settings))
+        session = sqlalchemy.session
+        table, tree = models.OzDrug.__table__, CategoryTree()
+        models.Base.metadata.create_all(sqlalchemy.engine, tables=[table])
+        tree.create_tables(sqlalchemy.engine)
+        batch_size = self.settings.getint('MIGRATION_BATCH_SIZE')
+        if not session.execute(select([func.count()]).select_from(table)).scalar():
+            started = time.perf_counter()
+            synthetic.fill_oz_drugs(session, opts.rows, opts.seed, batch_size)
+            print('fill:\t{} rows\t{:.2f}s'.format(opts.rows, time.perf_counter() - started))
+
+        started = time.perf_counter()
+        drugs, links = tree.rebuild(session, batch_size)
+        print('rebuild:\t{} drugs\t{} links\t{:.2f}s'.format(drugs, links, time.perf_counter() - started))
+
+        is_postgres = sqlalchemy.engine.dialect.name == 'postgresql'
+        for label, category_id in zip(('top', 'mid', 'leaf'), synthetic.get_category_leaves()[0]):
+            scan_time, scanned = self._time(lambda: self._scan(session, table, category_id), 1)
+            sql_time, sql_scanned = self._time(lambda: session.execute(
+                select([table.c.id, table.c.price])
+                .where(get_in_category(table, category_id, is_postgres))
+                .order_by(table.c.price, table.c.id)
+            ).fetchall(), 1)
+            tree_time, found = self._time(lambda: tree.get_drugs(session, category_id), opts.repeat)
+            if not [tuple(row) for row in found] == [tuple(row) for row in sql_scanned] == scanned:
+                raise RuntimeError('The category tree disagrees with oz_drug about category {}'.format(category_id))
+            print('{}:\tpython scan {:.1f}ms\tsql scan {:.1f}ms\ttree {:.2f}ms\t({} drugs)'.format(
+                label, scan_time * 1000, sql_time * 1000, tree_time * 1000, len(found)
+            ))
+
+        # the upkeep of saved batches, every drug is linked again to the categories it has
+        started = time.perf_counter()
+        for start in range(1, opts.batches * 100 + 1, 100):
+            tree.update(session, dict(session.execute(
+                select([table.c.id, table.c.data['breadcrumbs'].as_string()])
+                .where(table.c.id.between(start, start + 99))
+            ).fetchall()))
+            session.commit()
+        print('upkeep:\t{:.2f}ms per 100 drug batch'.format((time.perf_counter() - started) * 1000 / opts.batches))
+        sqlalchemy.close()
+
+    @staticmethod
+    def _scan(db_session, table, category_id):
+        # what every lookup took before the tree, decoding the categories of every drug
+        return sorted((
+            (id_, price)
+            for id_, price, categories in db_session.execute(select([table.c.id, table.c.price, table.c.categories]))
+            if categories and str(category_id) in categories
+        ), key=lambda row: (row[1], row[0]))
+
+    @staticmethod
+    def _time(query, repeat):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            result = query()
+        return (time.perf_counter() - started) / repeat, result
@@ -0,0 +1,132 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from sqlalchemy import func, select
+
+from drugs.db import db, models
+from drugs.spiders.oz import OzSpider
+from drugs.utils import synthetic
+from drugs.utils.work_queue import WorkQueue
+
+
+class MockOzHandler(BaseHTTPRequestHandler):
+    # answers page queries with pages of synthetic products after latency seconds,
+    # pages past the last one are empty like they are on oz
+    pages = {}
+    latency = 0
+    served = []
+
+    def do_POST(self):
+        variables = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['variables']
+        pages = [variables['page']] if 'page' in variables else [variables['page{}'.format(i)] for i in range(len(variables) - 1)]
+        time.sleep(self.latency)
+        self.served.extend(pages)
+
+        body = json.dumps({'data': {
+            alias: {'items': self.pages.get(page, [])} for alias, page in zip(OzSpider._get_aliases(len(pages)), pages)
+        }}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {
+        'LOG_ENABLED': False,
+    }
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Measure how a distributed oz crawl scales with its worker count against a local mock'
+
+    def long_desc(self):
+        return (
+            'Serves --pages pages of synthetic oz products from a local graphql mock answering after '
+            '--latency seconds, then crawls them once per --workers count with that many `scrapy crawl oz` '
+            'processes sharing the work queue of a fresh SQLite database. Every worker fetches one page '
+            'at a time --delay seconds apart, the oz window grows with the worker count.'
+        )
+
+    def add_options(self, parser):
+        super(Command, self).add_options(parser)
+        parser.add_argument('-w', '--workers', default='1,2,4', help='comma separated worker counts')
+        parser.add_argument('-p', '--pages', type=int, default=300, help='pages served')
+        parser.add_argument('--page-size', type=int, default=20, help='products per page')
+        parser.add_argument('--latency', type=float, default=0.1, help='seconds the mock takes per response')
+        parser.add_argument('--delay', type=float, default=0.2, help='download delay of every worker')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+        try:
+            worker_counts = [int(count) for count in opts.workers.split(',')]
+        except ValueError:
+            raise UsageError('--workers must be comma separated integers', print_help=False)
+
+        rng, leaves = random.Random(opts.seed), synthetic.get_category_leaves()
+        MockOzHandler.pages = {
+            page: [synthetic.get_oz_product(page * opts.page_size + i, rng, leaves) for i in range(opts.page_size)]
+            for page in range(1, opts.pages + 1)
+        }
+        MockOzHandler.latency = opts.latency
+        server = ThreadingHTTPServer(('127.0.0.1', 0), MockOzHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:{}/graphql'.format(server.server_address[1])
+
+        for workers in worker_counts:
+            db_url = 'sqlite:///{}'.format(os.path.join(tempfile.mkdtemp(prefix='drugs-distributed-'), 'crawl.sqlite'))
+            sqlalchemy = db.SQLAlchemy(db_url)
+            models.Base.metadata.create_all(sqlalchemy.engine)
+            del MockOzHandler.served[:]
+
+            started = time.perf_counter()
+            processes = [subprocess.Popen(self._get_worker_args(url, db_url, workers, opts)) for _ in range(workers)]
+            failed = sum(1 for process in processes if process.wait())
+            elapsed = time.perf_counter() - started
+
+            rows = sqlalchemy.session.execute(select([func.count()]).select_from(models.OzDrug.__table__)).scalar()
+            counts = WorkQueue(OzSpider.name, None).get_counts(sqlalchemy.session)
+            print('{} workers:\t{:.1f} requests/sec\t{} requests\t{} pages\t{} rows\t{:.1f}s\t{}{}'.format(
+                workers, len(MockOzHandler.served) / elapsed, len(MockOzHandler.served),
+                len(set(MockOzHandler.served) & MockOzHandler.pages.keys()), rows, elapsed,
+                '\t'.join('{}: {}'.format(state, count) for state, count in counts.items()),
+                '\t{} workers failed'.format(failed) if failed else ''
+            ))
+            sqlalchemy.close()
+        server.shutdown()
+
+    @staticmethod
+    def _get_worker_args(url, db_url, workers, opts):
+        settings = {
+            'DB_URL': db_url,
+            'DISTRIBUTED_ENABLED': True,
+            'ADAPTIVE_THROTTLE_ENABLED': False,
+            'DOWNLOAD_DELAY': opts.delay,
+            'CONCURRENT_REQUESTS_PER_DOMAIN': 1,
+            'ROBOTSTXT_OBEY': False,
+            'PIPELINE_FLUSH_INTERVAL': 1,
+            'LOG_LEVEL': 'ERROR',
+        }
+        return [
+            sys.executable, '-m', 'scrapy', 'crawl', OzSpider.name,
+            '-a', 'url={}'.format(url), '-a', 'page_size={}'.format(opts.page_size), '-a', 'window={}'.format(8 * workers),
+            *(arg for name, value in settings.items() for arg in ('-s', '{}={}'.format(name, value)))
+        ]
@@ -0,0 +1,73 @@
+import gc
+import random
+import tracemalloc
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from drugs.items import OzPageItem
+from drugs.spiders.oz import OzSpider, OzTransformer
+from drugs.utils import synthetic
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {
+        'LOG_ENABLED': False,
+    }
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Measure the memory an oz crawl held in the pipeline buffer takes as items and as page dicts'
+
+    def long_desc(self):
+        return (
+            'Builds the pages of a synthetic oz crawl and holds them the way the pipeline buffer does: '
+            'as page dicts carrying every extracted field next to the raw products, as the spider used to, '
+            'and as typed OzPageItems with the stored columns only. Sizes are traced with tracemalloc, '
+            'beyond the raw products both keep.'
+        )
+
+    def add_options(self, parser):
+        super(Command, self).add_options(parser)
+        parser.add_argument('-p', '--pages', type=int, default=700, help='pages held')
+        parser.add_argument('--page-size', type=int, default=20, help='products per page')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+
+        rng = random.Random(opts.seed)
+        leaves = synthetic.get_category_leaves()
+        tracemalloc.start()
+        pages = [
+            [synthetic.get_oz_product(page * opts.page_size + i, rng, leaves) for i in range(opts.page_size)]
+            for page in range(opts.pages)
+        ]
+        gc.collect()
+        raw_size = tracemalloc.get_traced_memory()[0]
+        print('raw products:\t{:.2f} MiB\t({} pages of {})'.format(raw_size / 2 ** 20, opts.pages, opts.page_size))
+
+        for label, hold in (('page dicts', self._get_page_dicts), ('typed items', self._get_page_items)):
+            gc.collect()
+            started = tracemalloc.get_traced_memory()[0]
+            buffer = hold(pages)
+            gc.collect()
+            print('{}:\t{:.2f} MiB'.format(label, (tracemalloc.get_traced_memory()[0] - started) / 2 ** 20))
+            del buffer
+        tracemalloc.stop()
+
+    @staticmethod
+    def _get_page_dicts(pages):
+        extractors = OzTransformer.get_extractors()
+        return [
+            {'page': page, 'items': items, 'normalized': [OzTransformer.transform(item, extractors) for item in items]}
+            for page, items in enumerate(pages)
+        ]
+
+    @staticmethod
+    def _get_page_items(pages):
+        return [OzPageItem(page=page, drugs=OzSpider._get_drugs(items)[0]) for page, items in enumerate(pages)]
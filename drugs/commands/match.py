@@ -0,0 +1,41 @@
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from drugs.db import db, models
+from drugs.utils import utils
+from drugs.utils.matching import DrugMatcher
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {
+        'LOG_ENABLED': False,
+    }
+
+    def short_desc(self):
+        return 'Rebuild the drug_match table linking oz products to asna ones'
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+
+        started = time.perf_counter()
+        sqlalchemy = db.SQLAlchemy(utils.get_db_url(self.settings), **utils.get_db_options(self.settings))
+        matcher = DrugMatcher(self.settings.getfloat('MATCHING_MIN_CONFIDENCE'))
+        session = sqlalchemy.session
+        table = models.DrugMatch.__table__
+
+        session.execute(table.delete())
+        rows = matcher.load(session)
+        matched = time.perf_counter()
+        if rows:
+            session.execute(table.insert(), rows)
+        session.commit()
+        sqlalchemy.close()
+
+        print('products:\t{} oz\t{} asna'.format(*matcher.get_sizes()))
+        print('matches:\t{}'.format(len(matcher)))
+        print('load and match:\t{:.2f}s'.format(matched - started))
+        print('save:\t{:.2f}s'.format(time.perf_counter() - matched))
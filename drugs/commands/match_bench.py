@@ -0,0 +1,65 @@
+import random
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from drugs.utils import matching, synthetic
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {
+        'LOG_ENABLED': False,
+    }
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Time blocked matching of synthetic oz and asna catalogues against comparing every pair'
+
+    def long_desc(self):
+        return (
+            'Builds a synthetic catalogue of --products drugs, listed by oz and, two in three, by asna, '
+            'and matches it with DrugMatcher. Comparing every oz product to every asna one is timed on '
+            '--sample oz products and scaled to the catalogue, the matches it finds for the sample are '
+            'checked against the blocked ones.'
+        )
+
+    def add_options(self, parser):
+        super(Command, self).add_options(parser)
+        parser.add_argument('-p', '--products', type=int, default=30000, help='drugs in the catalogue')
+        parser.add_argument('--sample', type=int, default=200, help='oz products matched pair by pair')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+
+        oz, asna = synthetic.get_match_products(opts.products, opts.seed)
+        min_confidence = self.settings.getfloat('MATCHING_MIN_CONFIDENCE')
+        print('products:\t{} oz\t{} asna'.format(len(oz), len(asna)))
+
+        started = time.perf_counter()
+        blocked = {row['oz_id']: row['confidence'] for row in matching.DrugMatcher(min_confidence).rebuild(asna, oz)}
+        print('blocking:\t{:.2f}s\t({} matches)'.format(time.perf_counter() - started, len(blocked)))
+
+        sample = random.Random(opts.seed).sample(oz, min(opts.sample, len(oz)))
+        started = time.perf_counter()
+        pairwise = {oz_id: self._get_best(product, asna, min_confidence) for oz_id, product in sample}
+        elapsed = time.perf_counter() - started
+        print('pairwise:\t{:.2f}s for {} oz products\t~{:.0f}s for all of them'.format(
+            elapsed, len(sample), elapsed / len(sample) * len(oz)
+        ))
+
+        # ties between equally good asna products may go either way, so the confidences are compared
+        matched = [oz_id for oz_id, confidence in pairwise.items() if confidence is not None]
+        print('sample:\t{} matched pair by pair\t{} of them as well by blocking'.format(
+            len(matched), sum(1 for oz_id in matched if blocked.get(oz_id) == pairwise[oz_id])
+        ))
+
+    @staticmethod
+    def _get_best(product, asna, min_confidence):
+        confidence = max(matching.get_confidence(product, other) for _, other in asna)
+        return confidence if confidence >= min_confidence else None
@@ -0,0 +1,112 @@
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from sqlalchemy import and_, bindparam, inspect, select, text
+from sqlalchemy.dialects import postgresql
+
+from drugs.db import db, models
+from drugs.spiders.oz import NORMALIZED_COLUMNS, OzSpider
+from drugs.utils import utils
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {
+        'LOG_ENABLED': False,
+        'MIGRATION_BATCH_SIZE': 5000,
+    }
+
+    def short_desc(self):
+        return 'Upgrade oz_drug to JSONB with the extracted and indexed hot fields, in batches'
+
+    def long_desc(self):
+        return (
+            'Every step can be rerun. Missing columns are added and rows are rewritten '
+            'MIGRATION_BATCH_SIZE at a time, each batch in its own transaction, so a crawl can keep '
+            'writing meanwhile. The hot fields are extracted from data the way the spider does it on '
+            'write, products it would leave out keep them NULL. On PostgreSQL the json '
+            'columns are copied to jsonb ones and swapped in a single short transaction at the end, '
+            'indexes are then built concurrently.'
+        )
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+
+        sqlalchemy = db.SQLAlchemy(utils.get_db_url(self.settings), **utils.get_db_options(self.settings))
+        engine = sqlalchemy.engine
+        table = models.OzDrug.__table__
+        batch_size = self.settings.getint('MIGRATION_BATCH_SIZE')
+        is_postgres = engine.dialect.name == 'postgresql'
+        columns = {column['name']: column for column in inspect(engine).get_columns(table.name)}
+
+        with engine.begin() as connection:
+            for column in table.columns:
+                if column.name not in columns:
+                    connection.execute(text('ALTER TABLE oz_drug ADD COLUMN {} {}'.format(
+                        column.name, column.type.compile(dialect=engine.dialect)
+                    )))
+        columns = {column['name']: column for column in inspect(engine).get_columns(table.name)}
+
+        # columns added above already are jsonb, older json ones are copied over and swapped
+        values = {}
+        jsonb_columns = [
+            column for column in ('data', 'categories') if not isinstance(columns[column]['type'], postgresql.JSONB)
+        ] if is_postgres else []
+        if jsonb_columns:
+            with engine.begin() as connection:
+                for column in jsonb_columns:
+                    connection.execute(text('ALTER TABLE oz_drug ADD COLUMN IF NOT EXISTS {0}_jsonb jsonb'.format(column)))
+                    values['{}_jsonb'.format(column)] = text('{}::jsonb'.format(column))
+
+        started = time.perf_counter()
+        migrated, invalid = self._update_in_batches(engine, table, values, batch_size)
+        print('rows:\t{}\t{} left out\t{:.2f}s'.format(migrated, invalid, time.perf_counter() - started))
+
+        if jsonb_columns:
+            with engine.begin() as connection:
+                # rows written by a crawl since their batch ran are caught up under the lock
+                connection.execute(text('LOCK TABLE oz_drug IN EXCLUSIVE MODE'))
+                connection.execute(text('UPDATE oz_drug SET {} WHERE data_jsonb IS NULL OR data_jsonb <> data::jsonb'.format(
+                    ', '.join('{0}_jsonb = {0}::jsonb'.format(column) for column in jsonb_columns)
+                )))
+                for column in jsonb_columns:
+                    connection.execute(text('ALTER TABLE oz_drug DROP COLUMN {0}'.format(column)))
+                    connection.execute(text('ALTER TABLE oz_drug RENAME COLUMN {0}_jsonb TO {0}'.format(column)))
+
+        started = time.perf_counter()
+        existing = {index['name'] for index in inspect(engine).get_indexes(table.name)}
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            for index in table.indexes:
+                if index.name not in existing:
+                    if is_postgres:
+                        index.dialect_options['postgresql']['concurrently'] = True
+                    index.create(connection)
+        print('indexes:\t{:.2f}s'.format(time.perf_counter() - started))
+
+        sqlalchemy.close()
+
+    @staticmethod
+    def _update_in_batches(engine, table, values, batch_size):
+        # keyset batches on the primary key, each one commits on its own
+        migrated, invalid, last_id = 0, 0, None
+        while True:
+            with engine.begin() as connection:
+                query = select([table.c.id, table.c.data]).order_by(table.c.id).limit(batch_size)
+                if last_id is not None:
+                    query = query.where(table.c.id > last_id)
+                if not (rows := connection.execute(query).fetchall()):
+                    return migrated, invalid
+
+                drugs, errors = OzSpider._get_drugs([data for _, data in rows])
+                if drugs:
+                    connection.execute(table.update().where(table.c.id == bindparam('_id')), [
+                        {'_id': drug.id, **{column: getattr(drug, column) for column in NORMALIZED_COLUMNS}}
+                        for drug in drugs
+                    ])
+                if values:
+                    upper_id = rows[-1][0]
+                    bounds = table.c.id <= upper_id if last_id is None else and_(table.c.id > last_id, table.c.id <= upper_id)
+                    connection.execute(table.update().where(bounds).values(values))
+                migrated, invalid, last_id = migrated + len(drugs), invalid + len(errors), rows[-1][0]
@@ -0,0 +1,102 @@
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from sqlalchemy import func, select, type_coerce
+from sqlalchemy.dialects import postgresql
+
+from drugs.db import db, models
+from drugs.utils import synthetic, utils
+
+
+def get_in_category(table, category_id, is_postgres):
+    # a scan over the categories json, GIN indexed on PostgreSQL only
+    if is_postgres:
+        return type_coerce(table.c.categories, postgresql.JSONB).has_key(str(category_id))
+    return table.c.categories[str(category_id)].as_string().isnot(None)
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {
+        'LOG_ENABLED': False,
+        'MIGRATION_BATCH_SIZE': 5000,
+    }
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Time the hot oz_drug queries through the data blob and through the extracted columns'
+
+    def long_desc(self):
+        return (
+            'Fills an empty oz_drug in DB_URL with --rows synthetic products, written the way the spider '
+            'writes them, then runs every query both ways: reading the field out of data in every row, '
+            'as before the columns were extracted, and through the indexed columns.'
+        )
+
+    def add_options(self, parser):
+        super(Command, self).add_options(parser)
+        parser.add_argument('-r', '--rows', type=int, default=100000, help='synthetic products to fill with')
+        parser.add_argument('-n', '--repeat', type=int, default=5, help='runs of every query')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+
+        sqlalchemy = db.SQLAlchemy(utils.get_db_url(self.settings), **utils.get_db_options(self.settings))
+        session = sqlalchemy.session
+        table = models.OzDrug.__table__
+        models.Base.metadata.create_all(sqlalchemy.engine, tables=[table])
+        if not session.execute(select([func.count()]).select_from(table)).scalar():
+            started = time.perf_counter()
+            synthetic.fill_oz_drugs(session, opts.rows, opts.seed, self.settings.getint('MIGRATION_BATCH_SIZE'))
+            print('fill:\t{} rows\t{:.2f}s'.format(opts.rows, time.perf_counter() - started))
+
+        is_postgres = sqlalchemy.engine.dialect.name == 'postgresql'
+        for name, before, after in self._get_queries(table, is_postgres):
+            before_time, before_rows = self._time(session, before, opts.repeat)
+            after_time, after_rows = self._time(session, after, opts.repeat)
+            print('{}:\tdata {:.2f}ms\tcolumns {:.2f}ms\t({} rows{})'.format(
+                name, before_time * 1000, after_time * 1000, len(after_rows),
+                '' if before_rows == after_rows else ', {} through data'.format(len(before_rows))
+            ))
+        sqlalchemy.close()
+
+    @staticmethod
+    def _get_queries(table, is_postgres):
+        price = table.c.data[('price', 'regularPrice', 'amount', 'value')].as_float()
+        category = '123'
+        return (
+            (
+                'price range',
+                select([table.c.id]).where(price.between(100, 120)),
+                select([table.c.id]).where(table.c.price.between(100, 120)),
+            ),
+            (
+                'in stock by price, top 20',
+                select([table.c.id]).where(table.c.data['is_in_stock'].as_string() == 'true').order_by(price, table.c.id).limit(20),
+                select([table.c.id]).where(table.c.is_in_stock.is_(True)).order_by(table.c.price, table.c.id).limit(20),
+            ),
+            (
+                'manufacturer_id',
+                select([table.c.id]).where(table.c.data[('manufacturer_id', 'option_id')].as_string() == '42'),
+                select([table.c.id]).where(table.c.manufacturer_id == 42),
+            ),
+            (
+                'category',
+                select([table.c.id]).where(
+                    table.c.data['breadcrumbs'].as_string().contains('"id": "{}"'.format(category))
+                ),
+                select([table.c.id]).where(get_in_category(table, category, is_postgres)),
+            ),
+        )
+
+    @staticmethod
+    def _time(db_session, query, repeat):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            rows = sorted(id_ for id_, in db_session.execute(query))
+        return (time.perf_counter() - started) / repeat, rows
@@ -0,0 +1,83 @@
+import random
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from sqlalchemy import func, select
+from twisted.internet import defer, task
+
+from drugs.db import db, models
+from drugs.items import OzPageItem
+from drugs.pipelines import DrugsPipeline
+from drugs.spiders.oz import OzSpider
+from drugs.utils import synthetic, utils
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {
+        'LOG_ENABLED': False,
+    }
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Measure oz pages/sec through DrugsPipeline at several batch sizes'
+
+    def long_desc(self):
+        return (
+            'Pushes --pages normalized pages of synthetic oz products through DrugsPipeline into oz_drug '
+            'in DB_URL once per batch size, closing the spider to flush the last batch. Every run writes '
+            'products of its own, above the highest id in the table, so all of them are inserted.'
+        )
+
+    def add_options(self, parser):
+        super(Command, self).add_options(parser)
+        parser.add_argument('-p', '--pages', type=int, default=500, help='pages pushed per batch size')
+        parser.add_argument('--page-size', type=int, default=20, help='products per page')
+        parser.add_argument('--batch-sizes', default='1,10,50,100', help='comma separated pages per batch')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+        try:
+            batch_sizes = [int(size) for size in opts.batch_sizes.split(',')]
+        except ValueError:
+            raise UsageError('--batch-sizes must be comma separated integers', print_help=False)
+
+        pg_url, db_options = utils.get_db_url(self.settings), utils.get_db_options(self.settings)
+        sqlalchemy = db.SQLAlchemy(pg_url, **db_options)
+        table = models.OzDrug.__table__
+        models.Base.metadata.create_all(sqlalchemy.engine, tables=[table])
+        first_id = (sqlalchemy.session.execute(select([func.max(table.c.id)])).scalar() or 0) + 1
+        sqlalchemy.close()
+
+        rng, leaves = random.Random(opts.seed), synthetic.get_category_leaves()
+        runs = []
+        for batch_size in batch_sizes:
+            pages = []
+            for page in range(opts.pages):
+                products = [synthetic.get_oz_product(first_id + i, rng, leaves) for i in range(opts.page_size)]
+                pages.append(OzPageItem(page=page + 1, drugs=OzSpider._get_drugs(products)[0]))
+                first_id += opts.page_size
+            runs.append((DrugsPipeline(pg_url, batch_size=batch_size, db_options=db_options), pages))
+
+        task.react(lambda _: self._push_all(runs, opts))
+
+    @defer.inlineCallbacks
+    def _push_all(self, runs, opts):
+        for pipeline, pages in runs:
+            spider = OzSpider(page_size=opts.page_size)
+            yield pipeline.open_spider(spider)
+            started = time.perf_counter()
+            for page in pages:
+                # a full batch hands back the deferred of its save, the push waits for it like the scraper does
+                yield pipeline.process_item(page, spider)
+            yield pipeline.close_spider(spider)
+            elapsed = time.perf_counter() - started
+            print('batch of {}:\t{:.1f} pages/sec\t{:.0f} products/sec\t({} pages in {:.2f}s)'.format(
+                pipeline.batch_size, len(pages) / elapsed, len(pages) * opts.page_size / elapsed,
+                len(pages), elapsed
+            ))
@@ -0,0 +1,44 @@
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from sqlalchemy import null, select
+
+from drugs.db import db, models
+from drugs.utils import utils
+from drugs.utils.price_history import PriceHistory
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {
+        'LOG_ENABLED': False,
+    }
+
+    def short_desc(self):
+        return 'Append the current oz and asna prices that changed to price_history'
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+
+        sqlalchemy = db.SQLAlchemy(utils.get_db_url(self.settings), **utils.get_db_options(self.settings))
+        PriceHistory.create_table(sqlalchemy.engine)
+        session = sqlalchemy.session
+        oz_table, asna_table = models.OzDrug.__table__, models.AsnaDrug.__table__
+
+        for source, query in (
+            ('oz', select([oz_table.c.id, oz_table.c.price, oz_table.c.is_in_stock])),
+            ('asna', select([asna_table.c.url, asna_table.c.price, null()]).where(
+                asna_table.c.id.in_(models.AsnaDrug.get_latest_ids())
+            )),
+        ):
+            started = time.perf_counter()
+            prices = {str(product_id): (price, is_in_stock) for product_id, price, is_in_stock in session.execute(query)}
+            appended = PriceHistory(source).record(session, prices)
+            session.commit()
+            print('{}:\t{} products\t{} appended\t{:.2f}s'.format(
+                source, len(prices), appended, time.perf_counter() - started
+            ))
+
+        sqlalchemy.close()
@@ -0,0 +1,125 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from sqlalchemy import func, select
+
+from drugs.db import db, models
+from drugs.utils import utils
+from drugs.utils.matching import ASNA, OZ, WORD_RE, normalize
+from drugs.utils.queries import DrugQueries, QueryCache
+
+# lookups by key, price lookups and searches, as shares of the queries run
+WORKLOAD = (('drugs', 0.6), ('prices', 0.25), ('search', 0.15))
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {
+        'LOG_ENABLED': False,
+    }
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Measure queries/sec and latency of the DrugQueries read API against DB_URL'
+
+    def long_desc(self):
+        return (
+            'Runs a mix of bulk product lookups, latest price lookups and searches from several '
+            'threads. Keys are drawn with a skew towards popular products, as served traffic is, '
+            'so the hit rate of the cache shows. --no-cache runs every query against the db.'
+        )
+
+    def add_options(self, parser):
+        super(Command, self).add_options(parser)
+        parser.add_argument('-n', '--queries', type=int, default=5000, help='queries to run')
+        parser.add_argument('-t', '--threads', type=int, default=4, help='threads running them')
+        parser.add_argument('-b', '--batch', type=int, default=20, help='keys per bulk lookup')
+        parser.add_argument('--no-cache', action='store_true', help='query the db every time')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+
+        sqlalchemy = db.SQLAlchemy(utils.get_db_url(self.settings), **utils.get_db_options(self.settings))
+        cache = QueryCache(
+            0 if opts.no_cache else self.settings.getint('QUERY_CACHE_SIZE'),
+            self.settings.getfloat('QUERY_CACHE_TTL')
+        )
+        queries = DrugQueries(cache)
+        keys, words = self._load_keys(sqlalchemy.session)
+        if not keys[OZ] and not keys[ASNA]:
+            raise UsageError('No oz or asna products in {}'.format(utils.get_db_url(self.settings)), print_help=False)
+
+        rng = random.Random(opts.seed)
+        plan = [self._get_query(rng, keys, words, opts.batch) for _ in range(opts.queries)]
+
+        def run_query(query):
+            kind, source, argument = query
+            started = time.perf_counter()
+            try:
+                if kind == 'drugs':
+                    queries.get_drugs(sqlalchemy.session, source, argument)
+                elif kind == 'prices':
+                    queries.get_latest_prices(sqlalchemy.session, source, argument)
+                else:
+                    queries.search(sqlalchemy.session, argument, source)
+            finally:
+                sqlalchemy.session.remove()
+            return kind, time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(opts.threads) as executor:
+            latencies = list(executor.map(run_query, plan))
+        elapsed = time.perf_counter() - started
+        sqlalchemy.close()
+
+        print('queries/sec:\t{:.0f}\t({} queries, {} threads, {:.2f}s)'.format(
+            len(latencies) / elapsed, len(latencies), opts.threads, elapsed
+        ))
+        for kind, _ in WORKLOAD:
+            if times := sorted(latency for query_kind, latency in latencies if query_kind == kind):
+                print('{}:\tp50 {:.2f}ms\tp99 {:.2f}ms\t({} queries)'.format(
+                    kind, self._percentile(times, 0.5) * 1000, self._percentile(times, 0.99) * 1000, len(times)
+                ))
+        total = cache.hits + cache.misses
+        print('cache:\t{:.1%} hits\t{} entries'.format(cache.hits / total if total else 0, len(cache)))
+
+    @staticmethod
+    def _load_keys(db_session):
+        oz_table, asna_table = models.OzDrug.__table__, models.AsnaDrug.__table__
+        keys = {
+            OZ: [id_ for id_, in db_session.execute(select([oz_table.c.id]).order_by(oz_table.c.id))],
+            ASNA: [url for url, in db_session.execute(
+                select([asna_table.c.url]).group_by(asna_table.c.url).order_by(func.min(asna_table.c.id))
+            )],
+        }
+        words = sorted({
+            word
+            for name, in db_session.execute(select([oz_table.c.data['name'].as_string()]).limit(1000))
+            for word in WORD_RE.findall(normalize(name))
+            if len(word) > 3
+        })
+        db_session.remove()
+        return keys, words
+
+    @staticmethod
+    def _get_query(rng, keys, words, batch):
+        kind = rng.choices([kind for kind, _ in WORKLOAD], [share for _, share in WORKLOAD])[0]
+        source = rng.choice([source for source in (OZ, ASNA) if keys[source]])
+        if kind == 'search' and words:
+            return kind, source, rng.choice(words)
+        # a product's rank in the table stands for its popularity, the first ones are asked for most
+        population = keys[source]
+        return 'drugs' if kind == 'search' else kind, source, [
+            population[int(len(population) * rng.random() ** 3)] for _ in range(batch)
+        ]
+
+    @staticmethod
+    def _percentile(times, share):
+        return times[min(int(len(times) * share), len(times) - 1)]
@@ -0,0 +1,27 @@
+from drugs.commands import replay
+
+
+class Command(replay.Command):
+    # the replay run, served by the http cache and writing to the configured db
+    replay_settings = {
+        'HTTPCACHE_ENABLED': True,
+        'HTTPCACHE_IGNORE_MISSING': True,
+        'HTTPCACHE_EXPIRATION_SECS': 0,
+        'HTTPCACHE_STORAGE': 'drugs.utils.http_cache.PackCacheStorage',
+        'FINGERPRINTS_ENABLED': False,
+        'SINK': 'db',
+        'ADAPTIVE_THROTTLE_ENABLED': False,
+        'CHECKPOINTS_ENABLED': False,
+        'DISTRIBUTED_ENABLED': False,
+    }
+    hit_stats = ('httpcache/hit', 'httpcache/ignore')
+    scratch_db = False
+
+    def short_desc(self):
+        return 'Rebuild the db from the http cache of a spider, without touching the network'
+
+    def long_desc(self):
+        return (
+            'Fill the cache first with `scrapy crawl <spider> -s HTTPCACHE_ENABLED=1`, '
+            'requests it misses are dropped. Set PARSE_POOL_SIZE to parse on several cores.'
+        )
@@ -0,0 +1,88 @@
+import os
+import resource
+import tempfile
+
+from scrapy.commands import BaseRunSpiderCommand
+from scrapy.exceptions import UsageError
+
+from drugs.db import db, models
+from drugs.utils import timing, utils
+
+
+class Command(BaseRunSpiderCommand):
+    requires_project = True
+    default_settings = {
+        'CONCURRENT_REQUESTS': 64,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 64,
+        'LOG_LEVEL': 'INFO',
+    }
+    # project settings outrank command defaults, these must win for the numbers to mean anything
+    replay_settings = {
+        'REPLAY_MODE': 'replay',
+        'PARSE_POOL_SIZE': 0,
+        'FINGERPRINTS_ENABLED': False,
+        'SINK': 'db',
+        'ADAPTIVE_THROTTLE_ENABLED': False,
+        'CHECKPOINTS_ENABLED': False,
+        'MATCHING_ENABLED': False,
+        'DISTRIBUTED_ENABLED': False,
+    }
+    # the stats counting the responses served and missing, and whether items go to a throwaway db
+    hit_stats = ('replay/hits', 'replay/missing')
+    scratch_db = True
+
+    def syntax(self):
+        return '[options] <spider>'
+
+    def short_desc(self):
+        return 'Replay an archived crawl at full speed and report its throughput'
+
+    def long_desc(self):
+        return (
+            'Record an archive first with `scrapy crawl <spider> -s REPLAY_MODE=record`. '
+            'Items go to a fresh SQLite database unless DB_URL is set.'
+        )
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+
+        self.settings.setdict(self.replay_settings, priority='cmdline')
+        if self.scratch_db and not self.settings.get('DB_URL'):
+            db_fp = os.path.join(tempfile.mkdtemp(prefix='drugs-replay-'), 'replay.sqlite')
+            self.settings.set('DB_URL', 'sqlite:///{}'.format(db_fp), priority='cmdline')
+        # reparse writes to the configured database, which may be given by the PG_* settings only
+        sqlalchemy = db.SQLAlchemy(utils.get_db_url(self.settings), **utils.get_db_options(self.settings))
+        models.Base.metadata.create_all(sqlalchemy.engine)
+
+        timing.reset()
+        timing.enable()
+
+        crawler = self.crawler_process.create_crawler(args[0])
+        self.crawler_process.crawl(crawler, **opts.spargs)
+        self.crawler_process.start()
+
+        self._report(crawler.stats.get_stats())
+
+    def _report(self, stats):
+        elapsed = (stats['finish_time'] - stats['start_time']).total_seconds()
+        hits_stat, missing_stat = self.hit_stats
+        requests = stats.get(hits_stat, 0)
+        items = stats.get('item_scraped_count', 0)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+
+        print('elapsed:\t{:.2f}s'.format(elapsed))
+        print('requests/sec:\t{:.1f}\t({} served, {} missing)'.format(
+            requests / elapsed, requests, stats.get(missing_stat, 0)
+        ))
+        print('items/sec:\t{:.1f}\t({} items)'.format(items / elapsed, items))
+        print('cpu time:\t{:.2f}s user\t{:.2f}s sys'.format(usage.ru_utime, usage.ru_stime))
+        print('peak rss:\t{:.1f} MiB'.format(usage.ru_maxrss / 1024))
+        for stage, stage_stats in sorted(timing.get_stages().items()):
+            print('stage {}:\t{:.3f}s cpu\t{} calls\tp50 {:.5f}s\tp99 {:.5f}s'.format(
+                stage,
+                stage_stats['cpu_time'],
+                stage_stats['calls'],
+                stage_stats['p50'],
+                stage_stats['p99']
+            ))
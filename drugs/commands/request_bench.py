@@ -0,0 +1,70 @@
+import time
+
+import scrapy
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from drugs.spiders.oz import REQUEST_QUERY_FILES, OzSpider
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {
+        'LOG_ENABLED': False,
+    }
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Time building oz page requests from json.dumps against the pre-encoded body templates'
+
+    def long_desc(self):
+        return (
+            'Builds --requests page requests the way the spider used to, reading the query file and '
+            'json.dumps-ing the body for every page, and through the cached, pre-encoded body templates, '
+            'with the query as written and minified, one page and several pages per request.'
+        )
+
+    def add_options(self, parser):
+        super(Command, self).add_options(parser)
+        parser.add_argument('-n', '--requests', type=int, default=2000, help='requests built per variant')
+        parser.add_argument('--pages-per-request', type=int, default=4, help='pages of a batched request')
+
+    def run(self, args, opts):
+        if args:
+            raise UsageError()
+
+        original = OzSpider(query_file=REQUEST_QUERY_FILES[0], minify_query='0')
+        variants = (
+            ('json.dumps', lambda page: self._get_dumped_request(original, page)),
+            ('template', OzSpider(minify_query='0')._get_request),
+            ('template, minified', OzSpider()._get_request),
+            ('template, minified, {} pages'.format(opts.pages_per_request), self._get_batched(opts)),
+        )
+        for label, get_request in variants:
+            started = time.perf_counter()
+            for page in range(1, opts.requests + 1):
+                request = get_request(page)
+            elapsed = time.perf_counter() - started
+            print('{}:\t{:.1f}us/request\t{} byte body'.format(
+                label, elapsed / opts.requests * 1e6, len(request.body)
+            ))
+
+    @staticmethod
+    def _get_dumped_request(spider, page):
+        # the request as built before the body templates, the query file read every time
+        with open(spider.query_fp, 'r', encoding='utf-8') as file:
+            query = file.read()
+        return scrapy.http.JsonRequest(
+            url=spider.url,
+            data={'query': query, 'variables': {'page': page, 'size': spider.page_size}},
+            cb_kwargs={'page': page},
+            callback=spider.parse,
+            errback=spider.parse_error
+        )
+
+    @staticmethod
+    def _get_batched(opts):
+        spider = OzSpider(pages_per_request=opts.pages_per_request)
+        return lambda page: spider._get_request(page, opts.pages_per_request)
@@ -0,0 +1,37 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from drugs.db import db
+from drugs.utils import utils
+from drugs.utils.work_queue import WorkQueue
+
+ACTIONS = ('status', 'reset')
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {
+        'LOG_ENABLED': False,
+    }
+
+    def syntax(self):
+        return '<spider> [status|reset]'
+
+    def short_desc(self):
+        return 'Show the distributed work queue of a spider, or empty it before a new run'
+
+    def run(self, args, opts):
+        if not 1 <= len(args) <= 2 or (action := (args[1:] or ['status'])[0]) not in ACTIONS:
+            raise UsageError()
+
+        sqlalchemy = db.SQLAlchemy(utils.get_db_url(self.settings), **utils.get_db_options(self.settings))
+        queue = WorkQueue(args[0], worker=None, max_attempts=self.settings.getint('DISTRIBUTED_MAX_ATTEMPTS'))
+
+        if action == 'reset':
+            print('{}:\t{} requests deleted'.format(args[0], queue.reset(sqlalchemy.session)))
+        else:
+            print('{}:\t{}'.format(args[0], '\t'.join(
+                '{}: {}'.format(state, count) for state, count in queue.get_counts(sqlalchemy.session).items()
+            )))
+
+        sqlalchemy.close()
@@ -1,28 +1,132 @@
+import time
+import weakref
+
+import sqlalchemy
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+# keeps the IN lists well below the bind parameter limits of every backend
+CHUNK_SIZE = 1000
+
+# psycopg2 multi row VALUES inserts, the mode was renamed in SQLAlchemy 1.4
+EXECUTEMANY_MODE = 'values' if tuple(map(int, sqlalchemy.__version__.split('.')[:2])) < (1, 4) else 'values_only'
+
+_engines = {}
+
+
+class MeasuredQueuePool(QueuePool):
+
+    def __init__(self, *args, **kwargs):
+        super(MeasuredQueuePool, self).__init__(*args, **kwargs)
+
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_overflow_used = 0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super(MeasuredQueuePool, self)._do_get()
+        finally:
+            self.checkouts += 1
+            self.wait_time += time.perf_counter() - started
+            self.max_overflow_used = max(self.max_overflow_used, self.overflow())
+
+    def get_metrics(self):
+        return {
+            'checkouts': self.checkouts,
+            'wait_time': round(self.wait_time, 6),
+            'max_overflow': self.max_overflow_used,
+            'size': self.size()
+        }
 
 
 class SQLAlchemy:
 
-    def __init__(self, url):
+    def __init__(self, url, pool_size=5, max_overflow=10, pool_pre_ping=False,
+                 pool_recycle=-1, statement_timeout=None):
         self.url = url
+        self.pool_options = {
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            'pool_pre_ping': pool_pre_ping,
+            'pool_recycle': pool_recycle
+        }
+        self.statement_timeout = statement_timeout
 
-        self._engine = None
         self._session = None
+        # the session of every thread, scoped_session.remove only reaches the calling one
+        self._sessions = weakref.WeakSet()
 
     @property
     def engine(self):
-        if self._engine is None:
-            self._engine = create_engine(self.url, client_encoding='utf8')
-        return self._engine
+        # engines are shared by every wrapper with the same url and options,
+        # so pipelines and spiders draw from one pool
+        key = (self.url, self.statement_timeout, *sorted(self.pool_options.items()))
+        if (engine := _engines.get(key)) is None:
+            engine = _engines[key] = self._create_engine()
+        return engine
 
     @property
     def session(self):
         if self._session is None:
-            session_maker = sessionmaker(bind=self.engine)
-            self._session = session_maker()
+            self._session = scoped_session(self._get_session_factory())
         return self._session
 
     def close(self):
         if self._session is not None:
-            self.session.close()
+            self._session.remove()
+        for session in list(self._sessions):
+            session.close()
+        self._sessions.clear()
+
+    def _get_session_factory(self):
+        factory = sessionmaker(bind=self.engine)
+
+        def create_session():
+            session = factory()
+            self._sessions.add(session)
+            return session
+        return create_session
+
+    def _create_engine(self):
+        return create_engine(self.url, **self._get_engine_kwargs())
+
+    def _get_engine_kwargs(self):
+        if self.url.startswith('sqlite'):
+            # sessions are handed between the reactor and its thread pool, never shared at once
+            return {'connect_args': {'check_same_thread': False}}
+        if not self.url.startswith('postgresql'):
+            return {}
+
+        kwargs = {
+            'client_encoding': 'utf8',
+            'executemany_mode': EXECUTEMANY_MODE,
+            'poolclass': MeasuredQueuePool,
+            **self.pool_options
+        }
+        if self.statement_timeout:
+            # a session level SET would stay on the server connection pgbouncer hands to its next client
+            kwargs['connect_args'] = {'options': '-c statement_timeout={:d}'.format(int(self.statement_timeout))}
+        return kwargs
+
+
+def get_pool_metrics():
+    metrics = {'checkouts': 0, 'wait_time': 0.0, 'max_overflow': 0, 'size': 0}
+    for engine in _engines.values():
+        if not isinstance(engine.pool, MeasuredQueuePool):
+            continue
+        for name, value in engine.pool.get_metrics().items():
+            metrics[name] = max(metrics[name], value) if name == 'max_overflow' else metrics[name] + value
+    return metrics
+
+
+def insert_ignore(db_session, table, rows):
+    # rows whose primary key is already there are left as they are
+    if db_session.get_bind().dialect.name == 'postgresql':
+        stmt = postgresql.insert(table).on_conflict_do_nothing()
+    else:
+        stmt = table.insert().prefix_with('OR IGNORE')
+    db_session.execute(stmt, rows)
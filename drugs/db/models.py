@@ -1,15 +1,51 @@
-from sqlalchemy import Column, Integer, Text, Float, Boolean, JSON
+from sqlalchemy import Column, Integer, Text, Float, Boolean, DateTime, Index, JSON, func, select
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.declarative import declarative_base
 
+# binary json on postgres is parsed once on write and can be GIN indexed
+JSONB = JSON().with_variant(postgresql.JSONB(), 'postgresql')
 
 Base = declarative_base()
 
 
 class OzDrug(Base):
+    # hot fields are extracted from data on write, `scrapy migrate_oz` upgrades older tables
     __tablename__ = 'oz_drug'
+    __table_args__ = (
+        Index('ix_oz_drug_categories', 'categories', postgresql_using='gin'),
+        # in stock offers are listed by price
+        Index('ix_oz_drug_is_in_stock_price', 'is_in_stock', 'price'),
+    )
 
     id = Column(Integer, primary_key=True)
-    data = Column(JSON)
+    data = Column(JSONB)
+    price = Column(Float, index=True)
+    is_in_stock = Column(Boolean)
+    manufacturer_id = Column(Integer, index=True)
+    manufacturer = Column(Text)
+    categories = Column(JSONB)
+
+
+class Category(Base):
+    # the oz catalogue tree, path lists the ids from the top level category down as /id/id/
+    __tablename__ = 'category'
+    __table_args__ = (
+        # prefix matches select a subtree
+        Index('ix_category_path', 'path', postgresql_ops={'path': 'text_pattern_ops'}),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    parent_id = Column(Integer, index=True)
+    name = Column(Text)
+    path = Column(Text)
+
+
+class DrugCategory(Base):
+    # every category on the breadcrumbs of a drug, ancestors included
+    __tablename__ = 'drug_category'
+
+    category_id = Column(Integer, primary_key=True, autoincrement=False)
+    drug_id = Column(Integer, primary_key=True, autoincrement=False, index=True)
 
 
 class AsnaDrug(Base):
@@ -22,3 +58,75 @@ class AsnaDrug(Base):
     price = Column(Float)
     images = Column(JSON)
     is_receipt = Column(Boolean)
+    url = Column(Text, index=True)
+
+    @classmethod
+    def get_latest_ids(cls, condition=None):
+        # rows are appended on every crawl, only the latest one of each url is current
+        table = cls.__table__
+        query = select([func.max(table.c.id)])
+        if condition is not None:
+            query = query.where(condition)
+        return query.group_by(table.c.url)
+
+
+class Fingerprint(Base):
+    __tablename__ = 'fingerprint'
+
+    source = Column(Text, primary_key=True)
+    key = Column(Text, primary_key=True)
+    digest = Column(Text)
+    etag = Column(Text)
+    last_modified = Column(Text)
+
+
+class Checkpoint(Base):
+    __tablename__ = 'checkpoint'
+
+    source = Column(Text, primary_key=True)
+    state = Column(JSON)
+
+
+class DrugMatch(Base):
+    __tablename__ = 'drug_match'
+
+    oz_id = Column(Integer, primary_key=True)
+    asna_url = Column(Text, index=True)
+    confidence = Column(Float)
+
+
+class PriceHistory(Base):
+    # one row per change, the primary key doubles as the latest / price at time index
+    __tablename__ = 'price_history'
+
+    source = Column(Text, primary_key=True)
+    product_id = Column(Text, primary_key=True)
+    observed_at = Column(DateTime, primary_key=True)
+    price = Column(Float)
+    is_in_stock = Column(Boolean)
+
+
+class WorkItem(Base):
+    # the request frontier shared by distributed workers, one row per request fingerprint
+    __tablename__ = 'work_queue'
+    __table_args__ = (
+        Index('ix_work_queue_open', 'source', 'is_done', 'leased_until'),
+    )
+
+    source = Column(Text, primary_key=True)
+    key = Column(Text, primary_key=True)
+    request = Column(JSON)
+    seeded_at = Column(Float)
+    # unix times, compared by every worker against its own clock
+    leased_until = Column(Float)
+    worker = Column(Text)
+    attempts = Column(Integer)
+    is_done = Column(Boolean)
+
+
+class RateLimit(Base):
+    # the next request time of a domain shared by distributed workers
+    __tablename__ = 'rate_limit'
+
+    domain = Column(Text, primary_key=True)
+    next_at = Column(Float)
@@ -0,0 +1,263 @@
+# Define here the extensions for your project
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import defer, reactor, threads
+from twisted.web import resource, server
+
+from drugs import signals as drugs_signals
+from drugs.db import db
+from drugs.pipelines import UnchangedItem
+from drugs.utils import timing, utils
+from drugs.utils.checkpoints import CheckpointStore
+from drugs.utils.matching import DrugMatcher
+from drugs.utils.parse_pool import ParsePool
+from drugs.utils.queries import DrugQueries, QueryCache
+
+
+class ParsePoolExtension:
+
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+
+        self._pool = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not (pool_size := crawler.settings.getint('PARSE_POOL_SIZE')):
+            raise NotConfigured
+
+        extension = cls(pool_size=pool_size)
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        self._pool = spider.parse_pool = ParsePool(self.pool_size)
+
+    def spider_closed(self, spider):
+        return threads.deferToThread(self._pool.close)
+
+
+class DbPoolStatsExtension:
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        extension = cls(stats=crawler.stats)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_closed(self, spider):
+        for name, value in db.get_pool_metrics().items():
+            self.stats.set_value('db_pool/{}'.format(name), value, spider=spider)
+
+
+class TimingStatsExtension:
+
+    def __init__(self, stats, prometheus_file=None, prometheus_port=None):
+        self.stats = stats
+        self.prometheus_file = prometheus_file
+        self.prometheus_port = prometheus_port
+
+        self._port = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('TIMING_ENABLED'):
+            raise NotConfigured
+
+        extension = cls(
+            stats=crawler.stats,
+            prometheus_file=crawler.settings.get('TIMING_PROMETHEUS_FILE'),
+            prometheus_port=crawler.settings.getint('TIMING_PROMETHEUS_PORT') or None
+        )
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        timing.reset()
+        timing.enable()
+
+        if self.prometheus_port is not None:
+            # only a collector on the same host can scrape it
+            self._port = reactor.listenTCP(
+                self.prometheus_port, server.Site(PrometheusResource()), interface='127.0.0.1'
+            )
+            spider.logger.info('Serving stage timings on 127.0.0.1:%d', self.prometheus_port)
+
+    def spider_closed(self, spider):
+        timing.enable(False)
+
+        for stage, stage_stats in timing.get_stages().items():
+            for name, value in stage_stats.items():
+                self.stats.set_value('timing/{}/{}'.format(stage, name), value, spider=spider)
+
+        if self.prometheus_file:
+            with open(self.prometheus_file, 'w', encoding='utf-8') as file:
+                file.write(timing.to_prometheus())
+
+        if self._port is not None:
+            return self._port.stopListening()
+
+
+class PrometheusResource(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4')
+        return timing.to_prometheus().encode('utf-8')
+
+
+class CheckpointExtension:
+    # The spider's checkpoint only moves on batch_saved, once its items are committed,
+    # or when they are dropped as unchanged and so already stored
+
+    def __init__(self, pg_url, db_options=None):
+        self.pg_url = pg_url
+        self.db_options = db_options or {}
+
+        self._db = None
+        self._store = None
+        self._lock = defer.DeferredLock()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if (
+            not settings.getbool('CHECKPOINTS_ENABLED')
+            or settings.get('SINK') != 'db'
+            or settings.getbool('DISTRIBUTED_ENABLED')
+        ):
+            raise NotConfigured
+
+        extension = cls(pg_url=utils.get_db_url(crawler.settings), db_options=utils.get_db_options(crawler.settings))
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(extension.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(extension.batch_saved, signal=drugs_signals.batch_saved)
+        return extension
+
+    def spider_opened(self, spider):
+        self._db = db.SQLAlchemy(self.pg_url, **self.db_options)
+        self._store = CheckpointStore(spider.name)
+
+        d = threads.deferToThread(self._store.create_table, self._db.engine)
+        if not spider.resume:
+            # forget the previous run right away, a resume must never skip pages this run did not save
+            return d.addCallback(lambda _: self._save(spider))
+        d.addCallback(lambda _: threads.deferToThread(self._store.load, self._db.session))
+        return d.addCallback(self._restore, spider)
+
+    @staticmethod
+    def _restore(state, spider):
+        if state is not None:
+            spider.restore_checkpoint(state)
+
+    def spider_closed(self, spider):
+        return self._lock.run(defer.succeed, None).addCallback(lambda _: self._db.close())
+
+    def batch_saved(self, items, spider):
+        if spider.advance_checkpoint(items):
+            return self._save(spider)
+
+    def item_dropped(self, item, response, exception, spider):
+        if isinstance(exception, UnchangedItem) and spider.advance_checkpoint([item]):
+            return self._save(spider)
+
+    def _save(self, spider):
+        return self._lock.run(threads.deferToThread, self._store.save, self._db.session, spider.get_checkpoint())
+
+
+class MatchingExtension:
+    # Keeps drug_match current while crawling, `scrapy match` rebuilds it from scratch
+
+    def __init__(self, pg_url, min_confidence, stats, db_options=None):
+        self.pg_url = pg_url
+        self.min_confidence = min_confidence
+        self.stats = stats
+        self.db_options = db_options or {}
+
+        self._db = None
+        self._matcher = None
+        self._lock = defer.DeferredLock()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('MATCHING_ENABLED') or settings.get('SINK') != 'db':
+            raise NotConfigured
+
+        extension = cls(
+            pg_url=utils.get_db_url(crawler.settings),
+            min_confidence=settings.getfloat('MATCHING_MIN_CONFIDENCE'),
+            stats=crawler.stats,
+            db_options=utils.get_db_options(crawler.settings)
+        )
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(extension.batch_saved, signal=drugs_signals.batch_saved)
+        return extension
+
+    def spider_opened(self, spider):
+        self._db = db.SQLAlchemy(self.pg_url, **self.db_options)
+        self._matcher = DrugMatcher(self.min_confidence)
+        # matches the load finds missing or stale are written before the crawl starts
+        return threads.deferToThread(self._matcher.load, self._db.session).addCallback(self._save)
+
+    def spider_closed(self, spider):
+        self.stats.set_value('matching/matches', len(self._matcher), spider=spider)
+        return self._lock.run(defer.succeed, None).addCallback(lambda _: self._db.close())
+
+    def batch_saved(self, items, spider):
+        rows = self._matcher.add(spider.name, (entry for item in items for entry in spider.get_match_entries(item)))
+        self.stats.inc_value('matching/updated', len(rows), spider=spider)
+        return self._save(rows)
+
+    def _save(self, rows):
+        if rows:
+            return self._lock.run(threads.deferToThread, self._matcher.save, self._db.session, rows)
+
+
+class QueryCacheExtension:
+    # Gives the spider a DrugQueries read API whose cached lookups of a product
+    # are dropped once the pipeline commits that product
+
+    def __init__(self, cache_size, cache_ttl, stats):
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.stats = stats
+
+        self._queries = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('QUERY_CACHE_ENABLED') or settings.get('SINK') != 'db':
+            raise NotConfigured
+
+        extension = cls(
+            cache_size=settings.getint('QUERY_CACHE_SIZE'),
+            cache_ttl=settings.getfloat('QUERY_CACHE_TTL'),
+            stats=crawler.stats
+        )
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(extension.batch_saved, signal=drugs_signals.batch_saved)
+        return extension
+
+    def spider_opened(self, spider):
+        self._queries = spider.drug_queries = DrugQueries(QueryCache(self.cache_size, self.cache_ttl))
+
+    def spider_closed(self, spider):
+        self.stats.set_value('query_cache/hits', self._queries.cache.hits, spider=spider)
+        self.stats.set_value('query_cache/misses', self._queries.cache.misses, spider=spider)
+
+    def batch_saved(self, items, spider):
+        self._queries.invalidate(spider.name, [key for item in items for key, _ in spider.get_fingerprint_entries(item)])
@@ -2,11 +2,64 @@
 #
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/items.html
+#
+# Items are slotted attrs classes, validated when they are built
+# so schema errors surface in the spider instead of at commit time
+
+import json
+
+import attr
+from attr.converters import optional as optional_converter
+from attr.validators import deep_iterable, instance_of, optional
+
+
+def _list_of(item_type):
+    return deep_iterable(instance_of(item_type), instance_of(list))
+
+
+def _optional_int(value):
+    # oz option ids come as strings and may be blank
+    return int(value) if value not in (None, '') else None
+
+
+class RowMixin:
+    __slots__ = ()
+
+    def to_row(self):
+        return attr.asdict(self, recurse=False)
+
+    def to_json(self):
+        return json.dumps(self.to_row(), ensure_ascii=False, default=str)
+
+
+@attr.s(slots=True)
+class AsnaDrugItem(RowMixin):
+    title = attr.ib(validator=instance_of(str))
+    info = attr.ib(validator=optional(_list_of(dict)))
+    instructions = attr.ib(validator=optional(_list_of(dict)))
+    price = attr.ib(converter=optional_converter(float))
+    images = attr.ib(validator=optional(_list_of(dict)))
+    is_receipt = attr.ib(validator=instance_of(bool))
+    url = attr.ib(validator=instance_of(str))
+
+
+@attr.s(slots=True)
+class OzDrugItem(RowMixin):
+    id = attr.ib(converter=int)
+    data = attr.ib(validator=instance_of(dict), repr=False)
+    price = attr.ib(converter=optional_converter(float))
+    is_in_stock = attr.ib(validator=instance_of(bool))
+    manufacturer_id = attr.ib(converter=_optional_int)
+    manufacturer = attr.ib(validator=optional(instance_of(str)))
+    categories = attr.ib(validator=optional(instance_of(dict)))
 
-import scrapy
 
+@attr.s(slots=True)
+class OzPageItem:
+    # raw product dicts until the page is normalized into drugs
+    page = attr.ib(validator=instance_of(int))
+    items = attr.ib(default=None, validator=optional(_list_of(dict)), repr=False)
+    drugs = attr.ib(default=None, validator=optional(_list_of(OzDrugItem)), repr=False)
 
-class DrugsItem(scrapy.Item):
-    # define the fields for your item here like:
-    # name = scrapy.Field()
-    pass
+    def get_raw_items(self):
+        return self.items if self.drugs is None else [drug.data for drug in self.drugs]
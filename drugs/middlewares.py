@@ -3,11 +3,26 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import os
+import socket
+from collections import deque
+from functools import partial
+
+import scrapy
 from scrapy import signals
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest, NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.internet import defer, reactor, task, threads
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from drugs import signals as drugs_signals
+from drugs.db import db
+from drugs.utils import utils
+from drugs.utils.archive import ResponseArchive
+from drugs.utils.work_queue import SharedRateLimit, WorkQueue
+
 
 class DrugsSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -101,3 +116,431 @@ class DrugsDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class RecordReplayDownloaderMiddleware(DrugsDownloaderMiddleware):
+    # REPLAY_MODE = 'record' stores every downloaded response in REPLAY_ARCHIVE,
+    # REPLAY_MODE = 'replay' serves responses from it without touching the network
+
+    def __init__(self, mode, archive, stats):
+        self.mode = mode
+        self.archive = archive
+        self.stats = stats
+
+        self._records = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if (mode := utils.get_config_var(crawler, 'REPLAY_MODE')) not in ('record', 'replay'):
+            raise NotConfigured
+
+        s = cls(
+            mode=mode,
+            archive=ResponseArchive(
+                utils.get_config_var(crawler, 'REPLAY_ARCHIVE').format(spider=crawler.spidercls.name)
+            ),
+            stats=crawler.stats
+        )
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_request(self, request, spider):
+        if self.mode != 'replay':
+            return None
+
+        if (record := self._records.get(utils.get_request_fingerprint(request))) is None:
+            self.stats.inc_value('replay/missing', spider=spider)
+            raise IgnoreRequest('Not in archive: {}'.format(request.url))
+
+        self.stats.inc_value('replay/hits', spider=spider)
+        return self.archive.build_response(record, request)
+
+    def process_response(self, request, response, spider):
+        if self.mode == 'record' and 'replayed' not in response.flags:
+            self.archive.append(utils.get_request_fingerprint(request), response)
+            self.stats.inc_value('replay/recorded', spider=spider)
+        return response
+
+    def spider_opened(self, spider):
+        if self.mode == 'replay':
+            self._records = self.archive.load()
+            spider.logger.info('Replaying %d responses from %s', len(self._records), self.archive.path)
+
+    def spider_closed(self, spider):
+        self.archive.close()
+
+
+class AdaptiveThrottleDownloaderMiddleware(DrugsDownloaderMiddleware):
+    # Resizes the downloader slot of every domain once per ADAPTIVE_THROTTLE_WINDOW responses:
+    # 429/5xx/download errors or spider.has_errors() above the tolerated rate halve concurrency
+    # and double the delay, latency above ADAPTIVE_THROTTLE_LATENCY_FACTOR times the best window
+    # seen holds, otherwise the delay is halved and then concurrency grows by one
+
+    # responses served from the http cache or a replay archive say nothing about the site
+    skipped_flags = frozenset(('cached', 'replayed'))
+
+    def __init__(self, crawler, window, min_delay, max_delay, min_concurrency, max_concurrency,
+                 max_error_rate, latency_factor):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.window = window
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_error_rate = max_error_rate
+        self.latency_factor = latency_factor
+
+        self._windows = {}
+        self._base_latencies = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('ADAPTIVE_THROTTLE_ENABLED'):
+            raise NotConfigured
+
+        s = cls(
+            crawler=crawler,
+            window=crawler.settings.getint('ADAPTIVE_THROTTLE_WINDOW'),
+            min_delay=crawler.settings.getfloat('ADAPTIVE_THROTTLE_MIN_DELAY'),
+            max_delay=crawler.settings.getfloat('ADAPTIVE_THROTTLE_MAX_DELAY'),
+            min_concurrency=crawler.settings.getint('ADAPTIVE_THROTTLE_MIN_CONCURRENCY'),
+            max_concurrency=crawler.settings.getint('ADAPTIVE_THROTTLE_MAX_CONCURRENCY'),
+            max_error_rate=crawler.settings.getfloat('ADAPTIVE_THROTTLE_MAX_ERROR_RATE'),
+            latency_factor=crawler.settings.getfloat('ADAPTIVE_THROTTLE_LATENCY_FACTOR')
+        )
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        return s
+
+    def process_response(self, request, response, spider):
+        if not self.skipped_flags.isdisjoint(response.flags) or (slot := self._get_slot(request)) is None:
+            return response
+
+        if response.status == 429 and (retry_after := response.headers.get('Retry-After', b'')).isdigit():
+            slot.delay = min(self.max_delay, max(slot.delay, float(retry_after)))
+
+        is_error = response.status == 429 or response.status >= 500 or spider.has_errors(response)
+        self._observe(request.meta['download_slot'], slot, spider, request.meta.get('download_latency'), is_error)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if not isinstance(exception, IgnoreRequest) and (slot := self._get_slot(request)) is not None:
+            self._observe(request.meta['download_slot'], slot, spider, None, True)
+
+    def _observe(self, key, slot, spider, latency, is_error):
+        # [responses, errors, latency sum, responses with latency]
+        window = self._windows.setdefault(key, [0, 0, 0.0, 0])
+        window[0] += 1
+        window[1] += is_error
+        if latency is not None:
+            window[2] += latency
+            window[3] += 1
+
+        if window[0] >= self.window:
+            del self._windows[key]
+            self._adjust(key, slot, spider, *window)
+
+    def _adjust(self, key, slot, spider, responses, errors, latency_sum, latency_count):
+        error_rate = errors / responses
+        latency = latency_sum / latency_count if latency_count else None
+        if latency is not None:
+            self._base_latencies[key] = min(self._base_latencies.get(key, latency), latency)
+
+        slot.concurrency = min(self.max_concurrency, max(self.min_concurrency, slot.concurrency))
+        if error_rate > self.max_error_rate:
+            decision = 'decrease'
+            slot.concurrency = max(self.min_concurrency, slot.concurrency // 2)
+            slot.delay = min(self.max_delay, max(slot.delay * 2, self.min_delay, 0.1))
+        elif latency is not None and latency > self._base_latencies[key] * self.latency_factor:
+            decision = 'hold'
+        elif slot.delay > self.min_delay:
+            # delays below 50ms are not worth halving further
+            decision = 'increase'
+            slot.delay = max(self.min_delay, slot.delay / 2 if slot.delay >= 0.1 else 0.0)
+        elif slot.concurrency < self.max_concurrency:
+            decision = 'increase'
+            slot.concurrency += 1
+        else:
+            decision = 'hold'
+
+        self.stats.inc_value('throttle/{}'.format(decision), spider=spider)
+        self.stats.set_value('throttle/{}/concurrency'.format(key), slot.concurrency, spider=spider)
+        self.stats.set_value('throttle/{}/delay'.format(key), slot.delay, spider=spider)
+        self.stats.max_value('throttle/{}/max_concurrency'.format(key), slot.concurrency, spider=spider)
+        spider.logger.debug(
+            'Throttle %s %s: concurrency %d, delay %.2fs (error rate %.3f, latency %s)',
+            decision, key, slot.concurrency, slot.delay, error_rate,
+            '{:.3f}s'.format(latency) if latency is not None else '-'
+        )
+
+    def _get_slot(self, request):
+        # the downloader stores the slot key in meta when it enqueues a request
+        if (key := request.meta.get('download_slot')) is None:
+            return None
+        return self.crawler.engine.downloader.slots.get(key)
+
+
+class DistributedSpiderMiddleware:
+    # Requests the spider yields are seeded into the shared work_queue instead of being
+    # scheduled, and every worker crawls the ones it leases from there. A leased request
+    # is completed once the items its response yielded are committed, failed downloads are
+    # released to be leased again, and leases of a worker that died run out on their own
+
+    def __init__(self, crawler, pg_url, worker, lease_size, lease_timeout, max_attempts, db_options=None):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.lease_size = lease_size
+        self.lease_timeout = lease_timeout
+
+        self._db = db.SQLAlchemy(pg_url, **(db_options or {}))
+        self._queue = WorkQueue(crawler.spidercls.name, worker, lease_timeout, max_attempts)
+        self._lock = defer.DeferredLock()
+        self._renew_loop = None
+        self._is_leasing = False
+        self._is_finished = False
+
+        # keys leased and not yet through the spider
+        self._in_flight = set()
+        # items yielded and dropped so far, the rest went to the DrugsPipeline buffer in that order,
+        # and items committed from it: a key is done once the items buffered before its response ended are
+        self._yielded = 0
+        self._dropped = 0
+        self._saved = 0
+        self._unsaved = deque()
+        self._failed = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('DISTRIBUTED_ENABLED') or settings.get('SINK') != 'db':
+            raise NotConfigured
+
+        s = cls(
+            crawler=crawler,
+            pg_url=utils.get_db_url(crawler.settings),
+            worker=settings.get('DISTRIBUTED_WORKER') or '{}:{}'.format(socket.gethostname(), os.getpid()),
+            lease_size=settings.getint('DISTRIBUTED_LEASE_SIZE'),
+            lease_timeout=settings.getfloat('DISTRIBUTED_LEASE_TIMEOUT'),
+            max_attempts=settings.getint('DISTRIBUTED_MAX_ATTEMPTS'),
+            db_options=utils.get_db_options(crawler.settings)
+        )
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(s.item_error, signal=signals.item_error)
+        crawler.signals.connect(s.batch_saved, signal=drugs_signals.batch_saved)
+        return s
+
+    def process_start_requests(self, start_requests, spider):
+        # every worker seeds them, the ones some worker seeded before keep their state
+        self._seed(spider, list(start_requests))
+        return []
+
+    def process_spider_output(self, response, result, spider):
+        requests = []
+        for entry in result:
+            if isinstance(entry, scrapy.Request):
+                requests.append(entry)
+                continue
+            self._yielded += 1
+            yield entry
+
+        self._seed(spider, requests)
+        # a key already released by its errback, on an http error status, stays released
+        if (key := response.meta.get('work_key')) is not None and key in self._in_flight:
+            self._in_flight.discard(key)
+            self._unsaved.append((self._yielded - self._dropped, key))
+            self._complete_saved()
+            self._refill(spider)
+
+    def process_spider_exception(self, response, exception, spider):
+        if (key := response.meta.get('work_key')) is not None and key in self._in_flight:
+            self._in_flight.discard(key)
+            self.stats.inc_value('distributed/released', spider=spider)
+            self._run(self._queue.release, [key])
+            self._refill(spider)
+
+    def spider_opened(self, spider):
+        self._renew_loop = task.LoopingCall(self._renew)
+        self._renew_loop.start(self.lease_timeout / 3, now=False).addErrback(
+            lambda failure: spider.logger.error('Lease renewal failed: %s', failure.value)
+        )
+
+    def spider_idle(self, spider):
+        # the queue may still get requests from workers holding leases, so it is polled
+        # on every idle signal until none is left to lease anywhere
+        if self._is_finished:
+            return
+        if not self._is_leasing:
+            self._lease(spider)
+        raise DontCloseSpider
+
+    def spider_closed(self, spider):
+        if self._renew_loop is not None and self._renew_loop.running:
+            self._renew_loop.stop()
+        # whatever was not committed by now is left for the other workers
+        keys = self._in_flight | {key for _, key in self._unsaved}
+        d = self._run(self._queue.release, keys) if keys else self._lock.run(defer.succeed, None)
+        return d.addCallback(lambda _: self._db.close())
+
+    def batch_saved(self, items, spider):
+        self._saved += len(items)
+        return self._complete_saved()
+
+    def item_dropped(self, item, response, exception, spider):
+        self._dropped += 1
+        return self._complete_saved()
+
+    def item_error(self, item, response, spider, failure):
+        self._dropped += 1
+        if (key := response.meta.get('work_key')) is not None:
+            self._failed.add(key)
+        return self._complete_saved()
+
+    def _seed(self, spider, requests):
+        if requests:
+            self.stats.inc_value('distributed/seeded', len(requests), spider=spider)
+            return self._run(self._queue.seed, [
+                (utils.get_request_fingerprint(request), self._to_dict(request)) for request in requests
+            ])
+
+    def _refill(self, spider):
+        # leases are taken in batches of at least half the lease size
+        if not self._is_leasing and len(self._in_flight) <= self.lease_size // 2:
+            self._lease(spider)
+
+    def _lease(self, spider):
+        self._is_leasing = True
+        d = self._run(self._queue.lease, self.lease_size - len(self._in_flight))
+        d.addCallback(self._crawl, spider)
+        d.addErrback(lambda failure: spider.logger.error('Leasing failed: %s', failure.value))
+        d.addBoth(self._leased)
+
+    def _leased(self, _):
+        self._is_leasing = False
+
+    def _crawl(self, entries, spider):
+        self.stats.inc_value('distributed/leased', len(entries), spider=spider)
+        for key, request in entries:
+            self._in_flight.add(key)
+            self.crawler.engine.crawl(self._from_dict(request, key, spider))
+
+        if not entries and not self._in_flight:
+            return self._run(self._queue.has_open).addCallback(self._set_finished, spider)
+
+    def _set_finished(self, has_open, spider):
+        # closed right away rather than on the next idle signal
+        if not has_open and not self._in_flight:
+            self._is_finished = True
+            self.crawler.engine.close_spider(spider, 'finished')
+
+    def _fail(self, failure, key, errback, spider):
+        self._in_flight.discard(key)
+        self.stats.inc_value('distributed/released', spider=spider)
+        self._run(self._queue.release, [key])
+        self._refill(spider)
+
+        # errback output does not go through the spider middlewares
+        requests, output = [], []
+        for entry in (errback(failure) if errback is not None else None) or ():
+            (requests if isinstance(entry, scrapy.Request) else output).append(entry)
+        self._seed(spider, requests)
+        return output
+
+    def _complete_saved(self):
+        completed, released = [], []
+        while self._unsaved and self._unsaved[0][0] <= self._saved:
+            _, key = self._unsaved.popleft()
+            if key in self._failed:
+                self._failed.discard(key)
+                released.append(key)
+            else:
+                completed.append(key)
+
+        if completed:
+            self.stats.inc_value('distributed/completed', len(completed))
+            self._run(self._queue.complete, completed)
+        if released:
+            self.stats.inc_value('distributed/released', len(released))
+            return self._run(self._queue.release, released)
+
+    def _renew(self):
+        if keys := self._in_flight | {key for _, key in self._unsaved}:
+            return self._run(self._queue.renew, keys)
+
+    def _run(self, method, *args):
+        return self._lock.run(threads.deferToThread, method, self._db.session, *args)
+
+    @staticmethod
+    def _to_dict(request):
+        # callbacks are spider methods, looked up by name again by whichever worker leases it
+        return {
+            'url': request.url,
+            'method': request.method,
+            'headers': {
+                key.decode('latin-1'): [value.decode('latin-1') for value in values]
+                for key, values in request.headers.items()
+            },
+            'body': request.body.decode('latin-1'),
+            'callback': request.callback.__name__ if request.callback is not None else None,
+            'errback': request.errback.__name__ if request.errback is not None else None,
+            'cb_kwargs': request.cb_kwargs,
+            'meta': request.meta,
+            'priority': request.priority
+        }
+
+    def _from_dict(self, request, key, spider):
+        errback = getattr(spider, request['errback']) if request['errback'] is not None else None
+        return scrapy.Request(
+            url=request['url'],
+            method=request['method'],
+            headers=request['headers'],
+            body=request['body'].encode('latin-1'),
+            callback=getattr(spider, request['callback']) if request['callback'] is not None else None,
+            errback=partial(self._fail, key=key, errback=errback, spider=spider),
+            cb_kwargs=request['cb_kwargs'],
+            meta={**request['meta'], 'work_key': key},
+            priority=request['priority'],
+            # the queue already holds every request once, a released one must be crawled again
+            dont_filter=True
+        )
+
+
+class SharedRateLimitDownloaderMiddleware(DrugsDownloaderMiddleware):
+    # Spaces the requests to a domain 1 / DISTRIBUTED_RATE_LIMIT seconds apart across every
+    # distributed worker, on top of the download delay each worker keeps by itself
+
+    def __init__(self, pg_url, rate_limit, stats, db_options=None):
+        self.stats = stats
+
+        self._db = db.SQLAlchemy(pg_url, **(db_options or {}))
+        self._rate_limit = SharedRateLimit(1 / rate_limit)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('DISTRIBUTED_ENABLED') or not settings.getfloat('DISTRIBUTED_RATE_LIMIT'):
+            raise NotConfigured
+
+        s = cls(
+            pg_url=utils.get_db_url(crawler.settings),
+            rate_limit=settings.getfloat('DISTRIBUTED_RATE_LIMIT'),
+            stats=crawler.stats,
+            db_options=utils.get_db_options(crawler.settings)
+        )
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    async def process_request(self, request, spider):
+        domain = urlparse_cached(request).hostname
+        delay = await threads.deferToThread(self._rate_limit.reserve, self._db.session, domain)
+        if delay:
+            self.stats.inc_value('distributed/rate_limit/waits', spider=spider)
+            self.stats.inc_value('distributed/rate_limit/wait_time', delay, spider=spider)
+            await task.deferLater(reactor, delay, lambda: None)
+        return None
+
+    def spider_closed(self, spider):
+        self._db.close()
@@ -3,36 +3,272 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
+import os
+
+from scrapy import signals as scrapy_signals
+from scrapy.exceptions import DropItem, NotConfigured
+from twisted.internet import defer, task, threads
+
+from drugs import signals
 from drugs.db import db
-from drugs.utils import utils
+from drugs.utils import fingerprints, sinks, timing, utils
+from drugs.utils.categories import CategoryTree
+from drugs.utils.price_history import PriceHistory
+
+
+class UnchangedItem(DropItem):
+    pass
+
+
+class FingerprintPipeline:
+
+    def __init__(self, pg_url, stats, db_options=None):
+        self.pg_url = pg_url
+        self.stats = stats
+        self.db_options = db_options or {}
+
+        self._db = None
+        self._store = None
+        self._lock = defer.DeferredLock()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # digests are recorded on batch_saved, which only the db sink sends
+        if not crawler.settings.getbool('FINGERPRINTS_ENABLED') or crawler.settings.get('SINK', 'db') != 'db':
+            raise NotConfigured
+
+        pipeline = cls(
+            pg_url=utils.get_db_url(crawler.settings),
+            stats=crawler.stats,
+            db_options=utils.get_db_options(crawler.settings)
+        )
+        crawler.signals.connect(pipeline.batch_saved, signal=signals.batch_saved)
+        crawler.signals.connect(pipeline.spider_closed, signal=scrapy_signals.spider_closed)
+        return pipeline
+
+    def open_spider(self, spider):
+        self._db = db.SQLAlchemy(self.pg_url, **self.db_options)
+        self._store = spider.fingerprints = fingerprints.FingerprintStore(spider.name)
+        return threads.deferToThread(self._store.load, self._db.session)
+
+    def spider_closed(self, spider):
+        # let fingerprint writes already in flight finish on this session
+        return self._lock.run(defer.succeed, None).addCallback(lambda _: self._db.close())
+
+    @timing.timed('fingerprint')
+    def process_item(self, item, spider):
+        kept = []
+        for key, sub_item in spider.get_fingerprint_entries(item):
+            status = self._store.classify(key, fingerprints.get_digest(sub_item))
+            self.stats.inc_value('fingerprints/{}'.format(status), spider=spider)
+            if status != fingerprints.UNCHANGED:
+                kept.append(sub_item)
+
+        if (item := spider.filter_fingerprinted(item, kept)) is None:
+            raise UnchangedItem('Unchanged')
+        return item
+
+    def batch_saved(self, items, spider):
+        rows = self._store.pop_committed(
+            (key for item in items for key, _ in spider.get_fingerprint_entries(item)),
+            # batch_saved runs before the next batch is saved, so these are still this batch's
+            skipped=spider.skipped_keys
+        )
+        if rows:
+            return self._lock.run(threads.deferToThread, self._store.save, self._db.session, rows)
+
+
+class NormalizationPipeline:
+
+    @timing.timed('normalize')
+    def process_item(self, item, spider):
+        return spider.normalize(item)
+
+
+class FileSinkPipeline:
+
+    def __init__(self, storage_dir, file_format='jsonl', compression='gzip', max_file_size=64 * 2 ** 20):
+        self.storage_dir = storage_dir
+        self.file_format = file_format
+        self.compression = compression
+        self.max_file_size = max_file_size
+
+        self._sink = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if crawler.settings.get('SINK', 'db') != 'file':
+            raise NotConfigured
+
+        pipeline = cls(
+            storage_dir=utils.get_config_var(crawler, 'SINK_DIR'),
+            file_format=utils.get_config_var(crawler, 'SINK_FORMAT'),
+            compression=utils.get_config_var(crawler, 'SINK_COMPRESSION'),
+            max_file_size=crawler.settings.getint('SINK_MAX_FILE_SIZE')
+        )
+        sinks.check_available(pipeline.file_format, pipeline.compression)
+        return pipeline
+
+    def open_spider(self, spider):
+        self._sink = sinks.RotatingFileSink(
+            directory=os.path.join(self.storage_dir, spider.name),
+            file_format=self.file_format,
+            compression=self.compression,
+            columns=spider.db_model.__table__.columns,
+            max_file_size=self.max_file_size
+        )
+
+    def close_spider(self, spider):
+        self._sink.close()
+
+    @timing.timed('sink')
+    def process_item(self, item, spider):
+        self._sink.write(spider.get_rows([item]))
+        return spider.get_item_label(item)
 
 
 class DrugsPipeline:
-    storage_dir = 'drugs/src/oz/results'
 
-    def __init__(self, pg_url):
+    def __init__(self, pg_url, batch_size=1, flush_interval=0, signal_manager=None, db_options=None,
+                 price_history=False, category_tree=False, save_attempts=3, stats=None):
         self.pg_url = pg_url
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.signal_manager = signal_manager
+        self.db_options = db_options or {}
+        self.price_history = price_history
+        self.category_tree = category_tree
+        self.save_attempts = save_attempts
+        self.stats = stats
+
+        self._db = None
+        self._buffer = []
+        # id(item) -> failed saves of the items put back in the buffer
+        self._failures = {}
+        self._lock = defer.DeferredLock()
+        self._flush_loop = None
 
     @classmethod
     def from_crawler(cls, crawler):
-        pg_url = '{}://{}:{}@{}:{}/{}'.format(
-            *(utils.get_config_var(crawler, var_name) for var_name in (
-                'PG_DRIVER',
-                'PG_USERNAME',
-                'PG_PASSWORD',
-                'PG_HOST',
-                'PG_PORT',
-                'PG_DB_NAME'
-            ))
+        if crawler.settings.get('SINK', 'db') != 'db':
+            raise NotConfigured
+
+        return cls(
+            pg_url=utils.get_db_url(crawler.settings),
+            batch_size=crawler.settings.getint('PIPELINE_BATCH_SIZE', 1),
+            flush_interval=crawler.settings.getfloat('PIPELINE_FLUSH_INTERVAL', 0),
+            signal_manager=crawler.signals,
+            db_options=utils.get_db_options(crawler.settings),
+            price_history=crawler.settings.getbool('PRICE_HISTORY_ENABLED'),
+            category_tree=crawler.settings.getbool('CATEGORY_TREE_ENABLED'),
+            save_attempts=crawler.settings.getint('PIPELINE_SAVE_ATTEMPTS', 3),
+            stats=crawler.stats
         )
-        return cls(pg_url=pg_url)
 
     def open_spider(self, spider):
-        spider.db_session = db.SQLAlchemy(self.pg_url).session
+        self._db = db.SQLAlchemy(self.pg_url, **self.db_options)
+        spider.db_session = self._db.session
+        features = []
+        if self.price_history:
+            spider.price_history = PriceHistory(spider.name)
+            features.append(spider.price_history.create_table)
+        if self.category_tree:
+            spider.category_tree = CategoryTree()
+            features.append(spider.category_tree.create_tables)
+
+        if self.flush_interval:
+            self._flush_loop = task.LoopingCall(self._flush_periodically, spider)
+            self._flush_loop.start(self.flush_interval, now=False)
+
+        if features:
+            return threads.deferToThread(self._create_tables, features)
 
+    def _create_tables(self, features):
+        for create_tables in features:
+            create_tables(self._db.engine)
+
+    @defer.inlineCallbacks
     def close_spider(self, spider):
-        spider.db_session.close()
+        if self._flush_loop is not None and self._flush_loop.running:
+            self._flush_loop.stop()
+
+        try:
+            # failed items are back in the buffer until they run out of attempts
+            while self._buffer:
+                yield self._flush(spider)
+        finally:
+            self._db.close()
 
+    @timing.timed('pipeline')
     def process_item(self, item, spider):
-        to_log = spider.save(item)
-        return to_log
+        self._buffer.append(item)
+        label = spider.get_item_label(item)
+
+        if len(self._buffer) < self.batch_size:
+            return label
+
+        # the item is held until its batch is committed, so a full buffer
+        # stalls the scraper instead of growing without bound
+        return self._flush(spider).addCallback(lambda _: label)
+
+    def _flush(self, spider):
+        return self._lock.run(self._save_buffer, spider)
+
+    def _flush_periodically(self, spider):
+        # an error would stop the loop, and with it every later periodic flush
+        return self._flush(spider).addErrback(
+            lambda failure: spider.logger.error('Periodic flush failed: %s', failure.value)
+        )
+
+    def _save_buffer(self, spider):
+        if not self._buffer:
+            return defer.succeed(None)
+
+        items, self._buffer = self._buffer, []
+        d = threads.deferToThread(self._save, spider, items)
+        d.addCallback(spider.logger.info)
+        d.addCallbacks(
+            lambda _: self._send_batch_saved(spider, items),
+            lambda failure: self._save_failed(failure, spider, items)
+        )
+        return d
+
+    def _save_failed(self, failure, spider, items):
+        # the batch goes back to the front of the buffer for the next flush,
+        # items that failed save_attempts times are dropped one by one
+        spider.logger.error('Saving %d items failed: %s', len(items), failure.value)
+        self._inc_stat('pipeline/failed_saves', spider)
+
+        retried = []
+        for item in items:
+            if (failures := self._failures.get(id(item), 0) + 1) < self.save_attempts:
+                self._failures[id(item)] = failures
+                retried.append(item)
+            else:
+                self._failures.pop(id(item), None)
+                spider.logger.error('Dropped after %d failed saves: %s', failures, spider.get_item_label(item))
+                self._inc_stat('pipeline/dropped_items', spider)
+        self._buffer[:0] = retried
+
+    def _send_batch_saved(self, spider, items):
+        if self._failures:
+            for item in items:
+                self._failures.pop(id(item), None)
+        if self.signal_manager is not None:
+            return self.signal_manager.send_catch_log_deferred(
+                signal=signals.batch_saved,
+                items=items,
+                spider=spider
+            )
+
+    def _inc_stat(self, name, spider):
+        if self.stats is not None:
+            self.stats.inc_value(name, spider=spider)
+
+    @staticmethod
+    def _save(spider, items):
+        try:
+            return spider.save(items)
+        except Exception:
+            spider.db_session.rollback()
+            raise
@@ -11,6 +11,7 @@ BOT_NAME = 'drugs'
 
 SPIDER_MODULES = ['drugs.spiders']
 NEWSPIDER_MODULE = 'drugs.spiders'
+COMMANDS_MODULE = 'drugs.commands'
 
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
@@ -44,28 +45,132 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
+SPIDER_MIDDLEWARES = {
 #    'drugs.middlewares.DrugsSpiderMiddleware': 543,
-#}
+    'drugs.middlewares.DistributedSpiderMiddleware': 100,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
+DOWNLOADER_MIDDLEWARES = {
 #    'drugs.middlewares.DrugsDownloaderMiddleware': 543,
-#}
+    'drugs.middlewares.RecordReplayDownloaderMiddleware': 543,
+    'drugs.middlewares.AdaptiveThrottleDownloaderMiddleware': 600,
+    'drugs.middlewares.SharedRateLimitDownloaderMiddleware': 650,
+}
+
+# 'record' archives every response to REPLAY_ARCHIVE, 'replay' serves them
+# back offline, see `scrapy replay <spider>` for the benchmark run
+REPLAY_MODE = None
+REPLAY_ARCHIVE = 'drugs/src/replay/{spider}.jsonl.gz'
+
+# Per domain delay and concurrency follow latency and error rates, spiders set
+# their start delay with DOWNLOAD_DELAY and their own bounds in custom_settings
+ADAPTIVE_THROTTLE_ENABLED = True
+ADAPTIVE_THROTTLE_WINDOW = 20
+ADAPTIVE_THROTTLE_MIN_DELAY = 0
+ADAPTIVE_THROTTLE_MAX_DELAY = 30
+ADAPTIVE_THROTTLE_MIN_CONCURRENCY = 1
+ADAPTIVE_THROTTLE_MAX_CONCURRENCY = 16
+ADAPTIVE_THROTTLE_MAX_ERROR_RATE = 0.05
+ADAPTIVE_THROTTLE_LATENCY_FACTOR = 2.0
+
+# Per stage call counts, cpu time and p50/p95/p99 latencies in the crawl stats,
+# optionally exported in prometheus text format to a file or an http port on 127.0.0.1
+TIMING_ENABLED = False
+TIMING_PROMETHEUS_FILE = None
+TIMING_PROMETHEUS_PORT = None
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
+EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+    'drugs.extensions.ParsePoolExtension': 500,
+    'drugs.extensions.DbPoolStatsExtension': 510,
+    'drugs.extensions.TimingStatsExtension': 520,
+    'drugs.extensions.CheckpointExtension': 530,
+    'drugs.extensions.MatchingExtension': 540,
+    'drugs.extensions.QueryCacheExtension': 550,
+}
+
+# Number of worker processes transforming response bodies off the reactor,
+# 0 keeps all parsing in the spider callbacks
+PARSE_POOL_SIZE = 0
+
+# Decoder of the oz pages, 'json' or 'orjson' (faster, needs the orjson package)
+JSON_BACKEND = 'json'
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
+   'drugs.pipelines.FingerprintPipeline': 200,
+   'drugs.pipelines.NormalizationPipeline': 250,
    'drugs.pipelines.DrugsPipeline': 300,
+   'drugs.pipelines.FileSinkPipeline': 300,
 }
 
+# Where items end up: 'db' writes through DrugsPipeline, 'file' streams
+# table shaped rows to SINK_DIR/<spider name>/ for a later bulk load.
+# Spiders can override it in custom_settings or with -s SINK=file
+SINK = 'db'
+SINK_DIR = 'drugs/src/results'
+# 'jsonl' or 'parquet' (needs pyarrow)
+SINK_FORMAT = 'jsonl'
+# 'gzip', 'zstd' (needs zstandard for jsonl) or 'none'
+SINK_COMPRESSION = 'gzip'
+SINK_MAX_FILE_SIZE = 64 * 2 ** 20
+
+# Skip products whose content did not change since the last committed crawl. Digests are
+# only recorded for rows a batch wrote, so products oz on_conflict=ignore left as they were
+# are compared again on the next crawl. Needs SINK = 'db'
+FINGERPRINTS_ENABLED = False
+
+# Crawl progress saved as items are committed, `-a resume=1` starts from it,
+# distributed crawls keep theirs in the work queue instead
+CHECKPOINTS_ENABLED = True
+
+# Crawl one spider with any number of workers sharing the work_queue table of the db:
+# the requests every worker yields are leased by DISTRIBUTED_LEASE_SIZE at a time and
+# leased again by any worker when one fails them or dies. `scrapy work_queue <spider> reset`
+# starts a new run. oz pages go in `-a window` chains across all the workers, so raise it
+# with their count. DISTRIBUTED_RATE_LIMIT caps the requests per second to a domain across
+# all the workers, 0 leaves the pace to the download delay of each of them
+DISTRIBUTED_ENABLED = False
+# defaults to host:pid
+DISTRIBUTED_WORKER = None
+DISTRIBUTED_LEASE_SIZE = 8
+DISTRIBUTED_LEASE_TIMEOUT = 300
+DISTRIBUTED_MAX_ATTEMPTS = 3
+DISTRIBUTED_RATE_LIMIT = 0
+
+# Link oz products to asna ones in drug_match as items are committed,
+# `scrapy match` rebuilds the whole table
+MATCHING_ENABLED = False
+MATCHING_MIN_CONFIDENCE = 0.6
+
+# Hand spiders a drugs.utils.queries.DrugQueries read API as spider.drug_queries, its cached
+# lookups are dropped as batches are committed and expire after QUERY_CACHE_TTL seconds anyway,
+# `scrapy query_bench` measures it against DB_URL
+QUERY_CACHE_ENABLED = False
+QUERY_CACHE_SIZE = 10000
+QUERY_CACHE_TTL = 60
+
+# Items are buffered by DrugsPipeline and written off the reactor thread
+# once the buffer holds PIPELINE_BATCH_SIZE items or every
+# PIPELINE_FLUSH_INTERVAL seconds, whichever comes first
+PIPELINE_BATCH_SIZE = 100
+PIPELINE_FLUSH_INTERVAL = 5
+# A batch that fails to save is put back in the buffer and retried with the next flush,
+# its items are dropped with a log entry each once they failed this many times
+PIPELINE_SAVE_ATTEMPTS = 3
+
+# Append price and stock changes to price_history in the same transaction as the items
+PRICE_HISTORY_ENABLED = True
+
+# Keep the category and drug_category tables of the oz catalogue current in the same
+# transaction as the items, `scrapy categories` creates and fills them from oz_drug
+CATEGORY_TREE_ENABLED = True
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 #AUTOTHROTTLE_ENABLED = True
@@ -85,7 +190,11 @@ ITEM_PIPELINES = {
 #HTTPCACHE_EXPIRATION_SECS = 0
 #HTTPCACHE_DIR = 'httpcache'
 #HTTPCACHE_IGNORE_HTTP_CODES = []
-#HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
+# Responses of a spider go to one pack of compressed bodies, each distinct body stored
+# once, `scrapy reparse <spider>` rebuilds the db from the cache without the network
+HTTPCACHE_STORAGE = 'drugs.utils.http_cache.PackCacheStorage'
+# 'zlib', 'zstd' (needs zstandard) or 'none'
+HTTPCACHE_PACK_COMPRESSION = 'zlib'
 
 PG_DRIVER = 'postgresql'
 PG_USERNAME = 'postgres'
@@ -93,3 +202,17 @@ PG_PASSWORD = 'postgres'
 PG_HOST = '192.168.1.11'
 PG_PORT = 6432
 PG_DB_NAME = 'pharmacy'
+
+# One engine is shared per url, size the pool against the pgbouncer
+# pool using the db_pool/* stats reported at the end of a crawl
+PG_POOL_SIZE = 5
+PG_MAX_OVERFLOW = 10
+PG_POOL_PRE_PING = True
+PG_POOL_RECYCLE = 1800
+# milliseconds, 0 disables the timeout. Sent as the options startup parameter,
+# a pgbouncer that does not pass it on needs the role default set instead
+PG_STATEMENT_TIMEOUT = 60000
+
+# Full SQLAlchemy url overriding the PG_* variables above,
+# e.g. 'sqlite:///drugs.sqlite' for a local stand-in
+DB_URL = None
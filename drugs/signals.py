@@ -0,0 +1,6 @@
+# Signals sent by the drugs pipelines, connect to them with
+# crawler.signals.connect(handler, signal=signals.batch_saved)
+
+# sent by DrugsPipeline once a batch of items has been committed,
+# handlers receive the committed items and the spider and may return a Deferred
+batch_saved = object()
@@ -1,14 +1,61 @@
+import posixpath
+import re
+from urllib.parse import urlparse
+
 import scrapy
+from lxml import etree
+from parsel.csstranslator import HTMLTranslator
 
 from drugs.db import models
-from drugs.utils import utils
+from drugs.items import AsnaDrugItem
+from drugs.utils import matching, timing, utils
 from drugs.utils.base_transformer import Transformer
+from drugs.utils.url_index import UrlIndex
 
 SRC_URL_MASKED = '68747470733a2f2f7777772e61736e612e72752f'
+# the start page menu that holds the pharma groups is found by one of its entries
+SRC_GROUP_MENU_XPATH = "//a[text() = 'Аллергия']/../../..//a"
+BLOCK_CLASSES = (
+    'product-title',
+    'item-recipe-line',
+    'js-photos-item-zoom',
+    'js-main-item-photo',
+    'infos',
+    'product-information__info__content__block',
+)
+CLASS_SEPARATOR_RE = re.compile(r'[ \t\r\n]+')
+
+
+def _compile_css(css):
+    return etree.XPath(HTMLTranslator().css_to_xpath(css), smart_strings=False)
+
+
+# one document scan for every class the transformer needs,
+# the exact class token match is done in python on the few candidates
+BLOCKS_XPATH = etree.XPath('descendant-or-self::*[@class and ({})]'.format(
+    ' or '.join("contains(@class, '{}')".format(class_name) for class_name in BLOCK_CLASSES)
+))
+TITLE_H1_XPATH = etree.XPath('descendant::h1')
+TEXT_CHILD_XPATH = etree.XPath('text()', smart_strings=False)
+INFO_LI_XPATH = _compile_css('li')
+INFO_LABEL_XPATH = _compile_css('.param::text')
+INFO_TEXT_XPATH = _compile_css('.param-text::text')
+INFO_LINK_TEXT_XPATH = _compile_css('.param-text a::text')
+INSTRUCTION_TITLE_XPATH = _compile_css('h3::text')
+INSTRUCTION_TAGS_XPATH = _compile_css('p, ul')
+INSTRUCTION_LI_XPATH = _compile_css('li')
+TEXT_XPATH = _compile_css('::text')
+PRICE_XPATH = _compile_css('link[itemprop=price]::attr(content)')
 
 
 class AsnaTransformer(Transformer):
 
+    def __init__(self, item):
+        super(AsnaTransformer, self).__init__(item)
+        self.root = item.selector.root
+        self.blocks = self._collect_blocks(self.root)
+
+    @timing.timed('transform')
     def get_transformed_item(self):
         return {
             **self.title(),
@@ -19,37 +66,46 @@ class AsnaTransformer(Transformer):
             **self.instructions()
         }
 
+    @timing.timed('transform.title')
     def title(self):
-        return {'title': self.item.css('.product-title h1::text').get().strip()}
+        title = next((
+            text
+            for block in self.blocks['product-title']
+            for h1 in TITLE_H1_XPATH(block)
+            for text in TEXT_CHILD_XPATH(h1)
+        ), None)
+        return {'title': title.strip()}
 
+    @timing.timed('transform.info')
     def info(self):
         def param_text(li):
-            result = li.css('.param-text::text').get().strip()
+            result = self._first(INFO_TEXT_XPATH, li).strip()
             if not result:
-                result = li.css('.param-text a::text').get().strip()
+                result = self._first(INFO_LINK_TEXT_XPATH, li).strip()
             return result
 
-        if not (info_list := self.item.css('.infos')):
+        if not (info_list := self.blocks['infos']):
             return {'info': None}
 
         return {
             'info': [
                 {
-                    'label': li.css('.param::text').get().strip(),
+                    'label': self._first(INFO_LABEL_XPATH, li).strip(),
                     'value': param_text(li)
-                } for li in info_list[0].css('li')
+                } for li in INFO_LI_XPATH(info_list[0])
             ]
         }
 
+    @timing.timed('transform.instructions')
     def instructions(self):
         def extract_tag_value(tag):
-            if tag.root.tag == 'p':
-                return tag.css('::text').get(default='').strip()
+            if tag.tag == 'p':
+                return self._first(TEXT_XPATH, tag, default='').strip()
 
             return '\t{}'.format('\n\t'.join(
                 text.strip().replace('\n', ' ')
-                for li in tag.css('li')
-                if (text := li.css('::text').get()) is not None
+                for li in INSTRUCTION_LI_XPATH(tag)
+                if (text := self._first(TEXT_XPATH, li)) is not None
             ))
 
         return {
@@ -58,73 +114,308 @@ class AsnaTransformer(Transformer):
                     'label': title.strip(),
                     'value': '\n'.join(filter(
                         lambda x: x,
-                        map(extract_tag_value, div.css('p, ul'))
+                        map(extract_tag_value, INSTRUCTION_TAGS_XPATH(div))
                     ))
-                } for div in self.item.css('div.product-information__info__content__block')
-                if (title := div.css('h3::text').get()) is not None
+                } for div in self.blocks['product-information__info__content__block']
+                if div.tag == 'div' and (title := self._first(INSTRUCTION_TITLE_XPATH, div)) is not None
             ]
         }
 
+    @timing.timed('transform.price')
     def price(self):
-        price = self.item.css('link[itemprop=price]::attr(content)').get()
+        price = self._first(PRICE_XPATH, self.root)
         return {'price': float(price.strip()) if price else None}
 
+    @timing.timed('transform.images')
     def images(self):
-        def extract_images(img):
+        def extract_images(attrib):
             return {
                 'size_{}'.format(index): img_url
                 for index, attr_name
                 in enumerate(('src', 'data-main1', 'data-main2'), start=1)
-                if (img_url := img.attrib.get(attr_name)) is not None
+                if (img_url := attrib.get(attr_name)) is not None
             }
 
-        images = list(map(
-            extract_images,
-            self.item.css('.js-photos-item-zoom')
-        ))
+        images = [extract_images(img.attrib) for img in self.blocks['js-photos-item-zoom']]
 
         if not images:
-            images = [extract_images(self.item.css('.js-main-item-photo'))]
+            main_images = self.blocks['js-main-item-photo']
+            images = [extract_images(main_images[0].attrib if main_images else {})]
 
         return {'images': images}
 
+    @timing.timed('transform.is_receipt')
     def is_receipt(self):
-        return {'is_receipt': bool(self.item.css('.item-recipe-line'))}
+        return {'is_receipt': bool(self.blocks['item-recipe-line'])}
+
+    @staticmethod
+    @timing.timed('transform.blocks')
+    def _collect_blocks(root):
+        blocks = {class_name: [] for class_name in BLOCK_CLASSES}
+        for element in BLOCKS_XPATH(root):
+            for class_name in blocks.keys() & set(CLASS_SEPARATOR_RE.split(element.get('class'))):
+                blocks[class_name].append(element)
+        return blocks
+
+    @staticmethod
+    def _first(xpath, node, default=None):
+        result = xpath(node)
+        return result[0] if result else default
 
 
 class AsnaSpider(scrapy.Spider):
     name = "asna"
     transformer = AsnaTransformer
+    db_model = models.AsnaDrug
+    # rows are appended, so every saved item is written
+    skipped_keys = frozenset()
 
     start_urls = [utils.decode(SRC_URL_MASKED, 'hex')]
 
-    download_delay = 2
+    custom_settings = {
+        'DOWNLOAD_DELAY': 2,
+        # the adaptive throttle may speed asna up to one request a second over two connections
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 2,
+        'ADAPTIVE_THROTTLE_MIN_DELAY': 1,
+        'ADAPTIVE_THROTTLE_MAX_DELAY': 60,
+        'ADAPTIVE_THROTTLE_MAX_CONCURRENCY': 2
+    }
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, full_catalog='0', resume='0', *args, **kwargs):
         super(AsnaSpider, self).__init__(*args, **kwargs)
+        self.full_catalog = full_catalog not in ('0', 'false', 'False', False)
+        self.resume = resume not in ('0', 'false', 'False', False)
 
         self.db_session = None
+        self.fingerprints = None
+        self.parse_pool = None
+        self.price_history = None
+
+        self._done_groups = set()
+        self._done_pages = set()
+        # group url -> its pages not done yet, page url -> [drugs not done yet, group url],
+        # drug url -> the page it was first linked from
+        self._group_pages = {}
+        self._page_drugs = {}
+        self._drug_pages = {}
+        self._checkpoint_changed = False
+
+        # each product is downloaded once per run however many groups link it
+        self.url_index = UrlIndex()
+        self._catalog_root = None
 
     def parse(self, response, **kwargs):
-        pharma_group_links = response.xpath("//a[text() = 'Аллергия']/../../..//a")
-        yield from response.follow_all(pharma_group_links, self.parse_group)
+        group_urls = [response.urljoin(link) for link in response.xpath(SRC_GROUP_MENU_XPATH + '/@href').getall()]
+        if self.full_catalog:
+            self._catalog_root = self._get_catalog_root(group_urls)
+            group_urls.extend(self._get_catalog_urls(response))
+        yield from self._get_group_requests(group_urls)
+
+    def parse_group(self, response, group):
+        # group is the requested url, like page_url of parse_page, a redirect must not change it
+        if self.full_catalog:
+            yield from self._get_group_requests(self._get_catalog_urls(response))
 
-    def parse_group(self, response):
-        group_page_links = response.css('ul.pagination__pages a')
-        yield from self.parse_page(response)
-        yield from response.follow_all(group_page_links, self.parse_page)
+        page_urls = {
+            response.urljoin(link) for link in response.css('ul.pagination__pages a::attr(href)').getall()
+        }
+        page_urls.discard(group)
+
+        if not (pages := ({group} | page_urls) - self._done_pages):
+            self._complete_group(group)
+            return
+        self._group_pages[group] = pages
+
+        yield from self.parse_page(response, group, group)
+        for page_url in page_urls & pages:
+            yield scrapy.Request(page_url, self.parse_page, cb_kwargs={'group': group, 'page_url': page_url})
+
+    @timing.timed('parse')
+    def parse_page(self, response, group, page_url):
+        # page_url is the requested url, redirects must not change how the page is checkpointed
+        if page_url in self._done_pages:
+            return
 
-    def parse_page(self, response):
         drug_links = response.css('.product__information meta::attr(content)').getall()
-        yield from response.follow_all(drug_links, self.parse_drug)
+        drug_urls = [
+            drug_url
+            for drug_link in drug_links
+            if self.url_index.add(drug_url := response.urljoin(drug_link))
+        ]
+        self._page_drugs[page_url] = [len(drug_urls), group]
+        if not drug_urls:
+            self._complete_page(page_url)
+
+        for drug_url in drug_urls:
+            self._drug_pages[drug_url] = page_url
+            yield scrapy.Request(
+                drug_url,
+                self.parse_drug,
+                errback=self.parse_drug_error,
+                headers=self._get_conditional_headers(drug_url),
+                meta={'handle_httpstatus_list': [304], 'drug_url': drug_url},
+                dont_filter=True
+            )
+
+    @timing.timed('parse')
+    async def parse_drug(self, response):
+        if response.status == 304:
+            self.crawler.stats.inc_value('fingerprints/not_modified', spider=self)
+            self._complete_drug(response.meta['drug_url'])
+            return None
+
+        if response.url != (drug_url := response.meta['drug_url']) and drug_url in self._drug_pages:
+            # saved items are keyed by their final url
+            self._drug_pages[response.url] = self._drug_pages.pop(drug_url)
 
-    def parse_drug(self, response):
-        item = self.transformer(response).get_transformed_item()
+        if self.fingerprints is not None:
+            self.fingerprints.set_validators(
+                response.url,
+                *(self._get_header(response, name) for name in ('ETag', 'Last-Modified'))
+            )
+
+        if self.parse_pool is None:
+            item = self.transformer(response).get_transformed_item()
+        else:
+            item = await self.parse_pool.submit(
+                self._transform_body,
+                response.url,
+                response.body,
+                response.encoding
+            )
+        return AsnaDrugItem(url=response.url, **item)
+
+    def parse_drug_error(self, failure):
+        # a drug given up on must not keep its page and group out of the checkpoint
+        self.logger.error('drug: %s\t%s', failure.request.meta['drug_url'], repr(failure.value))
+        self._complete_drug(failure.request.meta['drug_url'])
+
+    @staticmethod
+    def normalize(item):
         return item
 
-    def save(self, item):
-        drug = models.AsnaDrug(**item)
-        self.db_session.add(drug)
+    @timing.timed('save')
+    def save(self, items):
+        self.db_session.execute(self.db_model.__table__.insert(), self.get_rows(items))
+        if self.price_history is not None:
+            # asna pages carry no stock flag
+            self.price_history.record(self.db_session, {item.url: (item.price, None) for item in items})
         self.db_session.commit()
 
-        return drug.title
+        return 'added: {}'.format(len(items))
+
+    @staticmethod
+    def get_rows(items):
+        return [item.to_row() for item in items]
+
+    @staticmethod
+    def has_errors(response):
+        return False
+
+    @staticmethod
+    def get_item_label(item):
+        return item.title
+
+    def get_checkpoint(self):
+        return {'groups': sorted(self._done_groups), 'pages': sorted(self._done_pages)}
+
+    def restore_checkpoint(self, checkpoint):
+        self._done_groups = set(checkpoint['groups'])
+        self._done_pages = set(checkpoint['pages'])
+        self.logger.info('Resuming with %d groups and %d pages done', len(self._done_groups), len(self._done_pages))
+
+    def advance_checkpoint(self, items):
+        for item in items:
+            self._complete_drug(item.url)
+
+        changed, self._checkpoint_changed = self._checkpoint_changed, False
+        return changed
+
+    @staticmethod
+    def get_fingerprint_entries(item):
+        return [(item.url, item.to_row())]
+
+    @staticmethod
+    def get_match_entries(item):
+        return [(item.url, matching.get_asna_product(item.title, item.info))]
+
+    @staticmethod
+    def filter_fingerprinted(item, kept):
+        return item if kept else None
+
+    @staticmethod
+    def _transform_body(url, body, encoding):
+        response = scrapy.http.HtmlResponse(url, body=body, encoding=encoding)
+        return AsnaSpider.transformer(response).get_transformed_item()
+
+    def closed(self, reason):
+        self.crawler.stats.set_value('url_index/urls', len(self.url_index), spider=self)
+        self.crawler.stats.set_value('url_index/hits', self.url_index.hits, spider=self)
+        self.crawler.stats.set_value('url_index/hit_rate', self.url_index.hit_rate, spider=self)
+        self.crawler.stats.set_value('url_index/memory', self.url_index.memory, spider=self)
+
+    def _get_group_requests(self, group_urls):
+        for group_url in group_urls:
+            if group_url not in self._done_groups:
+                yield scrapy.Request(group_url, self.parse_group, cb_kwargs={'group': group_url})
+
+    def _get_catalog_root(self, group_urls):
+        # the deepest path shared by the menu groups, following anything above it would crawl the whole site
+        if group_urls and (root := posixpath.commonpath([urlparse(url).path for url in group_urls])) != '/':
+            return root.rstrip('/') + '/'
+        self.logger.warning('No catalog root shared by the menu groups, crawling the menu groups only')
+        return None
+
+    def _get_catalog_urls(self, response):
+        # groups and subgroups are the query-less catalog paths, pagination and products are not
+        if self._catalog_root is None:
+            return []
+
+        drug_urls = {
+            response.urljoin(drug_link)
+            for drug_link in response.css('.product__information meta::attr(content)').getall()
+        }
+        return [
+            url
+            for url in (response.urljoin(link) for link in response.xpath('//a/@href').getall())
+            if url not in drug_urls
+            and not (parsed := urlparse(url)).query
+            and parsed.path.startswith(self._catalog_root)
+            and parsed.path != self._catalog_root
+        ]
+
+    def _complete_drug(self, drug_url):
+        if (page_url := self._drug_pages.pop(drug_url, None)) is None:
+            return
+
+        page_drugs = self._page_drugs[page_url]
+        page_drugs[0] -= 1
+        if not page_drugs[0]:
+            self._complete_page(page_url)
+
+    def _complete_page(self, page_url):
+        _, group = self._page_drugs.pop(page_url)
+        self._done_pages.add(page_url)
+        self._checkpoint_changed = True
+
+        # groups parsed by another distributed worker are not tracked here
+        if (group_pages := self._group_pages.get(group)) is None:
+            return
+        group_pages.discard(page_url)
+        if not group_pages:
+            del self._group_pages[group]
+            self._complete_group(group)
+
+    def _complete_group(self, group):
+        self._done_groups.add(group)
+        self._checkpoint_changed = True
+
+    def _get_conditional_headers(self, url):
+        if self.fingerprints is None:
+            return {}
+        return self.fingerprints.get_conditional_headers(url)
+
+    @staticmethod
+    def _get_header(response, name):
+        value = response.headers.get(name)
+        return value.decode('latin-1') if value is not None else None
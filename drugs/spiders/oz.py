@@ -1,74 +1,97 @@
 import json
-from functools import reduce
+import os
+import re
+from operator import itemgetter
 
 import scrapy
-from scrapy.exceptions import CloseSpider
+from sqlalchemy import bindparam, cast, literal_column, select
+from sqlalchemy.dialects import postgresql
 
-from drugs.db import models
-from drugs.utils import utils
+from drugs.db import db, models
+from drugs.items import OzDrugItem, OzPageItem
+from drugs.utils import categories, json_decoding, matching, timing, utils
 from drugs.utils.base_transformer import Transformer
 
-REQUEST_QUERY_FP = 'drugs/src/oz/oz.query'
+REQUEST_QUERY_DIR = 'drugs/src/oz'
+REQUEST_QUERY_FILES = ('oz.query', 'oz.query.original')
 SRC_URL_MASKED = '68747470733a2f2f7777772e7269676c612e72752f6772617068716c'
 SRC_START_PAGE_NUMBER = 1
 SRC_APPROXIMATE_PAGE_LIMIT = 700
+ON_CONFLICT_POLICIES = ('ignore', 'update')
+PAGE_ALIAS = 'productDetail'
+BATCHED_PAGE_ALIAS = 'page{}'
+NORMALIZED_COLUMNS = ('price', 'is_in_stock', 'manufacturer_id', 'manufacturer', 'categories')
 
 
 class OzTransformer(Transformer):
+    _extractors = None
+
     def get_transformed_item(self):
-        return self._oz_extract_data(
-            self.item,
-            *map(self._get_param, ('id', 'name', 'sku', 'mnn_ru', 'promo_label')),
-            *map(self._get_bool_param, (
-                ('is_active', 'active'),
-                ('is_receipt', 'rec_need'),
-                ('is_delivery', 'delivery'),
-                ('is_in_stock', 'is_in_stock'),
-                ('is_thermolabile', 'thermolabile'),
-            )),
-            *map(self._get_deeper_param, (
-                ('manufacturer_id', ('manufacturer_id', 'option_id')),
-                ('manufacturer', ('manufacturer_id', 'label')),
-                ('manufacturer_ru', ('manufacturer_ru', 'label')),
-                ('price', ('price', 'regularPrice', 'amount', 'value')),
-                ('images', ('media_gallery', 0)),
-                ('original', ('orig_preparat', 'label')),
-            )),
-            ('forms_url', lambda src: src['lekforms_url'], self._oz_extract_url),
-            ('categories', lambda src: src['breadcrumbs'], self._oz_edit_categories),
-            ('spec_attributes', lambda src: src['specification_set_attributes'], self._oz_extract_attrs),
-            ('desc_attributes', lambda src: src['description_set_attributes'], self._oz_extract_attrs),
-        )
+        return self._oz_extract_data(self.item, *self.get_extractors())
+
+    @classmethod
+    def transform(cls, item, extractors):
+        return cls._oz_extract_data(item, *extractors)
+
+    @classmethod
+    def get_extractors(cls, keys=None):
+        # every field, or only the keys given
+        if keys is not None:
+            return tuple(extractor for extractor in cls.get_extractors() if extractor[0] in keys)
+        if cls._extractors is None:
+            cls._extractors = (
+                *map(cls._get_param, ('id', 'name', 'sku', 'mnn_ru', 'promo_label')),
+                *map(cls._get_bool_param, (
+                    ('is_active', 'active'),
+                    ('is_receipt', 'rec_need'),
+                    ('is_delivery', 'delivery'),
+                    ('is_in_stock', 'is_in_stock'),
+                    ('is_thermolabile', 'thermolabile'),
+                )),
+                *map(cls._get_deeper_param, (
+                    ('manufacturer_id', ('manufacturer_id', 'option_id')),
+                    ('manufacturer', ('manufacturer_id', 'label')),
+                    ('manufacturer_ru', ('manufacturer_ru', 'label')),
+                    ('price', ('price', 'regularPrice', 'amount', 'value')),
+                    ('images', ('media_gallery', 0)),
+                    ('original', ('orig_preparat', 'label')),
+                )),
+                ('forms_url', itemgetter('lekforms_url'), cls._oz_extract_url),
+                ('categories', itemgetter('breadcrumbs'), cls._oz_edit_categories),
+                ('spec_attributes', itemgetter('specification_set_attributes'), cls._oz_extract_attrs),
+                ('desc_attributes', itemgetter('description_set_attributes'), cls._oz_extract_attrs),
+            )
+        return cls._extractors
 
     @staticmethod
     def _oz_extract_data(src_dict, *update_parts_args):
         return {
-            key: (update_func or (lambda x: x))(extract_func(src_dict))
+            key: extract_func(src_dict) if update_func is None else update_func(extract_func(src_dict))
             for key, extract_func, update_func in update_parts_args
         }
 
     @staticmethod
     def _get_param(key):
-        return key, lambda x: x[key], None
+        return key, itemgetter(key), None
 
     @staticmethod
     def _get_deeper_param(args):
         key, path = args
 
-        def get_deeper(x, x_keys):
-            if not x_keys:
-                return x
-            if x in (None, (), [], {}):
-                return None
-            return get_deeper(x[x_keys[0]], x_keys[1:])
+        def get_deeper(x):
+            for x_key in path:
+                if x in (None, (), [], {}):
+                    return None
+                x = x[x_key]
+            return x
 
-        return key, lambda x: get_deeper(x, path), None
+        return key, get_deeper, None
 
     @staticmethod
     def _get_bool_param(args):
         res_key, src_key = args
 
-        return res_key, lambda x: x[src_key], lambda x: x == 'true' or bool(int(x))
+        return res_key, itemgetter(src_key), lambda x: x == 'true' or bool(int(x))
 
     @staticmethod
     def _oz_extract_url(extracted):
@@ -88,19 +111,7 @@ class OzTransformer(Transformer):
 
     @staticmethod
     def _oz_edit_categories(extracted):
-        def extract_category(category_struct):
-            if (category_id := category_struct.get('id')) in ('2669', '2672', '2671'):
-                return None
-            return category_id, category_struct.get('name')
-
-        def add_categories(dict_to_upd: dict, categories_struct: dict) -> dict:
-            dict_to_upd.update(filter(
-                lambda x: x is not None,
-                map(extract_category, categories_struct.get('path'))
-            ))
-            return dict_to_upd
-
-        return reduce(add_categories, json.loads(extracted), dict())
+        return {category_id: name for path in categories.get_paths(extracted) for category_id, name in path}
 
 
 class OzSpider(scrapy.Spider):
@@ -108,15 +119,61 @@ class OzSpider(scrapy.Spider):
     transformer = OzTransformer
     db_model = models.OzDrug
 
-    download_delay = 0.5
-
-    def __init__(self, page_size=20, *args, **kwargs):
+    custom_settings = {
+        'PIPELINE_BATCH_SIZE': 10,
+        # start delay, the adaptive throttle moves it and the slot concurrency from there
+        'DOWNLOAD_DELAY': 0.5,
+        'ADAPTIVE_THROTTLE_MIN_DELAY': 0.1,
+        'ADAPTIVE_THROTTLE_MAX_DELAY': 30,
+        # more in flight requests than the page window would never be used
+        'ADAPTIVE_THROTTLE_MAX_CONCURRENCY': 8
+    }
+
+    def __init__(self, page_size=20, window=8, page_limit=None, on_conflict='ignore',
+                 query_file=REQUEST_QUERY_FILES[0], minify_query='1', resume='0', pages_per_request=1,
+                 url=None, *args, **kwargs):
         super(OzSpider, self).__init__(*args, **kwargs)
         self.page_size = int(page_size)
-
-        self._url = None
+        self.window = int(window)
+        # pages fetched by one request through aliased selections of the page query
+        self.pages_per_request = int(pages_per_request)
+        if self.pages_per_request < 1:
+            raise ValueError('pages_per_request must be positive')
+
+        if query_file not in REQUEST_QUERY_FILES:
+            raise ValueError('query_file must be one of {}'.format(REQUEST_QUERY_FILES))
+        self.query_fp = os.path.join(REQUEST_QUERY_DIR, query_file)
+        self.minify_query = minify_query not in ('0', 'false', 'False', False)
+        self.resume = resume not in ('0', 'false', 'False', False)
+
+        if on_conflict not in ON_CONFLICT_POLICIES:
+            raise ValueError('on_conflict must be one of {}'.format(ON_CONFLICT_POLICIES))
+        self.on_conflict = on_conflict
+
+        self._next_page = SRC_START_PAGE_NUMBER
+        self._last_page = int(page_limit) if page_limit else None
+        self._saved_page = SRC_START_PAGE_NUMBER - 1
+        self._saved_pages = set()
+
+        # another graphql endpoint serving the same api, a mirror or a local mock
+        self._url = url
         self._query_template = None
+        self._body_templates = {}
         self.db_session = None
+        self.fingerprints = None
+        self.parse_pool = None
+        self.price_history = None
+        self.category_tree = None
+        self.json_backend = 'json'
+        # fingerprint keys of the last saved batch whose rows were left as they were
+        self.skipped_keys = frozenset()
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(OzSpider, cls).from_crawler(crawler, *args, **kwargs)
+        spider.json_backend = crawler.settings.get('JSON_BACKEND')
+        json_decoding.check_available(spider.json_backend)
+        return spider
 
     @property
     def url(self):
@@ -126,70 +183,317 @@ class OzSpider(scrapy.Spider):
 
     @property
     def query(self):
-        with open(REQUEST_QUERY_FP, 'r', encoding='utf-8') as file:
-            self._query_template = file.read()
+        if self._query_template is None:
+            with open(self.query_fp, 'r', encoding='utf-8') as file:
+                self._query_template = file.read()
+            if self.minify_query:
+                self._query_template = self._minify(self._query_template)
         return self._query_template
 
     def start_requests(self):
-        yield self._get_request(SRC_START_PAGE_NUMBER)
+        yield from self._get_next_requests(self.window)
+
+    @timing.timed('parse')
+    async def parse(self, response, page, page_count=1, is_fallback=False):
+        pages = range(page, page + page_count)
+        aliases = self._get_aliases(page_count)
+        # (batch, products listed) of each page, a page whose products
+        # all failed to normalize is not the last one
+        if self.parse_pool is None:
+            batches = [
+                (None, 0) if items is None else (OzPageItem(page=page_num, items=items), len(items))
+                for page_num, items in zip(pages, self._load_items(response.body, aliases, self.json_backend))
+            ]
+        else:
+            pages_drugs = await self.parse_pool.submit(self._load_drugs, response.body, aliases, self.json_backend)
+            batches = [
+                (None, 0) if loaded is None else (self._get_page(page_num, *loaded), sum(map(len, loaded)))
+                for page_num, loaded in zip(pages, pages_drugs)
+            ]
+
+        result = []
+        for page_num, (batch, size) in zip(pages, batches):
+            if batch is None:
+                result.extend(self._get_failed_page_requests(page_num, page_count))
+            elif not size:
+                self._set_last_page(page_num - 1)
+            else:
+                result.append(batch)
+        # pages refetched on their own do not take a place in the request window
+        if not is_fallback:
+            result.extend(self._get_successor_requests(page))
+        return result
+
+    @staticmethod
+    def has_errors(response):
+        # graphql reports failures with a 200 and a top level errors list
+        return b'"errors":' in response.body
+
+    def parse_error(self, failure):
+        page, page_count, is_fallback = map(failure.request.cb_kwargs.get, ('page', 'page_count', 'is_fallback'))
+        self.logger.error('page: %s\t%s', self._get_pages_label(page, page_count), repr(failure.value))
+        if page_count > 1:
+            for page_num in range(page, page + page_count):
+                yield from self._get_failed_page_requests(page_num, page_count)
+        if not is_fallback:
+            yield from self._get_successor_requests(page)
+
+    def normalize(self, batch):
+        if batch.drugs is None:
+            batch = self._get_page(batch.page, *self._get_drugs(batch.items))
+        return batch
+
+    @timing.timed('save')
+    def save(self, batches):
+        rows = self._get_rows(batches)
+
+        if not rows:
+            added, updated = [], []
+        elif self.db_session.get_bind().dialect.name == 'postgresql':
+            added, updated = self._upsert_rows(rows)
+        else:
+            added, updated = self._merge_rows(rows)
+        if self.price_history is not None:
+            # recorded for skipped rows too, the history is what on_conflict=ignore would lose
+            self.price_history.record(
+                self.db_session,
+                {str(id_): (row['price'], row['is_in_stock']) for id_, row in rows.items()}
+            )
+        # on_conflict=ignore keeps existing rows whatever the items hold, with update
+        # the rows not written already hold the same data
+        if self.on_conflict == 'ignore':
+            self.skipped_keys = frozenset(str(id_) for id_ in rows.keys() - {*added, *updated})
+        if self.category_tree is not None and (written := added + updated):
+            # rows on_conflict=ignore skipped keep the links of the data that is stored
+            self.category_tree.update(self.db_session, {id_: rows[id_]['data']['breadcrumbs'] for id_ in written})
+        self.db_session.commit()
+
+        return self._get_save_result([batch.page for batch in batches], len(added), len(updated), len(rows))
+
+    def get_rows(self, batches):
+        return list(self._get_rows(batches).values())
+
+    @staticmethod
+    def get_item_label(batch):
+        return 'page: {}'.format(batch.page)
+
+    def get_checkpoint(self):
+        return {'page': self._saved_page}
+
+    def restore_checkpoint(self, checkpoint):
+        self._saved_page = checkpoint['page']
+        self._next_page = self._saved_page + 1
+        self.logger.info('Resuming after page %d', self._saved_page)
+
+    def advance_checkpoint(self, batches):
+        # pages within the request window are saved out of order, so only
+        # the highest page with every page before it saved is kept
+        saved_page = self._saved_page
+        self._saved_pages.update(batch.page for batch in batches)
+        while self._saved_page + 1 in self._saved_pages:
+            self._saved_page += 1
+            self._saved_pages.remove(self._saved_page)
+        return self._saved_page != saved_page
+
+    def get_fingerprint_entries(self, batch):
+        return [(str(self._get_item_id(item)), item) for item in batch.get_raw_items()]
 
-    def parse(self, response, **kwargs):
-        rsp_json = response.json()
-        batch = rsp_json['data']['productDetail']
-        self._close_spider_if_empty(batch['items'])
-        batch.update(response.cb_kwargs)
-        yield batch
-        yield self._get_request(response.cb_kwargs['page'] + 1)
+    @staticmethod
+    def get_match_entries(batch):
+        return [(drug.id, matching.get_oz_product(drug.data, drug.manufacturer)) for drug in batch.drugs]
 
-    def save(self, batch):
-        items = batch['items']
-        ignore_ids = self._get_ignore_ids(items)
-        self._add_items(items, ignore_ids)
+    @staticmethod
+    def filter_fingerprinted(batch, kept):
+        if not kept:
+            return None
 
-        return self._get_save_result(batch['page'], ignore_ids, len(items))
+        if batch.drugs is None:
+            return OzPageItem(page=batch.page, items=kept)
+        kept_ids = set(map(id, kept))
+        return OzPageItem(page=batch.page, drugs=[drug for drug in batch.drugs if id(drug.data) in kept_ids])
 
-    def _get_request(self, page_num):
+    def _get_request(self, page_num, page_count=1, is_fallback=False):
         return scrapy.http.JsonRequest(
             url=self.url,
-            data={
-                'query': self.query,
-                'variables': {
-                    'page': page_num,
-                    'size': self.page_size
-                }
-            },
-            cb_kwargs={'page': page_num},
-            callback=self.parse
+            body=self._get_body_template(page_count) % tuple(range(page_num, page_num + page_count)),
+            method='POST',
+            cb_kwargs={'page': page_num, 'page_count': page_count, 'is_fallback': is_fallback},
+            callback=self.parse,
+            errback=self.parse_error
+        )
+
+    def _get_failed_page_requests(self, page_num, page_count):
+        # a page failing inside a batched request is refetched alone, a single page is given up
+        if page_count == 1:
+            self.logger.error('page: %s\tno items in the response', page_num)
+            return
+        self.crawler.stats.inc_value('oz/fallback_pages')
+        yield self._get_request(page_num, is_fallback=True)
+
+    def _get_body_template(self, page_count):
+        if (template := self._body_templates.get(page_count)) is None:
+            # a single page keeps the plain query so its request body does not change
+            if page_count == 1:
+                query, variables = self.query, ', "page": %d'
+            else:
+                query = self._get_batched_query(self.query, page_count)
+                variables = ''.join(', "page{}": %d'.format(i) for i in range(page_count))
+            head = json.dumps({'query': query, 'variables': {'size': self.page_size}})
+            template = self._body_templates[page_count] = (head[:-2].replace('%', '%%') + variables + '}}').encode()
+        return template
+
+    @staticmethod
+    def _get_batched_query(query, page_count):
+        # the page selection is repeated under one alias and one page variable per page
+        head, selection = query.split('{', 1)
+        selection = selection[:selection.rindex('}')]
+        variables = ', '.join('$page{}: Int'.format(i) for i in range(page_count))
+        return '{}{{{}}}'.format(
+            # minified queries drop the space after the colon
+            re.sub(r'\$page\s*:\s*Int\b', variables, head),
+            ' '.join(
+                re.sub(r'\$page\b', '$page{}'.format(i), selection.replace(PAGE_ALIAS + ':', alias + ':', 1))
+                for i, alias in enumerate(OzSpider._get_aliases(page_count))
+            )
         )
 
     @staticmethod
-    def _close_spider_if_empty(items):
-        if not items:
-            raise CloseSpider('Empty items')
+    def _get_aliases(page_count):
+        if page_count == 1:
+            return PAGE_ALIAS,
+        return tuple(BATCHED_PAGE_ALIAS.format(i) for i in range(page_count))
+
+    @staticmethod
+    def _get_pages_label(page, page_count):
+        return page if page_count == 1 else '{}-{}'.format(page, page + page_count - 1)
 
-    def _get_ignore_ids(self, items):
-        items_ids = tuple(self._get_item_id(i) for i in items)
-        already_in_filter = self.db_model.id.in_(items_ids)
-        already_in_drugs = self.db_session.query(self.db_model).filter(already_in_filter).all()
-        return tuple(oz_drug.id for oz_drug in already_in_drugs)
+    def _get_page(self, page_num, drugs, errors):
+        for item_id, error in errors:
+            self.logger.error('page: %s\tproduct %s left out: %s', page_num, item_id, error)
+            self.crawler.stats.inc_value('oz/invalid_products', spider=self)
+        return OzPageItem(page=page_num, drugs=drugs)
 
-    def _add_items(self, items, ignore_ids):
-        self.db_session.add_all(
-            self.db_model(id=id_, data=item)
-            for item in items
-            if (id_ := self._get_item_id(item)) not in ignore_ids
-        )
-        self.db_session.commit()
+    @staticmethod
+    @timing.timed('transform')
+    def _get_drugs(items):
+        # only the stored columns are extracted, a product failing that is left out
+        # with its error and the rest of its page is kept
+        extractors = OzSpider.transformer.get_extractors(NORMALIZED_COLUMNS)
+        drugs, errors = [], []
+        for item in items:
+            try:
+                drugs.append(OzDrugItem(
+                    id=OzSpider._get_item_id(item),
+                    data=item,
+                    **OzSpider.transformer.transform(item, extractors)
+                ))
+            except Exception as error:
+                errors.append((item.get('id') if isinstance(item, dict) else None, repr(error)))
+        return drugs, errors
 
     @staticmethod
-    def _get_save_result(page_num, ignore_ids, items_length):
-        return 'page: {}/~{}\tadded: {}/{}'.format(
-            page_num,
+    def _load_items(body, aliases, json_backend):
+        # a page the server failed to resolve comes back null next to an errors entry
+        data = json_decoding.load(body, json_backend).get('data') or {}
+        return [(data.get(alias) or {}).get('items') for alias in aliases]
+
+    @staticmethod
+    def _load_drugs(body, aliases, json_backend):
+        return [
+            None if items is None else OzSpider._get_drugs(items)
+            for items in OzSpider._load_items(body, aliases, json_backend)
+        ]
+
+    def _get_next_requests(self, count):
+        for _ in range(count):
+            if self._last_page is not None and self._next_page > self._last_page:
+                return
+            page_count = self._get_page_count(self._next_page)
+            yield self._get_request(self._next_page, page_count)
+            self._next_page += page_count
+
+    def _get_successor_requests(self, page_num):
+        # each request of the window is followed by the one a window further, so the
+        # window runs as chains that need no page counter shared between distributed workers
+        page_num += self.window * self.pages_per_request
+        if self._last_page is None or page_num <= self._last_page:
+            yield self._get_request(page_num, self._get_page_count(page_num))
+
+    def _get_page_count(self, page_num):
+        if self._last_page is None:
+            return self.pages_per_request
+        return min(self.pages_per_request, self._last_page - page_num + 1)
+
+    def _set_last_page(self, page_num):
+        # pages may come back out of order, so the first empty page
+        # seen is not necessarily the first empty page overall
+        if self._last_page is None or page_num < self._last_page:
+            self._last_page = page_num
+
+    @staticmethod
+    def _get_rows(batches):
+        return {drug.id: drug.to_row() for batch in batches for drug in batch.drugs}
+
+    @timing.timed('save.upsert')
+    def _upsert_rows(self, rows):
+        table = self.db_model.__table__
+        stmt = postgresql.insert(table).values(list(rows.values()))
+
+        if self.on_conflict == 'update':
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.id],
+                set_={column: stmt.excluded[column] for column in ('data', *NORMALIZED_COLUMNS)},
+                where=cast(table.c.data, postgresql.JSONB) != cast(stmt.excluded.data, postgresql.JSONB)
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=[table.c.id])
+
+        # xmax is zero only for freshly inserted rows, skipped rows are not returned at all
+        rows = self.db_session.execute(
+            stmt.returning(table.c.id, literal_column('(xmax = 0)').label('is_inserted'))
+        ).fetchall()
+        return [row.id for row in rows if row.is_inserted], [row.id for row in rows if not row.is_inserted]
+
+    @timing.timed('save.merge')
+    def _merge_rows(self, rows):
+        table = self.db_model.__table__
+        columns = [table.c.id, table.c.data] if self.on_conflict == 'update' else [table.c.id]
+        ids, existing = list(rows), {}
+        for start in range(0, len(ids), db.CHUNK_SIZE):
+            existing.update(
+                (row[0], row[-1])
+                for row in self.db_session.execute(select(columns).where(table.c.id.in_(ids[start:start + db.CHUNK_SIZE])))
+            )
+
+        new_rows = [row for id_, row in rows.items() if id_ not in existing]
+        changed_rows = [
+            {'_id': id_, 'data': row['data'], **{column: row[column] for column in NORMALIZED_COLUMNS}}
+            for id_, row in rows.items()
+            if self.on_conflict == 'update' and id_ in existing and existing[id_] != row['data']
+        ]
+
+        if new_rows:
+            self.db_session.execute(table.insert(), new_rows)
+        if changed_rows:
+            self.db_session.execute(table.update().where(table.c.id == bindparam('_id')), changed_rows)
+        return [row['id'] for row in new_rows], [row['_id'] for row in changed_rows]
+
+    @staticmethod
+    def _get_save_result(pages, added, updated, items_length):
+        return 'pages: {}-{}/~{}\tadded: {}\tupdated: {}\tskipped: {}'.format(
+            min(pages),
+            max(pages),
             SRC_APPROXIMATE_PAGE_LIMIT,
-            items_length - len(ignore_ids),
-            items_length
+            added,
+            updated,
+            items_length - added - updated
         )
 
+    @staticmethod
+    def _minify(query):
+        # the queries hold no string literals, so every whitespace run is insignificant
+        return re.sub(r'\s*([{}():,])\s*', r'\1', ' '.join(query.split()))
+
     @staticmethod
     def _get_item_id(item):
         return item['id']
@@ -0,0 +1,60 @@
+import base64
+import gzip
+import json
+import os
+
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+
+
+class ResponseArchive:
+
+    def __init__(self, path):
+        self.path = path
+
+        self._file = None
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+
+        with gzip.open(self.path, 'rt', encoding='utf-8') as file:
+            return {
+                (record := json.loads(line))['fingerprint']: record
+                for line in file
+            }
+
+    def append(self, fingerprint, response):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._file = gzip.open(self.path, 'at', encoding='utf-8')
+
+        self._file.write(json.dumps({
+            'fingerprint': fingerprint,
+            'url': response.url,
+            'status': response.status,
+            'headers': {
+                key.decode('latin-1'): [value.decode('latin-1') for value in values]
+                for key, values in response.headers.items()
+            },
+            'body': base64.b64encode(response.body).decode('ascii')
+        }) + '\n')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def build_response(record, request):
+        headers = Headers(record['headers'])
+        body = base64.b64decode(record['body'])
+        response_cls = responsetypes.from_args(headers=headers, url=record['url'], body=body)
+        return response_cls(
+            url=record['url'],
+            status=record['status'],
+            headers=headers,
+            body=body,
+            request=request,
+            flags=['replayed']
+        )
@@ -0,0 +1,126 @@
+from sqlalchemy import and_, bindparam, select
+
+from drugs.db import db, models
+from drugs.utils import json_decoding
+
+# technical roots of the oz catalogue, the categories under them are the top level ones
+EXCLUDED_IDS = frozenset(('2669', '2672', '2671'))
+
+
+def get_paths(breadcrumbs):
+    # one [(id, name), ...] path from the top down for every place the product is listed in
+    return [
+        [
+            (category.get('id'), category.get('name'))
+            for category in path.get('path')
+            if category.get('id') not in EXCLUDED_IDS
+        ]
+        for path in json_decoding.loads(breadcrumbs)
+    ]
+
+
+class CategoryTree:
+    # category keeps the oz catalogue with the materialized id path of every node,
+    # drug_category links a drug to each category on its breadcrumbs, ancestors included,
+    # so the drugs under a category are one primary key range joined to oz_drug
+
+    db_model = models.Category
+    link_model = models.DrugCategory
+
+    @classmethod
+    def create_tables(cls, engine):
+        # databases created before the tree lack its tables
+        models.Base.metadata.create_all(engine, tables=[cls.db_model.__table__, cls.link_model.__table__])
+
+    def update(self, db_session, drugs):
+        # drugs are {drug id: breadcrumbs}, their links are replaced, the caller commits
+        categories, links = {}, []
+        for drug_id, breadcrumbs in drugs.items():
+            linked = set()
+            for path in get_paths(breadcrumbs):
+                parent_id, ids = None, []
+                for category_id, name in path:
+                    if category_id is None:
+                        continue
+                    ids.append(category_id)
+                    category_id = int(category_id)
+                    categories[category_id] = {
+                        'id': category_id,
+                        'parent_id': parent_id,
+                        'name': name,
+                        'path': '/{}/'.format('/'.join(ids))
+                    }
+                    linked.add(category_id)
+                    parent_id = category_id
+            links.extend({'category_id': category_id, 'drug_id': drug_id} for category_id in linked)
+
+        self._save_categories(db_session, categories)
+        self._save_links(db_session, list(drugs), links)
+        return len(links)
+
+    def rebuild(self, db_session, batch_size=5000):
+        # oz_drug is read by id ranges, each batch is committed on its own
+        oz_table = models.OzDrug.__table__
+        db_session.execute(self.link_model.__table__.delete())
+        db_session.execute(self.db_model.__table__.delete())
+        db_session.commit()
+
+        drugs, links, last_id = 0, 0, None
+        while True:
+            query = select([oz_table.c.id, oz_table.c.data['breadcrumbs'].as_string()])
+            if last_id is not None:
+                query = query.where(oz_table.c.id > last_id)
+            if not (rows := db_session.execute(query.order_by(oz_table.c.id).limit(batch_size)).fetchall()):
+                break
+            links += self.update(db_session, {drug_id: breadcrumbs for drug_id, breadcrumbs in rows if breadcrumbs})
+            db_session.commit()
+            drugs, last_id = drugs + len(rows), rows[-1][0]
+        return drugs, links
+
+    def get_drugs(self, db_session, category_id, in_stock_only=False):
+        # (id, price) of the drugs under the category, cheapest first
+        oz_table, link_table = models.OzDrug.__table__, self.link_model.__table__
+        conditions = [link_table.c.category_id == category_id]
+        if in_stock_only:
+            conditions.append(oz_table.c.is_in_stock.is_(True))
+        return db_session.execute(
+            select([oz_table.c.id, oz_table.c.price])
+            .select_from(link_table.join(oz_table, oz_table.c.id == link_table.c.drug_id))
+            .where(and_(*conditions))
+            .order_by(oz_table.c.price, oz_table.c.id)
+        ).fetchall()
+
+    def get_children(self, db_session, category_id=None):
+        table = self.db_model.__table__
+        return db_session.execute(
+            select([table.c.id, table.c.name]).where(table.c.parent_id == category_id).order_by(table.c.name)
+        ).fetchall()
+
+    def _save_categories(self, db_session, categories):
+        # the tree barely changes, only new nodes and renamed or moved ones are written
+        table = self.db_model.__table__
+        category_ids = list(categories)
+        for start in range(0, len(category_ids), db.CHUNK_SIZE):
+            chunk = category_ids[start:start + db.CHUNK_SIZE]
+            existing = {
+                category_id: {'id': category_id, 'parent_id': parent_id, 'name': name, 'path': path}
+                for category_id, parent_id, name, path in db_session.execute(
+                    select([table.c.id, table.c.parent_id, table.c.name, table.c.path]).where(table.c.id.in_(chunk))
+                )
+            }
+            if new_rows := [categories[category_id] for category_id in chunk if category_id not in existing]:
+                # another worker may add the same node meanwhile
+                db.insert_ignore(db_session, table, new_rows)
+            if changed_rows := [
+                {'_id': category_id, **{key: value for key, value in categories[category_id].items() if key != 'id'}}
+                for category_id in chunk
+                if category_id in existing and existing[category_id] != categories[category_id]
+            ]:
+                db_session.execute(table.update().where(table.c.id == bindparam('_id')), changed_rows)
+
+    def _save_links(self, db_session, drug_ids, links):
+        table = self.link_model.__table__
+        for start in range(0, len(drug_ids), db.CHUNK_SIZE):
+            db_session.execute(table.delete().where(table.c.drug_id.in_(drug_ids[start:start + db.CHUNK_SIZE])))
+        if links:
+            db_session.execute(table.insert(), links)
@@ -0,0 +1,27 @@
+from sqlalchemy import select
+
+from drugs.db import models
+
+
+class CheckpointStore:
+    db_model = models.Checkpoint
+
+    def __init__(self, source):
+        self.source = source
+
+    @classmethod
+    def create_table(cls, engine):
+        # databases created before checkpoints lack the table
+        models.Base.metadata.create_all(engine, tables=[cls.db_model.__table__])
+
+    def load(self, db_session):
+        table = self.db_model.__table__
+        return db_session.execute(
+            select([table.c.state]).where(table.c.source == self.source)
+        ).scalar()
+
+    def save(self, db_session, state):
+        table = self.db_model.__table__
+        db_session.execute(table.delete().where(table.c.source == self.source))
+        db_session.execute(table.insert(), {'source': self.source, 'state': state})
+        db_session.commit()
@@ -0,0 +1,88 @@
+import hashlib
+import json
+
+from sqlalchemy import and_, select
+
+from drugs.db import models
+
+NEW = 'new'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
+
+def get_digest(item):
+    dumped = json.dumps(item, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(dumped.encode('utf-8')).hexdigest()
+
+
+class FingerprintStore:
+    db_model = models.Fingerprint
+
+    def __init__(self, source):
+        self.source = source
+
+        self._known = {}
+        self._pending = {}
+        self._validators = {}
+
+    def load(self, db_session):
+        table = self.db_model.__table__
+        rows = db_session.execute(
+            select([table.c.key, table.c.digest, table.c.etag, table.c.last_modified])
+            .where(table.c.source == self.source)
+        )
+        self._known = {key: (digest, etag, last_modified) for key, digest, etag, last_modified in rows}
+
+    def classify(self, key, digest):
+        if (known := self._known.get(key)) is None:
+            status = NEW
+        elif known[0] == digest:
+            return UNCHANGED
+        else:
+            status = CHANGED
+
+        self._pending[key] = digest
+        return status
+
+    def set_validators(self, key, etag, last_modified):
+        self._validators[key] = etag, last_modified
+
+    def get_conditional_headers(self, key):
+        if (known := self._known.get(key)) is None:
+            return {}
+
+        _, etag, last_modified = known
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def pop_committed(self, keys, skipped=frozenset()):
+        # skipped keys were not written, their stored rows may still differ from the digest
+        rows = []
+        for key in keys:
+            if (digest := self._pending.pop(key, None)) is None:
+                continue
+            etag, last_modified = self._validators.pop(key, (None, None))
+            if key in skipped:
+                continue
+            self._known[key] = digest, etag, last_modified
+            rows.append({
+                'source': self.source,
+                'key': key,
+                'digest': digest,
+                'etag': etag,
+                'last_modified': last_modified
+            })
+        return rows
+
+    def save(self, db_session, rows):
+        table = self.db_model.__table__
+        db_session.execute(table.delete().where(and_(
+            table.c.source == self.source,
+            table.c.key.in_([row['key'] for row in rows])
+        )))
+        db_session.execute(table.insert(), rows)
+        db_session.commit()
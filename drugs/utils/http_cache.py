@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import time
+import zlib
+
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from drugs.utils import utils
+
+COMPRESSIONS = ('zstd', 'zlib', 'none')
+PACK_FILE = 'bodies.pack'
+INDEX_FILE = 'index.jsonl'
+
+
+def check_available(compression):
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown http cache compression: {}'.format(compression))
+    if compression == 'zstd' and zstandard is None:
+        raise ImportError('zstd compression requires the zstandard package')
+
+
+class PackCacheStorage:
+    # HTTPCACHE_STORAGE keeping the responses of a spider in two append-only files: a pack of
+    # compressed bodies, each distinct body stored once, and an index of responses pointing into it.
+    # Requests are keyed like the replay archive, body included, so every oz page has its own entry
+
+    def __init__(self, settings):
+        self.cache_dir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.compression = settings.get('HTTPCACHE_PACK_COMPRESSION')
+        check_available(self.compression)
+
+        # fingerprint -> response record, body digest -> (offset, size, compression) in the pack
+        self._index = {}
+        self._bodies = {}
+        self._index_lines = 0
+        self._pack = None
+        self._pack_reader = None
+        self._index_file = None
+        self._stats = None
+
+    def open_spider(self, spider):
+        directory = os.path.join(self.cache_dir, spider.name)
+        os.makedirs(directory, exist_ok=True)
+        index_path, pack_path = (os.path.join(directory, name) for name in (INDEX_FILE, PACK_FILE))
+
+        self._load(index_path)
+        self._pack = open(pack_path, 'ab')
+        self._pack_reader = open(pack_path, 'rb')
+        self._index_file = open(index_path, 'a', encoding='utf-8')
+        self._stats = spider.crawler.stats
+        spider.logger.info('Http cache of %d responses, %d bodies in %s', len(self._index), len(self._bodies), directory)
+
+    def close_spider(self, spider):
+        self._stats.set_value('httpcache/pack/responses', len(self._index), spider=spider)
+        self._stats.set_value('httpcache/pack/bodies', len(self._bodies), spider=spider)
+        self._stats.set_value('httpcache/pack/size', self._pack.tell(), spider=spider)
+        for file in (self._pack, self._pack_reader, self._index_file):
+            file.close()
+
+        # every refetch appends a line, the index is rewritten once most of them are stale
+        if self._index_lines > 2 * len(self._index):
+            self._compact_index(self._index_file.name)
+
+    def retrieve_response(self, spider, request):
+        if (record := self._index.get(utils.get_request_fingerprint(request))) is None:
+            return None
+        if 0 < self.expiration_secs < time.time() - record['time']:
+            return None
+
+        headers = Headers(record['headers'])
+        body = self._read_body(*self._bodies[record['body']])
+        response_cls = responsetypes.from_args(headers=headers, url=record['url'], body=body)
+        return response_cls(url=record['url'], status=record['status'], headers=headers, body=body)
+
+    def store_response(self, spider, request, response):
+        # a 304 only confirms the body cached before, storing it would shadow that body
+        if response.status == 304:
+            return
+
+        if (digest := hashlib.blake2b(response.body, digest_size=16).hexdigest()) in self._bodies:
+            self._stats.inc_value('httpcache/pack/deduplicated', spider=spider)
+        else:
+            self._bodies[digest] = self._write_body(response.body)
+            self._stats.inc_value('httpcache/pack/stored_bytes', self._bodies[digest][1], spider=spider)
+
+        fingerprint = utils.get_request_fingerprint(request)
+        record = self._index[fingerprint] = {
+            'url': response.url,
+            'status': response.status,
+            'headers': {
+                key.decode('latin-1'): [value.decode('latin-1') for value in values]
+                for key, values in response.headers.items()
+            },
+            'time': time.time(),
+            'body': digest
+        }
+        # the body is in the pack before an index line points to it
+        self._index_file.write(self._dump_record(fingerprint, record))
+        self._index_file.flush()
+        self._index_lines += 1
+
+    def _load(self, index_path):
+        if not os.path.exists(index_path):
+            return
+
+        with open(index_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the line of an interrupted write, its body is unreachable anyway
+                    continue
+                self._bodies[record['body']] = tuple(record.pop('pack'))
+                # later lines are newer responses to the same request
+                self._index[record.pop('fingerprint')] = record
+                self._index_lines += 1
+
+    def _compact_index(self, index_path):
+        with open(index_path + '.tmp', 'w', encoding='utf-8') as file:
+            file.writelines(self._dump_record(fingerprint, record) for fingerprint, record in self._index.items())
+        os.replace(index_path + '.tmp', index_path)
+
+    def _dump_record(self, fingerprint, record):
+        return json.dumps({'fingerprint': fingerprint, **record, 'pack': self._bodies[record['body']]}) + '\n'
+
+    def _write_body(self, body):
+        if self.compression == 'zstd':
+            blob = zstandard.ZstdCompressor().compress(body)
+        elif self.compression == 'zlib':
+            blob = zlib.compress(body)
+        else:
+            blob = body
+
+        offset = self._pack.tell()
+        self._pack.write(blob)
+        self._pack.flush()
+        return offset, len(blob), self.compression
+
+    def _read_body(self, offset, size, compression):
+        self._pack_reader.seek(offset)
+        blob = self._pack_reader.read(size)
+        if compression == 'zstd':
+            return zstandard.ZstdDecompressor().decompress(blob)
+        if compression == 'zlib':
+            return zlib.decompress(blob)
+        return blob
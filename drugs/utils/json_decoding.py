@@ -0,0 +1,23 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKENDS = ('json', 'orjson')
+
+# small nested documents are always decoded with the fastest backend installed
+loads = orjson.loads if orjson is not None else json.loads
+
+
+def check_available(backend):
+    if backend not in BACKENDS:
+        raise ValueError('Unknown json backend: {}'.format(backend))
+    if backend == 'orjson' and orjson is None:
+        raise ImportError('orjson json backend requires the orjson package')
+
+
+def load(body, backend):
+    # decoded straight from the bytes
+    return orjson.loads(body) if backend == 'orjson' else json.loads(body)
@@ -0,0 +1,201 @@
+import re
+from collections import defaultdict
+
+from sqlalchemy import select
+
+from drugs.db import models
+
+OZ = 'oz'
+ASNA = 'asna'
+MIN_CONFIDENCE = 0.6
+ASNA_MNN_LABELS = ('Действующее вещество', 'МНН')
+ASNA_MANUFACTURER_LABELS = ('Производитель',)
+
+WORD_RE = re.compile(r'[a-zа-я]+(?:-[a-zа-я]+)?')
+STRENGTH_RE = re.compile(r'(\d+(?:[.,]\d+)?)\s*(мкг|мг|мл|ме|г|%)')
+PACK_RE = re.compile(r'(?:№|\bn)\s*(\d+)')
+# dosage forms are spelled in many ways, they are compared apart from the name
+FORMS = {
+    'таб': 'tablet', 'табл': 'tablet', 'таблетки': 'tablet',
+    'капс': 'capsule', 'капсулы': 'capsule',
+    'раствор': 'solution', 'р-р': 'solution', 'амп': 'solution', 'ампулы': 'solution',
+    'мазь': 'ointment', 'крем': 'cream', 'гель': 'gel', 'спрей': 'spray',
+    'капли': 'drops', 'сироп': 'syrup', 'пор': 'powder', 'порошок': 'powder', 'саше': 'powder',
+    'супп': 'suppository', 'суппозитории': 'suppository',
+}
+STOP_WORDS = frozenset(('покр', 'плен', 'обол', 'пленочной', 'оболочкой', 'для', 'приема', 'внутрь', 'флакон', 'упак'))
+LEGAL_FORMS = frozenset(('ооо', 'зао', 'оао', 'пао', 'gmbh', 'ltd', 'inc', 'llc', 'plc', 'corp'))
+
+
+def normalize(text):
+    return (text or '').lower().replace('ё', 'е')
+
+
+def get_product(name, mnn, manufacturer):
+    # (name words, strengths, pack sizes, dosage forms, mnn, manufacturer words)
+    name = normalize(name)
+    words = WORD_RE.findall(name)
+    return (
+        tuple(word for word in words if len(word) > 2 and word not in FORMS and word not in STOP_WORDS),
+        frozenset(strength.replace(',', '.') + unit for strength, unit in STRENGTH_RE.findall(name)),
+        frozenset(PACK_RE.findall(name)),
+        frozenset(FORMS[word] for word in words if word in FORMS),
+        ' '.join(WORD_RE.findall(normalize(mnn))) or None,
+        frozenset(word for word in WORD_RE.findall(normalize(manufacturer)) if word not in LEGAL_FORMS),
+    )
+
+
+def get_oz_product(data, manufacturer):
+    return get_product(data.get('name'), data.get('mnn_ru'), manufacturer)
+
+
+def get_asna_product(title, info):
+    params = {param['label']: param['value'] for param in info or ()}
+    return get_product(
+        title,
+        next((params[label] for label in ASNA_MNN_LABELS if label in params), None),
+        next((params[label] for label in ASNA_MANUFACTURER_LABELS if label in params), None),
+    )
+
+
+def get_confidence(product, other):
+    words, *variants, mnn, manufacturer = product
+    other_words, *other_variants, other_mnn, other_manufacturer = other
+
+    union = len(set(words).union(other_words))
+    score, weight = 0.6 * len(set(words).intersection(other_words)) / union if union else 0.0, 0.6
+    if mnn and other_mnn:
+        score, weight = score + 0.2 * (mnn == other_mnn), weight + 0.2
+    if manufacturer and other_manufacturer:
+        score, weight = score + 0.2 * bool(manufacturer & other_manufacturer), weight + 0.2
+    for variant, other_variant in zip(variants, other_variants):
+        # the same brand in another strength, pack size or form is another product
+        if variant and other_variant and not variant & other_variant:
+            score /= 2
+    return score / weight
+
+
+class DrugMatcher:
+    # Products are blocked by the first word of their name and by mnn, only products
+    # sharing a block are compared. Every oz product keeps its best asna match
+
+    db_model = models.DrugMatch
+
+    def __init__(self, min_confidence=MIN_CONFIDENCE):
+        self.min_confidence = min_confidence
+
+        self._products = {OZ: {}, ASNA: {}}
+        self._blocks = {OZ: defaultdict(set), ASNA: defaultdict(set)}
+        self._matches = {}
+        # asna url -> the oz products matched to it
+        self._matched = defaultdict(set)
+
+    def __len__(self):
+        return len(self._matches)
+
+    def get_sizes(self):
+        return len(self._products[OZ]), len(self._products[ASNA])
+
+    def load(self, db_session):
+        oz_table, asna_table, table = models.OzDrug.__table__, models.AsnaDrug.__table__, self.db_model.__table__
+        self._matches = {
+            oz_id: (confidence, asna_url)
+            for oz_id, asna_url, confidence in db_session.execute(
+                select([table.c.oz_id, table.c.asna_url, table.c.confidence])
+            )
+        }
+        for oz_id, (_, asna_url) in self._matches.items():
+            self._matched[asna_url].add(oz_id)
+        asna_rows = db_session.execute(
+            select([asna_table.c.url, asna_table.c.title, asna_table.c.info])
+            .where(asna_table.c.id.in_(models.AsnaDrug.get_latest_ids()))
+            .order_by(asna_table.c.id)
+        )
+        oz_rows = db_session.execute(select([
+            oz_table.c.id,
+            oz_table.c.data['name'].as_string(),
+            oz_table.c.data['mnn_ru'].as_string(),
+            oz_table.c.manufacturer,
+        ]))
+        return self.rebuild(
+            ((url, get_asna_product(title, info)) for url, title, info in asna_rows),
+            ((oz_id, get_product(name, mnn, manufacturer)) for oz_id, name, mnn, manufacturer in oz_rows),
+        )
+
+    def rebuild(self, asna_products, oz_products):
+        # indexing every asna product first leaves one lookup per oz product
+        for url, product in asna_products:
+            self._index(ASNA, url, product)
+        return self.add(OZ, oz_products)
+
+    def add(self, source, products):
+        changed = {}
+        for key, product in products:
+            self._index(source, key, product)
+            if source == OZ:
+                self._match_oz(key, product, changed)
+            else:
+                self._match_asna(key, product, changed)
+        return list(changed.values())
+
+    def save(self, db_session, rows):
+        table = self.db_model.__table__
+        db_session.execute(table.delete().where(table.c.oz_id.in_([row['oz_id'] for row in rows])))
+        if kept := [row for row in rows if row['asna_url'] is not None]:
+            db_session.execute(table.insert(), kept)
+        db_session.commit()
+
+    def _index(self, source, key, product):
+        if (previous := self._products[source].get(key)) is not None:
+            for block in self._get_block_keys(previous):
+                self._blocks[source][block].discard(key)
+        self._products[source][key] = product
+        for block in self._get_block_keys(product):
+            self._blocks[source][block].add(key)
+
+    def _get_candidates(self, source, product):
+        blocks = self._blocks[source]
+        return set().union(*(blocks[block] for block in self._get_block_keys(product) if block in blocks))
+
+    @staticmethod
+    def _get_block_keys(product):
+        words, *_, mnn, _ = product
+        if words:
+            yield 'name', words[0]
+        if mnn:
+            yield 'mnn', mnn
+
+    def _match_oz(self, oz_id, product, changed):
+        best = max(
+            (
+                (get_confidence(product, self._products[ASNA][url]), url)
+                for url in self._get_candidates(ASNA, product)
+            ),
+            default=None
+        )
+        self._set_match(oz_id, best, changed)
+
+    def _match_asna(self, url, product, changed):
+        # the matches of the product as it was are dropped, their oz products look for
+        # their best match again, the product as it is now included
+        rematched = set(self._matched.get(url, ()))
+        for oz_id in rematched:
+            self._match_oz(oz_id, self._products[OZ][oz_id], changed)
+
+        for oz_id in self._get_candidates(OZ, product) - rematched:
+            confidence = get_confidence(self._products[OZ][oz_id], product)
+            if (current := self._matches.get(oz_id)) is None or confidence > current[0]:
+                self._set_match(oz_id, (confidence, url), changed)
+
+    def _set_match(self, oz_id, best, changed):
+        # a None asna_url row deletes a match that fell below the threshold
+        if best is None or best[0] < self.min_confidence:
+            if (current := self._matches.pop(oz_id, None)) is not None:
+                self._matched[current[1]].discard(oz_id)
+                changed[oz_id] = {'oz_id': oz_id, 'asna_url': None, 'confidence': None}
+        elif (current := self._matches.get(oz_id)) != best:
+            if current is not None:
+                self._matched[current[1]].discard(oz_id)
+            self._matches[oz_id] = best
+            self._matched[best[1]].add(oz_id)
+            changed[oz_id] = {'oz_id': oz_id, 'asna_url': best[1], 'confidence': best[0]}
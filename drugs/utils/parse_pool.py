@@ -0,0 +1,39 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from twisted.internet import defer, reactor
+
+
+class ParsePool:
+
+    def __init__(self, size):
+        self.size = size
+
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            # workers are spawned, forking a process that runs the reactor threads is unsafe
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.size,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return self._executor
+
+    def submit(self, func, *args):
+        d = defer.Deferred()
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(lambda done: reactor.callFromThread(self._fire, d, done))
+        return d
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    @staticmethod
+    def _fire(d, future):
+        if (exception := future.exception()) is not None:
+            d.errback(exception)
+        else:
+            d.callback(future.result())
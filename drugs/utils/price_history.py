@@ -0,0 +1,66 @@
+from datetime import datetime
+
+from sqlalchemy import and_, func, select
+
+from drugs.db import db, models
+
+
+class PriceHistory:
+    db_model = models.PriceHistory
+
+    def __init__(self, source):
+        self.source = source
+
+    @classmethod
+    def create_table(cls, engine):
+        # databases created before price history lack the table
+        models.Base.metadata.create_all(engine, tables=[cls.db_model.__table__])
+
+    def record(self, db_session, prices, observed_at=None):
+        # prices are {product_id: (price, is_in_stock)}, only the ones that changed are appended
+        observed_at = observed_at or datetime.utcnow()
+        product_ids = list(prices)
+
+        rows = []
+        for start in range(0, len(product_ids), db.CHUNK_SIZE):
+            chunk = product_ids[start:start + db.CHUNK_SIZE]
+            latest = self.get_latest(db_session, chunk)
+            rows.extend(
+                {
+                    'source': self.source,
+                    'product_id': product_id,
+                    'observed_at': observed_at,
+                    'price': prices[product_id][0],
+                    'is_in_stock': prices[product_id][1]
+                }
+                for product_id in chunk
+                if latest.get(product_id) != prices[product_id]
+            )
+
+        if rows:
+            db_session.execute(self.db_model.__table__.insert(), rows)
+        return len(rows)
+
+    def get_latest(self, db_session, product_ids, at=None):
+        # as last seen, or as seen at the time at when it is given
+        table = self.db_model.__table__
+        conditions = [table.c.source == self.source, table.c.product_id.in_(product_ids)]
+        if at is not None:
+            conditions.append(table.c.observed_at <= at)
+
+        latest = (
+            select([table.c.product_id, func.max(table.c.observed_at).label('observed_at')])
+            .where(and_(*conditions))
+            .group_by(table.c.product_id)
+            .alias('latest')
+        )
+        rows = db_session.execute(
+            select([table.c.product_id, table.c.price, table.c.is_in_stock]).select_from(
+                table.join(latest, and_(
+                    table.c.source == self.source,
+                    table.c.product_id == latest.c.product_id,
+                    table.c.observed_at == latest.c.observed_at
+                ))
+            )
+        )
+        return {product_id: (price, is_in_stock) for product_id, price, is_in_stock in rows}
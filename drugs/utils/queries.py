@@ -0,0 +1,203 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from sqlalchemy import or_, select
+
+from drugs.db import db, models
+from drugs.utils.matching import ASNA, ASNA_MNN_LABELS, OZ
+from drugs.utils.price_history import PriceHistory
+
+MISSING = object()
+
+
+class QueryCache:
+    # LRU of query results that also expire ttl seconds after they were stored,
+    # shared by the threads of a process
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            if (entry := self._entries.get(key)) is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = time.monotonic() + self.ttl, value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DrugQueries:
+    # Read side of the oz and asna tables. Products are looked up by id for oz and by url for
+    # asna, the ones not cached yet are fetched with one query per chunk. Lookups are dropped from
+    # the cache as the pipeline commits their products, searches once anything of their source is
+
+    oz_model = models.OzDrug
+    asna_model = models.AsnaDrug
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else QueryCache()
+
+        # searches are cached under the generation of their source, a commit moves it on
+        self._generations = defaultdict(int)
+
+    def get_drugs(self, db_session, source, keys):
+        # {key: product dict} of the keys found
+        fetch = self._fetch_oz_drugs if source == OZ else self._fetch_asna_drugs
+        return self._get_many(db_session, 'drug', source, keys, fetch)
+
+    def get_latest_prices(self, db_session, source, keys):
+        # {key: (price, is_in_stock)} as last recorded in price_history
+        def fetch(session, chunk):
+            prices = PriceHistory(source).get_latest(session, [str(key) for key in chunk])
+            return {self._get_key(source, product_id): price for product_id, price in prices.items()}
+
+        return self._get_many(db_session, 'price', source, keys, fetch)
+
+    def search(self, db_session, text, source=None, limit=20):
+        # products of both sources, or of one, whose title, or oz mnn, contains the text
+        sources = (OZ, ASNA) if source is None else (source,)
+        key = ('search', text.lower(), sources, limit, tuple(self._generations[searched] for searched in sources))
+        if (result := self.cache.get(key)) is not MISSING:
+            return result
+
+        result = []
+        for searched in sources:
+            search = self._search_oz if searched == OZ else self._search_asna
+            found = search(db_session, text, limit)
+            result.extend(found.values())
+            # the products found serve later lookups by key too
+            for product_key, product in found.items():
+                self.cache.set(('drug', searched, product_key), product)
+        self.cache.set(key, result)
+        return result
+
+    def invalidate(self, source, keys=None):
+        # the given products of the source, or the whole cache
+        self._generations[source] += 1
+        if keys is None:
+            self.cache.clear()
+            return
+        keys = [self._get_key(source, key) for key in keys]
+        self.cache.delete((kind, source, key) for kind in ('drug', 'price') for key in keys)
+
+    def _get_many(self, db_session, kind, source, keys, fetch):
+        result, missing = {}, []
+        for key in (self._get_key(source, key) for key in keys):
+            if (value := self.cache.get((kind, source, key))) is MISSING:
+                missing.append(key)
+            elif value is not None:
+                result[key] = value
+
+        for start in range(0, len(missing), db.CHUNK_SIZE):
+            chunk = missing[start:start + db.CHUNK_SIZE]
+            fetched = fetch(db_session, chunk)
+            for key in chunk:
+                # keys not found are cached as None, so they are not looked up again either
+                self.cache.set((kind, source, key), fetched.get(key))
+            result.update(fetched)
+        return result
+
+    def _fetch_oz_drugs(self, db_session, ids):
+        table = self.oz_model.__table__
+        return self._get_oz_drugs(db_session, table.c.id.in_(ids))
+
+    def _fetch_asna_drugs(self, db_session, urls):
+        table = self.asna_model.__table__
+        return self._get_asna_drugs(db_session, table.c.url.in_(urls))
+
+    def _search_oz(self, db_session, text, limit):
+        table = self.oz_model.__table__
+        pattern = '%{}%'.format(text)
+        return self._get_oz_drugs(db_session, or_(
+            table.c.data['name'].as_string().ilike(pattern),
+            table.c.data['mnn_ru'].as_string().ilike(pattern)
+        ), limit)
+
+    def _search_asna(self, db_session, text, limit):
+        table = self.asna_model.__table__
+        return self._get_asna_drugs(db_session, table.c.title.ilike('%{}%'.format(text)), limit)
+
+    def _get_oz_drugs(self, db_session, condition, limit=None):
+        # only the fields read are pulled out of data, the blob itself is not decoded
+        table = self.oz_model.__table__
+        rows = db_session.execute(
+            select([
+                table.c.id,
+                table.c.data['name'].as_string(),
+                table.c.data['mnn_ru'].as_string(),
+                table.c.price,
+                table.c.is_in_stock,
+                table.c.manufacturer,
+                table.c.categories
+            ]).where(condition).order_by(table.c.price, table.c.id).limit(limit)
+        )
+        return {
+            id_: {
+                'source': OZ,
+                'id': id_,
+                'title': name,
+                'mnn': mnn,
+                'price': price,
+                'is_in_stock': is_in_stock,
+                'manufacturer': manufacturer,
+                'categories': categories
+            }
+            for id_, name, mnn, price, is_in_stock, manufacturer, categories in rows
+        }
+
+    def _get_asna_drugs(self, db_session, condition, limit=None):
+        table = self.asna_model.__table__
+        rows = db_session.execute(
+            select([table.c.url, table.c.title, table.c.info, table.c.price, table.c.is_receipt])
+            .where(table.c.id.in_(self.asna_model.get_latest_ids(condition)))
+            .order_by(table.c.price, table.c.url)
+            .limit(limit)
+        )
+        return {
+            url: {
+                'source': ASNA,
+                'url': url,
+                'title': title,
+                'mnn': self._get_asna_mnn(info),
+                'price': price,
+                'is_receipt': is_receipt
+            }
+            for url, title, info, price, is_receipt in rows
+        }
+
+    @staticmethod
+    def _get_asna_mnn(info):
+        params = {param['label']: param['value'] for param in info or ()}
+        return next((params[label] for label in ASNA_MNN_LABELS if label in params), None)
+
+    @staticmethod
+    def _get_key(source, key):
+        # fingerprint entries and price_history key oz products by their id as a string
+        return int(key) if source == OZ else key
@@ -0,0 +1,164 @@
+import gzip
+import json
+import os
+import time
+
+from sqlalchemy import JSON, Boolean, Float, Integer, TypeDecorator
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+
+
+class JsonLinesWriter:
+    extension = '.jsonl'
+
+    def __init__(self, path, compression, columns):
+        self._raw = open(path + self.extension + COMPRESSION_EXTENSIONS[compression], 'wb')
+        self._file = self._wrap(self._raw, compression)
+
+    @property
+    def size(self):
+        return self._raw.tell()
+
+    def write(self, rows):
+        self._file.write(''.join(
+            json.dumps(row, ensure_ascii=False) + '\n' for row in rows
+        ).encode('utf-8'))
+
+    def close(self):
+        self._file.close()
+        if not self._raw.closed:
+            self._raw.close()
+
+    @staticmethod
+    def _wrap(raw, compression):
+        if compression == 'gzip':
+            return gzip.GzipFile(fileobj=raw, mode='wb')
+        if compression == 'zstd':
+            return zstandard.ZstdCompressor().stream_writer(raw)
+        return raw
+
+
+class ParquetWriter:
+    extension = '.parquet'
+    row_group_size = 1000
+
+    def __init__(self, path, compression, columns):
+        self._json_columns = {column.name for column in columns if isinstance(self._get_base_type(column.type), JSON)}
+        self._schema = pyarrow.schema([
+            (column.name, self._get_arrow_type(self._get_base_type(column.type))) for column in columns
+        ])
+
+        self._raw = open(path + self.extension, 'wb')
+        self._writer = pyarrow.parquet.ParquetWriter(
+            self._raw,
+            self._schema,
+            compression=None if compression == 'none' else compression
+        )
+        self._rows = []
+
+    @property
+    def size(self):
+        return self._raw.tell()
+
+    def write(self, rows):
+        self._rows.extend(rows)
+        if len(self._rows) >= self.row_group_size:
+            self._write_row_group()
+
+    def close(self):
+        self._write_row_group()
+        self._writer.close()
+        self._raw.close()
+
+    def _write_row_group(self):
+        if not self._rows:
+            return
+
+        self._writer.write_table(pyarrow.Table.from_pydict({
+            name: [self._encode(name, row.get(name)) for row in self._rows]
+            for name in self._schema.names
+        }, schema=self._schema))
+        self._rows = []
+
+    def _encode(self, name, value):
+        if name in self._json_columns and value is not None:
+            return json.dumps(value, ensure_ascii=False)
+        return value
+
+    @staticmethod
+    def _get_base_type(column_type):
+        # variants, as models.JSONB is one, wrap the type of the dialects not listed
+        return column_type.impl if isinstance(column_type, TypeDecorator) else column_type
+
+    @staticmethod
+    def _get_arrow_type(column_type):
+        for sql_type, arrow_type in (
+            (Boolean, pyarrow.bool_),
+            (Integer, pyarrow.int64),
+            (Float, pyarrow.float64),
+        ):
+            if isinstance(column_type, sql_type):
+                return arrow_type()
+        return pyarrow.string()
+
+
+WRITERS = {
+    'jsonl': JsonLinesWriter,
+    'parquet': ParquetWriter,
+}
+
+
+def check_available(file_format, compression):
+    if file_format not in WRITERS:
+        raise ValueError('Unknown sink format: {}'.format(file_format))
+    if compression not in COMPRESSION_EXTENSIONS:
+        raise ValueError('Unknown sink compression: {}'.format(compression))
+    if file_format == 'parquet' and pyarrow is None:
+        raise ImportError('parquet sink requires the pyarrow package')
+    if file_format == 'jsonl' and compression == 'zstd' and zstandard is None:
+        raise ImportError('zstd compression requires the zstandard package')
+
+
+class RotatingFileSink:
+
+    def __init__(self, directory, file_format, compression, columns, max_file_size):
+        self.directory = directory
+        self.writer_cls = WRITERS[file_format]
+        self.compression = compression
+        self.columns = columns
+        self.max_file_size = max_file_size
+
+        self._prefix = time.strftime('%Y%m%d-%H%M%S')
+        self._part = 0
+        self._writer = None
+
+    def write(self, rows):
+        if self._writer is None:
+            self._writer = self._open_next()
+
+        self._writer.write(rows)
+
+        if self._writer.size >= self.max_file_size:
+            self.close()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _open_next(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._part += 1
+        path = os.path.join(self.directory, '{}-{:05d}'.format(self._prefix, self._part))
+        return self.writer_cls(path, self.compression, self.columns)
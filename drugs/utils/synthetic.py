@@ -0,0 +1,98 @@
+import json
+import random
+
+from drugs.db import models
+from drugs.spiders.oz import OzSpider
+from drugs.utils import matching
+
+# oz products shaped like the ones the graphql api lists, for the benchmark commands
+
+# (oz, asna) spellings of the dosage forms
+DOSAGE_FORMS = (('таб.', 'таблетки'), ('капс.', 'капсулы'), ('р-р', 'раствор'), ('мазь', 'мазь'))
+
+
+def get_category_leaves(top=20, children=10, grandchildren=5):
+    # (top, child, grandchild) ids of a three level catalogue, 1220 nodes by default
+    return [
+        (
+            1 + top_id,
+            1 + top + top_id * children + child_id,
+            1 + top + top * children + (top_id * children + child_id) * grandchildren + grandchild_id
+        )
+        for top_id in range(top)
+        for child_id in range(children)
+        for grandchild_id in range(grandchildren)
+    ]
+
+
+def get_oz_product(id_, rng, leaves=None, manufacturers=2000, description_size=600):
+    # listed under one or two leaves of the catalogue, under the technical root like oz does
+    leaves = leaves or get_category_leaves()
+    manufacturer_id = rng.randrange(manufacturers)
+    return {
+        'id': id_,
+        'name': 'Drug {}'.format(id_),
+        'sku': 'sku{}'.format(id_),
+        'mnn_ru': rng.choice(('Лоратадин', 'Ибупрофен', 'Парацетамол', 'Амоксициллин')),
+        'promo_label': None,
+        'breadcrumbs': json.dumps([
+            {'path': [{'id': '2669', 'name': 'root'}, *(
+                {'id': str(category_id), 'name': 'Category {}'.format(category_id)} for category_id in leaf
+            )]}
+            for leaf in rng.sample(leaves, rng.choice((1, 1, 2)))
+        ], ensure_ascii=False),
+        'active': '1',
+        'manufacturer_ru': {'label': 'Производитель {}'.format(manufacturer_id)},
+        'manufacturer_id': {'label': 'Manufacturer {}'.format(manufacturer_id), 'option_id': str(manufacturer_id)},
+        'media_gallery': [{'url_image': 'a', 'url_thumbnail': 'b', 'url_small_image': 'c'}],
+        'orig_preparat': None,
+        'is_in_stock': rng.choice(('true', 'true', '0')),
+        'rec_need': rng.choice(('0', '1')),
+        'delivery': '1',
+        'thermolabile': '0',
+        'lekforms_url': 'x||/forms/tab',
+        'specification_set_attributes': [{'attribute_label': 'Форма', 'values': [{'value': 'таб'}]}],
+        'description_set_attributes': [{'attribute_label': 'Описание', 'values': [{'value': 'x' * description_size}]}],
+        'price': {'oldPrice': None, 'regularPrice': {'amount': {'value': round(rng.uniform(10, 5000), 2), 'currency': 'RUB'}}},
+    }
+
+
+def fill_oz_drugs(db_session, rows, seed=0, batch_size=5000):
+    # products 1..rows written the way the spider writes them, a batch per commit
+    rng = random.Random(seed)
+    leaves = get_category_leaves()
+    for start in range(1, rows + 1, batch_size):
+        products = [get_oz_product(id_, rng, leaves) for id_ in range(start, min(start + batch_size, rows + 1))]
+        drugs, _ = OzSpider._get_drugs(products)
+        db_session.execute(models.OzDrug.__table__.insert(), [drug.to_row() for drug in drugs])
+        db_session.commit()
+
+
+def get_match_products(products, seed=0):
+    # (oz, asna) matching entries of one catalogue, oz lists every drug and asna two in three,
+    # each spelling names, forms, units and pack marks the way its site does
+    rng = random.Random(seed)
+    brands = [_get_word(rng) for _ in range(max(1, products // 4))]
+    mnns = [_get_word(rng) for _ in range(max(1, products // 20))]
+    manufacturers = [_get_word(rng).capitalize() for _ in range(300)]
+    oz, asna = [], []
+    for id_ in range(1, products + 1):
+        brand_id = rng.randrange(len(brands))
+        brand, mnn = brands[brand_id], mnns[brand_id % len(mnns)]
+        manufacturer = manufacturers[brand_id % len(manufacturers)]
+        oz_form, asna_form = rng.choice(DOSAGE_FORMS)
+        strength, pack = rng.choice((5, 10, 20, 50, 100)), rng.choice((10, 20, 30))
+        oz.append((id_, matching.get_oz_product(
+            {'name': '{} {} {}мг №{}'.format(brand.capitalize(), oz_form, strength, pack), 'mnn_ru': mnn.capitalize()},
+            manufacturer
+        )))
+        if id_ % 3:
+            asna.append(('https://www.asna.ru/cards/{}.html'.format(id_), matching.get_asna_product(
+                '{} {} {} мг N{}'.format(brand.upper(), asna_form, strength, pack),
+                [{'label': 'Производитель', 'value': 'ООО ' + manufacturer}, {'label': 'Действующее вещество', 'value': mnn}]
+            )))
+    return oz, asna
+
+
+def _get_word(rng, size=7):
+    return ''.join(rng.choice('абвгдежзиклмнопрстуфхя') for _ in range(size))
@@ -0,0 +1,119 @@
+import functools
+import inspect
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+# histogram upper bounds in seconds, 10us doubling up to ~84s
+BUCKETS = tuple(1e-5 * 2 ** power for power in range(24))
+QUANTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+
+class StageStats:
+    __slots__ = ('calls', 'cpu_time', 'wall_time', 'bucket_counts')
+
+    def __init__(self):
+        self.calls = 0
+        self.cpu_time = 0.0
+        self.wall_time = 0.0
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)
+
+    def add(self, cpu_time, wall_time):
+        self.calls += 1
+        self.cpu_time += cpu_time
+        self.wall_time += wall_time
+        self.bucket_counts[bisect_left(BUCKETS, wall_time)] += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th sample, as prometheus' histogram_quantile would
+        rank = q * self.calls
+        cumulative = 0
+        for upper_bound, count in zip(BUCKETS, self.bucket_counts):
+            cumulative += count
+            if cumulative >= rank:
+                return upper_bound
+        return float('inf')
+
+
+_enabled = False
+_stages = defaultdict(StageStats)
+
+
+def enable(enabled=True):
+    global _enabled
+    _enabled = enabled
+
+
+def reset():
+    _stages.clear()
+
+
+def record(stage, cpu_time, wall_time):
+    _stages[stage].add(cpu_time, wall_time)
+
+
+def get_stages():
+    return {
+        stage: {
+            'calls': stats.calls,
+            'cpu_time': stats.cpu_time,
+            'wall_time': stats.wall_time,
+            **{name: stats.quantile(q) for name, q in QUANTILES}
+        }
+        for stage, stats in _stages.items()
+    }
+
+
+def to_prometheus():
+    lines = [
+        '# HELP drugs_stage_seconds Wall time spent per call in a crawl stage.',
+        '# TYPE drugs_stage_seconds histogram',
+    ]
+    for stage, stats in sorted(_stages.items()):
+        cumulative = 0
+        for upper_bound, count in zip(BUCKETS, stats.bucket_counts):
+            cumulative += count
+            lines.append('drugs_stage_seconds_bucket{{stage="{}",le="{:g}"}} {}'.format(stage, upper_bound, cumulative))
+        lines.append('drugs_stage_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format(stage, stats.calls))
+        lines.append('drugs_stage_seconds_sum{{stage="{}"}} {}'.format(stage, stats.wall_time))
+        lines.append('drugs_stage_seconds_count{{stage="{}"}} {}'.format(stage, stats.calls))
+
+    lines.extend((
+        '# HELP drugs_stage_cpu_seconds_total Thread cpu time spent in a crawl stage.',
+        '# TYPE drugs_stage_cpu_seconds_total counter',
+    ))
+    lines.extend(
+        'drugs_stage_cpu_seconds_total{{stage="{}"}} {}'.format(stage, stats.cpu_time)
+        for stage, stats in sorted(_stages.items())
+    )
+    return '\n'.join(lines) + '\n'
+
+
+def timed(stage):
+    # thread_time keeps the cost of database threads apart from the reactor thread,
+    # coroutines are measured across their awaits and so only make sense without a parse pool
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not _enabled:
+                    return await func(*args, **kwargs)
+                cpu_started, wall_started = time.thread_time(), time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    record(stage, time.thread_time() - cpu_started, time.perf_counter() - wall_started)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            cpu_started, wall_started = time.thread_time(), time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(stage, time.thread_time() - cpu_started, time.perf_counter() - wall_started)
+        return wrapper
+
+    return decorator
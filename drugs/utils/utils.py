@@ -1,4 +1,7 @@
 import codecs
+import hashlib
+
+from w3lib.url import canonicalize_url
 
 
 def decode(encoded, _type):
@@ -7,3 +10,35 @@ def decode(encoded, _type):
 
 def get_config_var(crawler, var_name):
     return crawler.settings.get(var_name)
+
+
+def get_db_url(settings):
+    return settings.get('DB_URL') or '{}://{}:{}@{}:{}/{}'.format(
+        *(settings.get(var_name) for var_name in (
+            'PG_DRIVER',
+            'PG_USERNAME',
+            'PG_PASSWORD',
+            'PG_HOST',
+            'PG_PORT',
+            'PG_DB_NAME'
+        ))
+    )
+
+
+def get_db_options(settings):
+    return {
+        'pool_size': settings.getint('PG_POOL_SIZE', 5),
+        'max_overflow': settings.getint('PG_MAX_OVERFLOW', 10),
+        'pool_pre_ping': settings.getbool('PG_POOL_PRE_PING'),
+        'pool_recycle': settings.getint('PG_POOL_RECYCLE', -1),
+        'statement_timeout': settings.getint('PG_STATEMENT_TIMEOUT') or None
+    }
+
+
+def get_request_fingerprint(request):
+    # the body is part of the key, oz sends every page to the same url
+    return hashlib.sha1(b'\n'.join((
+        request.method.encode('ascii'),
+        canonicalize_url(request.url).encode('utf-8'),
+        request.body or b''
+    ))).hexdigest()
@@ -0,0 +1,166 @@
+import time
+
+from sqlalchemy import and_, case, func, or_, select
+
+from drugs.db import db, models
+
+
+class WorkQueue:
+    # Workers lease open requests for lease_timeout seconds and mark them done once their
+    # items are committed. A lease that runs out, a worker that died or released it, puts
+    # the request back up to max_attempts leases
+
+    db_model = models.WorkItem
+
+    def __init__(self, source, worker, lease_timeout=300, max_attempts=3):
+        self.source = source
+        self.worker = worker
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+
+    def seed(self, db_session, entries):
+        # entries are (key, request dict), the ones seeded before keep their state
+        seeded_at = time.time()
+        rows = [
+            {
+                'source': self.source,
+                'key': key,
+                'request': request,
+                'seeded_at': seeded_at,
+                'leased_until': None,
+                'worker': None,
+                'attempts': 0,
+                'is_done': False
+            }
+            for key, request in entries
+        ]
+        for start in range(0, len(rows), db.CHUNK_SIZE):
+            db.insert_ignore(db_session, self.db_model.__table__, rows[start:start + db.CHUNK_SIZE])
+        db_session.commit()
+        return len(rows)
+
+    def lease(self, db_session, count):
+        table = self.db_model.__table__
+        now = time.time()
+        leased_until = now + self.lease_timeout
+
+        keys = (
+            select([table.c.key])
+            .where(self._get_available(now))
+            .order_by(table.c.seeded_at)
+            .limit(count)
+        )
+        if db_session.get_bind().dialect.name == 'postgresql':
+            # rows another worker is leasing right now are passed over instead of waited for
+            keys = keys.with_for_update(skip_locked=True)
+        # without row locks two workers may pick the same keys, whoever updates second finds them taken
+        db_session.execute(
+            table.update()
+            .where(and_(table.c.source == self.source, table.c.key.in_(keys), self._get_available(now)))
+            .values(worker=self.worker, leased_until=leased_until, attempts=table.c.attempts + 1)
+        )
+        rows = db_session.execute(
+            select([table.c.key, table.c.request])
+            .where(and_(
+                table.c.source == self.source,
+                table.c.worker == self.worker,
+                table.c.leased_until == leased_until
+            ))
+            .order_by(table.c.seeded_at)
+        ).fetchall()
+        db_session.commit()
+        return [(key, request) for key, request in rows]
+
+    def complete(self, db_session, keys):
+        # whoever holds the lease by now, the request itself is done
+        self._update(db_session, keys, {'is_done': True, 'leased_until': None}, own_only=False)
+
+    def release(self, db_session, keys):
+        # the request is leased again right away instead of once the lease runs out
+        self._update(db_session, keys, {'leased_until': None})
+
+    def renew(self, db_session, keys):
+        self._update(db_session, keys, {'leased_until': time.time() + self.lease_timeout})
+
+    def has_open(self, db_session):
+        # requests left to lease, or leased by another worker that may still fail them
+        table = self.db_model.__table__
+        now = time.time()
+        return db_session.execute(
+            select([func.count()]).select_from(table).where(or_(
+                self._get_available(now),
+                and_(
+                    table.c.source == self.source,
+                    table.c.is_done.is_(False),
+                    table.c.leased_until >= now,
+                    table.c.worker != self.worker
+                )
+            ))
+        ).scalar() > 0
+
+    def get_counts(self, db_session):
+        table = self.db_model.__table__
+        now = time.time()
+        state = case(
+            [
+                (table.c.is_done.is_(True), 'done'),
+                (table.c.leased_until >= now, 'leased'),
+                (table.c.attempts >= self.max_attempts, 'failed'),
+            ],
+            else_='pending'
+        ).label('state')
+        counts = dict.fromkeys(('pending', 'leased', 'done', 'failed'), 0)
+        counts.update(db_session.execute(
+            select([state, func.count()]).where(table.c.source == self.source).group_by(state)
+        ).fetchall())
+        return counts
+
+    def reset(self, db_session):
+        table = self.db_model.__table__
+        deleted = db_session.execute(table.delete().where(table.c.source == self.source)).rowcount
+        db_session.commit()
+        return deleted
+
+    def _get_available(self, now):
+        table = self.db_model.__table__
+        return and_(
+            table.c.source == self.source,
+            table.c.is_done.is_(False),
+            or_(table.c.leased_until.is_(None), table.c.leased_until < now),
+            table.c.attempts < self.max_attempts
+        )
+
+    def _update(self, db_session, keys, values, own_only=True):
+        table = self.db_model.__table__
+        keys = list(keys)
+        for start in range(0, len(keys), db.CHUNK_SIZE):
+            conditions = [table.c.source == self.source, table.c.key.in_(keys[start:start + db.CHUNK_SIZE])]
+            if own_only:
+                # a lease that ran out and went to another worker is theirs now
+                conditions.append(table.c.worker == self.worker)
+            db_session.execute(table.update().where(and_(*conditions)).values(values))
+        db_session.commit()
+
+
+class SharedRateLimit:
+    # Hands out request times of a domain min_interval apart to every worker,
+    # each one reserves the next free time and waits for it
+
+    db_model = models.RateLimit
+
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+
+    def reserve(self, db_session, domain):
+        # the row lock taken by the update orders concurrent reservations
+        table = self.db_model.__table__
+        now = time.time()
+        update = table.update().where(table.c.domain == domain).values(
+            next_at=case([(table.c.next_at > now, table.c.next_at)], else_=now) + self.min_interval
+        )
+        if not db_session.execute(update).rowcount:
+            db.insert_ignore(db_session, table, [{'domain': domain, 'next_at': now}])
+            db_session.execute(update)
+        next_at = db_session.execute(select([table.c.next_at]).where(table.c.domain == domain)).scalar()
+        db_session.commit()
+        return max(0.0, next_at - self.min_interval - now)
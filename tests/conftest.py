@@ -0,0 +1,50 @@
+import copy
+import json
+
+import pytest
+
+from drugs.db import db, models
+
+OZ_PRODUCT = {
+    'id': 20,
+    'name': 'Drug 20',
+    'sku': 'sku20',
+    'mnn_ru': 'Лоратадин',
+    'promo_label': None,
+    'breadcrumbs': json.dumps([
+        {'path': [{'id': '2669', 'name': 'root'}, {'id': '10', 'name': 'Allergy'}, {'id': '11', 'name': 'Tablets'}]},
+        {'path': [{'id': '2671', 'name': 'x'}, {'id': '99', 'name': 'Аллергия'}]},
+    ]),
+    'active': '1',
+    'manufacturer_ru': {'label': 'Байер'},
+    'manufacturer_id': {'label': 'Bayer', 'option_id': '55'},
+    'media_gallery': [{'url_image': 'a', 'url_thumbnail': 'b', 'url_small_image': 'c'}],
+    'orig_preparat': None,
+    'is_in_stock': 'true',
+    'rec_need': '0',
+    'delivery': '1',
+    'thermolabile': '0',
+    'lekforms_url': 'x||/forms/tab',
+    'specification_set_attributes': [{'attribute_label': 'Форма', 'values': [{'value': 'таб'}]}],
+    'description_set_attributes': [],
+    'price': {'oldPrice': None, 'regularPrice': {'amount': {'value': 100.0, 'currency': 'RUB'}}},
+}
+
+
+@pytest.fixture
+def db_session(tmp_path):
+    sqlalchemy = db.SQLAlchemy('sqlite:///{}'.format(tmp_path / 'drugs.sqlite'))
+    models.Base.metadata.create_all(sqlalchemy.engine)
+    yield sqlalchemy.session
+    sqlalchemy.close()
+
+
+@pytest.fixture
+def oz_product():
+    # a raw oz product as the graphql api lists it, fields given are replaced
+    def get_product(id_=OZ_PRODUCT['id'], **fields):
+        product = copy.deepcopy(OZ_PRODUCT)
+        product.update({'id': id_, 'name': 'Drug {}'.format(id_), 'sku': 'sku{}'.format(id_), **fields})
+        return product
+
+    return get_product
@@ -0,0 +1,22 @@
+import json
+import pathlib
+
+import pytest
+from scrapy.http import HtmlResponse
+
+from drugs.spiders.asna import AsnaTransformer
+
+FIXTURES_DIR = pathlib.Path(__file__).parent / 'fixtures' / 'asna'
+
+
+# the json files hold what the css selector transformer extracted from each page
+@pytest.mark.parametrize('name', sorted(path.stem for path in FIXTURES_DIR.glob('*.html')))
+def test_transformer_matches_the_saved_output(name):
+    response = HtmlResponse(
+        'https://www.asna.ru/cards/{}.html'.format(name),
+        body=(FIXTURES_DIR / '{}.html'.format(name)).read_bytes(),
+        encoding='utf-8'
+    )
+    expected = json.loads((FIXTURES_DIR / '{}.json'.format(name)).read_text(encoding='utf-8'))
+
+    assert AsnaTransformer(response).get_transformed_item() == expected
@@ -0,0 +1,118 @@
+from scrapy.http import HtmlResponse
+from twisted.python.failure import Failure
+
+from drugs.db import db
+from drugs.items import AsnaDrugItem, OzPageItem
+from drugs.spiders.asna import AsnaSpider
+from drugs.spiders.oz import OzSpider
+from drugs.utils.checkpoints import CheckpointStore
+
+GROUP = 'https://www.asna.ru/catalog/allergy/'
+PAGE_2 = GROUP + '?PAGEN_1=2'
+
+
+def get_pages(pages):
+    return [OzPageItem(page=page) for page in pages]
+
+
+def get_listing(*drug_links, pages=()):
+    return '<html><body><ul class="pagination__pages">{}</ul>{}</body></html>'.format(
+        ''.join('<a href="{}">page</a>'.format(page) for page in pages),
+        ''.join(
+            '<div class="product__information"><meta content="{}"></div>'.format(link) for link in drug_links
+        )
+    ).encode('utf-8')
+
+
+def get_drug(url):
+    return AsnaDrugItem(
+        title='drug', info=None, instructions=None, price=None, images=None, is_receipt=False, url=url
+    )
+
+
+def test_oz_checkpoint_stops_at_the_first_page_not_saved():
+    spider = OzSpider()
+
+    assert spider.advance_checkpoint(get_pages([2, 3])) is False
+    assert spider.get_checkpoint() == {'page': 0}
+
+    assert spider.advance_checkpoint(get_pages([1])) is True
+    assert spider.get_checkpoint() == {'page': 3}
+
+    assert spider.advance_checkpoint(get_pages([5])) is False
+    assert spider.advance_checkpoint(get_pages([4])) is True
+    assert spider.get_checkpoint() == {'page': 5}
+
+
+def test_oz_resumes_after_the_checkpoint():
+    spider = OzSpider(window=2)
+    spider.restore_checkpoint({'page': 40})
+
+    assert [request.cb_kwargs['page'] for request in spider.start_requests()] == [41, 42]
+
+
+def test_asna_pages_and_groups_are_done_once_their_drugs_are_saved():
+    spider = AsnaSpider()
+    group = HtmlResponse(GROUP, body=get_listing('/cards/a.html', '/cards/b.html', pages=[PAGE_2]))
+    list(spider.parse_group(group, GROUP))
+    list(spider.parse_page(HtmlResponse(PAGE_2, body=get_listing('/cards/c.html')), GROUP, PAGE_2))
+
+    assert spider.advance_checkpoint([get_drug('https://www.asna.ru/cards/a.html')]) is False
+    assert spider.advance_checkpoint([get_drug('https://www.asna.ru/cards/c.html')]) is True
+    assert spider.get_checkpoint() == {'groups': [], 'pages': [PAGE_2]}
+
+    assert spider.advance_checkpoint([get_drug('https://www.asna.ru/cards/b.html')]) is True
+    assert spider.get_checkpoint() == {'groups': [GROUP], 'pages': sorted([GROUP, PAGE_2])}
+
+
+def test_asna_drugs_given_up_on_complete_their_page():
+    spider = AsnaSpider()
+    requests = list(spider.parse_group(HtmlResponse(GROUP, body=get_listing('/cards/a.html', '/cards/b.html')), GROUP))
+    failure = Failure(ConnectionRefusedError())
+    failure.request = requests[1]
+
+    spider.parse_drug_error(failure)
+    assert spider.advance_checkpoint([get_drug('https://www.asna.ru/cards/a.html')]) is True
+    assert spider.get_checkpoint() == {'groups': [GROUP], 'pages': [GROUP]}
+
+
+def test_asna_groups_are_checkpointed_by_the_requested_url():
+    spider = AsnaSpider()
+    [request] = spider._get_group_requests([GROUP])
+    redirected = HtmlResponse(GROUP + 'new/', body=get_listing('/cards/a.html'), request=request)
+    list(request.callback(redirected, **request.cb_kwargs))
+
+    spider.advance_checkpoint([get_drug('https://www.asna.ru/cards/a.html')])
+    assert spider.get_checkpoint() == {'groups': [GROUP], 'pages': [GROUP]}
+    assert list(spider._get_group_requests([GROUP])) == []
+
+
+def test_asna_skips_what_the_checkpoint_lists():
+    spider = AsnaSpider()
+    spider.restore_checkpoint({'groups': [GROUP], 'pages': [PAGE_2]})
+
+    assert list(spider._get_group_requests([GROUP])) == []
+    assert list(spider.parse_page(HtmlResponse(PAGE_2, body=get_listing('/cards/c.html')), GROUP, PAGE_2)) == []
+
+
+def test_checkpoint_store_keeps_one_state_per_source(db_session):
+    oz, asna = CheckpointStore('oz'), CheckpointStore('asna')
+
+    oz.save(db_session, {'page': 3})
+    oz.save(db_session, {'page': 7})
+    asna.save(db_session, {'groups': [], 'pages': []})
+
+    assert oz.load(db_session) == {'page': 7}
+    assert asna.load(db_session) == {'groups': [], 'pages': []}
+
+
+def test_checkpoint_store_creates_its_table(tmp_path):
+    sqlalchemy = db.SQLAlchemy('sqlite:///{}'.format(tmp_path / 'old.sqlite'))
+    store = CheckpointStore('oz')
+
+    store.create_table(sqlalchemy.engine)
+    store.create_table(sqlalchemy.engine)
+    store.save(sqlalchemy.session, {'page': 3})
+
+    assert store.load(sqlalchemy.session) == {'page': 3}
+    sqlalchemy.close()
@@ -0,0 +1,36 @@
+import threading
+
+import sqlalchemy
+from sqlalchemy import event, text
+
+from drugs.db import db
+
+
+def test_close_returns_the_connections_of_every_thread(tmp_path):
+    database = db.SQLAlchemy('sqlite:///{}'.format(tmp_path / 'drugs.sqlite'))
+    checked_out = []
+    event.listen(database.engine, 'checkout', lambda *args: checked_out.append(1))
+    event.listen(database.engine, 'checkin', lambda *args: checked_out.pop())
+
+    # saves run in the reactor thread pool, each thread with a session of its own
+    thread = threading.Thread(target=lambda: database.session.execute(text('SELECT 1')))
+    thread.start()
+    thread.join()
+    database.session.execute(text('SELECT 1'))
+    assert len(checked_out) == 2
+
+    database.close()
+    assert not checked_out
+
+
+def test_executemany_mode_matches_the_installed_sqlalchemy():
+    kwargs = db.SQLAlchemy('postgresql://postgres@localhost/pharmacy')._get_engine_kwargs()
+
+    expected = 'values' if sqlalchemy.__version__.startswith('1.3') else 'values_only'
+    assert kwargs['executemany_mode'] == expected
+
+
+def test_statement_timeout_is_a_startup_option():
+    kwargs = db.SQLAlchemy('postgresql://postgres@localhost/pharmacy', statement_timeout=60000)._get_engine_kwargs()
+
+    assert kwargs['connect_args'] == {'options': '-c statement_timeout=60000'}
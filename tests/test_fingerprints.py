@@ -0,0 +1,54 @@
+from sqlalchemy import select
+
+from drugs.db import models
+from drugs.items import OzPageItem
+from drugs.spiders.oz import OzSpider
+from drugs.utils import fingerprints
+
+
+def get_spider(db_session, on_conflict):
+    spider = OzSpider(on_conflict=on_conflict)
+    spider.db_session = db_session
+    return spider
+
+
+def save(spider, products):
+    spider.save([spider.normalize(OzPageItem(page=1, items=products))])
+
+
+def classify(store, products):
+    return [store.classify(str(product['id']), fingerprints.get_digest(product)) for product in products]
+
+
+def test_digests_of_committed_keys_are_recorded():
+    store = fingerprints.FingerprintStore('oz')
+
+    assert classify(store, [{'id': 1}, {'id': 2}]) == [fingerprints.NEW, fingerprints.NEW]
+    assert [row['key'] for row in store.pop_committed(['1', '2'], skipped={'2'})] == ['1']
+    assert classify(store, [{'id': 1}, {'id': 2}]) == [fingerprints.UNCHANGED, fingerprints.NEW]
+    assert classify(store, [{'id': 1, 'name': 'renamed'}]) == [fingerprints.CHANGED]
+
+
+def test_rows_left_by_on_conflict_ignore_are_compared_again(db_session, oz_product):
+    spider = get_spider(db_session, 'ignore')
+    save(spider, [oz_product(1)])
+    store = fingerprints.FingerprintStore('oz')
+
+    changed = [oz_product(1, name='Renamed'), oz_product(2)]
+    classify(store, changed)
+    save(spider, changed)
+
+    assert spider.skipped_keys == {'1'}
+    assert [row['key'] for row in store.pop_committed(['1', '2'], skipped=spider.skipped_keys)] == ['2']
+    # the stored row still has the old name, so the next crawl keeps the product
+    assert classify(store, changed) == [fingerprints.NEW, fingerprints.UNCHANGED]
+
+
+def test_on_conflict_update_records_every_key(db_session, oz_product):
+    spider = get_spider(db_session, 'update')
+    save(spider, [oz_product(1)])
+    save(spider, [oz_product(1, name='Renamed')])
+
+    assert spider.skipped_keys == frozenset()
+    table = models.OzDrug.__table__
+    assert db_session.execute(select([table.c.data['name'].as_string()])).scalar() == 'Renamed'
@@ -0,0 +1,29 @@
+from sqlalchemy import select
+
+from drugs.db import models
+from drugs.utils import matching
+
+LORATADINE = matching.get_product('Лоратадин таб. 10мг №10', 'Лоратадин', 'Вертекс')
+LORATADINE_TEVA = matching.get_product('Лоратадин таблетки 10 мг №10', 'Лоратадин', 'Тева')
+IBUPROFEN = matching.get_product('Ибупрофен таб. 200мг №50', 'Ибупрофен', 'Озон')
+
+
+def test_changed_asna_product_drops_the_matches_it_lost(db_session):
+    matcher = matching.DrugMatcher()
+    matcher.save(db_session, matcher.rebuild([('asna/1', LORATADINE)], [(1, LORATADINE)]))
+
+    rows = matcher.add(matching.ASNA, [('asna/1', IBUPROFEN)])
+    matcher.save(db_session, rows)
+
+    assert rows == [{'oz_id': 1, 'asna_url': None, 'confidence': None}]
+    assert db_session.execute(select([models.DrugMatch.__table__])).fetchall() == []
+
+
+def test_changed_asna_product_hands_its_matches_to_the_next_best(db_session):
+    matcher = matching.DrugMatcher()
+    matcher.save(db_session, matcher.rebuild([('asna/1', LORATADINE), ('asna/2', LORATADINE_TEVA)], [(1, LORATADINE)]))
+
+    matcher.save(db_session, matcher.add(matching.ASNA, [('asna/1', IBUPROFEN)]))
+
+    table = models.DrugMatch.__table__
+    assert db_session.execute(select([table.c.oz_id, table.c.asna_url])).fetchall() == [(1, 'asna/2')]
@@ -0,0 +1,75 @@
+import importlib.util
+import json
+import os
+
+import pytest
+from scrapy.settings import Settings
+from sqlalchemy import inspect, select, text
+from sqlalchemy.dialects import postgresql
+
+from drugs.commands.migrate_oz import Command
+from drugs.db import db, models
+
+
+PG_TEST_URL = os.environ.get('PG_TEST_URL')
+requires_postgres = pytest.mark.skipif(
+    not PG_TEST_URL or importlib.util.find_spec('psycopg2') is None,
+    reason='needs psycopg2 and a scratch PostgreSQL database in PG_TEST_URL'
+)
+
+
+def migrate_old_table(url, oz_product):
+    # oz_drug as it was before the extracted columns, data as plain json
+    sqlalchemy = db.SQLAlchemy(url)
+    with sqlalchemy.engine.begin() as connection:
+        connection.execute(text('DROP TABLE IF EXISTS oz_drug'))
+        connection.execute(text('CREATE TABLE oz_drug (id INTEGER PRIMARY KEY, data JSON)'))
+        connection.execute(text('INSERT INTO oz_drug VALUES (:id, :data)'), [
+            {'id': 20, 'data': json.dumps(oz_product())},
+            {'id': 21, 'data': json.dumps(oz_product(21, is_in_stock='0', manufacturer_id={'label': 'X', 'option_id': ''}))},
+            {'id': 22, 'data': json.dumps(oz_product(22, is_in_stock=None))},
+        ])
+
+    command = Command()
+    command.settings = Settings({'DB_URL': url, 'MIGRATION_BATCH_SIZE': 2})
+    command.run([], None)
+    return sqlalchemy
+
+
+def test_old_table_gets_every_extracted_column_backfilled(tmp_path, oz_product):
+    sqlalchemy = migrate_old_table('sqlite:///{}'.format(tmp_path / 'old.sqlite'), oz_product)
+
+    table = models.OzDrug.__table__
+    assert {column['name'] for column in inspect(sqlalchemy.engine).get_columns('oz_drug')} == set(table.columns.keys())
+    rows = sqlalchemy.session.execute(
+        select([table.c.id, table.c.price, table.c.is_in_stock, table.c.manufacturer_id, table.c.manufacturer, table.c.categories])
+        .order_by(table.c.id)
+    ).fetchall()
+    assert [tuple(row) for row in rows] == [
+        (20, 100.0, True, 55, 'Bayer', {'10': 'Allergy', '11': 'Tablets', '99': 'Аллергия'}),
+        (21, 100.0, False, None, 'X', {'10': 'Allergy', '11': 'Tablets', '99': 'Аллергия'}),
+        # the spider would leave it out, so it keeps its data and nothing else
+        (22, None, None, None, None, None),
+    ]
+    assert {index['name'] for index in inspect(sqlalchemy.engine).get_indexes('oz_drug')} >= {
+        index.name for index in table.indexes
+    }
+    sqlalchemy.close()
+
+
+@requires_postgres
+def test_postgres_json_columns_are_swapped_for_gin_indexed_jsonb(oz_product):
+    sqlalchemy = migrate_old_table(PG_TEST_URL, oz_product)
+    session = sqlalchemy.session
+
+    columns = {column['name']: column['type'] for column in inspect(sqlalchemy.engine).get_columns('oz_drug')}
+    assert isinstance(columns['data'], postgresql.JSONB) and isinstance(columns['categories'], postgresql.JSONB)
+    assert session.execute(text("SELECT id FROM oz_drug WHERE data ->> 'sku' = 'sku21'")).scalar() == 21
+    assert [id_ for id_, in session.execute(text("SELECT id FROM oz_drug WHERE categories ? '99' ORDER BY id"))] == [20, 21]
+    assert 'USING gin' in session.execute(
+        text("SELECT indexdef FROM pg_indexes WHERE indexname = 'ix_oz_drug_categories'")
+    ).scalar()
+
+    session.execute(text('DROP TABLE oz_drug'))
+    session.commit()
+    sqlalchemy.close()
@@ -0,0 +1,36 @@
+import re
+
+import pytest
+
+from drugs.spiders.oz import BATCHED_PAGE_ALIAS, REQUEST_QUERY_FILES, OzSpider
+
+
+def get_variables(query):
+    head, selection = query.split('{', 1)
+    declared = re.findall(r'\$(\w+)\s*:', head)
+    return declared, set(re.findall(r'\$(\w+)', selection))
+
+
+@pytest.mark.parametrize('query_file', REQUEST_QUERY_FILES)
+@pytest.mark.parametrize('minify_query', ['1', '0'])
+def test_batched_query_declares_one_page_variable_per_alias(query_file, minify_query):
+    query = OzSpider(query_file=query_file, minify_query=minify_query).query
+
+    batched = OzSpider._get_batched_query(query, 3)
+
+    declared, used = get_variables(batched)
+    assert sorted(declared) == ['page0', 'page1', 'page2', 'size']
+    assert used == set(declared)
+    assert batched.count('{') == batched.count('}')
+    for i in range(3):
+        assert re.search(r'\b{}\s*:\s*productsElastic'.format(BATCHED_PAGE_ALIAS.format(i)), batched)
+
+
+@pytest.mark.parametrize('minify_query', ['1', '0'])
+def test_single_page_body_keeps_the_plain_query(minify_query):
+    spider = OzSpider(minify_query=minify_query)
+
+    declared, used = get_variables(spider.query)
+
+    assert sorted(declared) == ['page', 'size'] and used == {'page', 'size'}
+    assert b'"page": 7' in spider._get_request(7).body
@@ -0,0 +1,101 @@
+import pytest
+from scrapy.utils.test import get_crawler
+from sqlalchemy import select
+
+from drugs.db import db, models
+from drugs.items import OzPageItem
+from drugs.spiders.oz import OzSpider
+
+
+def get_spider(db_session, on_conflict='ignore'):
+    spider = OzSpider(on_conflict=on_conflict)
+    spider.db_session = db_session
+    return spider
+
+
+def get_batch(spider, page, products):
+    return spider.normalize(OzPageItem(page=page, items=products))
+
+
+def get_rows(db_session):
+    table = models.OzDrug.__table__
+    return {
+        row.id: row
+        for row in db_session.execute(select([table]).order_by(table.c.id))
+    }
+
+
+def test_new_products_are_inserted_with_their_normalized_columns(db_session, oz_product):
+    spider = get_spider(db_session)
+
+    result = spider.save([get_batch(spider, 1, [oz_product(1), oz_product(2)])])
+
+    assert result == 'pages: 1-1/~700\tadded: 2\tupdated: 0\tskipped: 0'
+    row = get_rows(db_session)[1]
+    assert row.data == oz_product(1)
+    assert (row.price, row.is_in_stock, row.manufacturer_id, row.manufacturer) == (100.0, True, 55, 'Bayer')
+    assert row.categories == {'10': 'Allergy', '11': 'Tablets', '99': 'Аллергия'}
+
+
+def test_on_conflict_ignore_keeps_existing_rows(db_session, oz_product):
+    spider = get_spider(db_session, 'ignore')
+    spider.save([get_batch(spider, 1, [oz_product(1)])])
+
+    result = spider.save([get_batch(spider, 2, [oz_product(1, name='Renamed'), oz_product(2)])])
+
+    assert result == 'pages: 2-2/~700\tadded: 1\tupdated: 0\tskipped: 1'
+    assert get_rows(db_session)[1].data['name'] == 'Drug 1'
+
+
+def test_on_conflict_update_rewrites_changed_rows_only(db_session, oz_product):
+    spider = get_spider(db_session, 'update')
+    spider.save([get_batch(spider, 1, [oz_product(1), oz_product(2)])])
+
+    price = {'oldPrice': None, 'regularPrice': {'amount': {'value': 80.0, 'currency': 'RUB'}}}
+    result = spider.save([
+        get_batch(spider, 1, [oz_product(1, price=price)]),
+        get_batch(spider, 2, [oz_product(2)]),
+    ])
+
+    assert result == 'pages: 1-2/~700\tadded: 0\tupdated: 1\tskipped: 1'
+    rows = get_rows(db_session)
+    assert (rows[1].price, rows[2].price) == (80.0, 100.0)
+
+
+def test_duplicates_within_a_batch_keep_the_last_one(db_session, oz_product):
+    spider = get_spider(db_session)
+
+    spider.save([get_batch(spider, 1, [oz_product(1)]), get_batch(spider, 2, [oz_product(1, name='Later')])])
+
+    assert get_rows(db_session)[1].data['name'] == 'Later'
+
+
+def test_existing_rows_are_looked_up_in_chunks(db_session, oz_product, monkeypatch):
+    monkeypatch.setattr(db, 'CHUNK_SIZE', 2)
+    spider = get_spider(db_session, 'update')
+    spider.save([get_batch(spider, 1, [oz_product(id_) for id_ in range(1, 4)])])
+
+    result = spider.save([get_batch(spider, 2, [oz_product(id_, name='Renamed') for id_ in range(1, 6)])])
+
+    assert result == 'pages: 2-2/~700\tadded: 2\tupdated: 3\tskipped: 0'
+    assert [row.data['name'] for row in get_rows(db_session).values()] == ['Renamed'] * 5
+
+
+def test_unknown_on_conflict_policy_is_refused():
+    with pytest.raises(ValueError):
+        OzSpider(on_conflict='replace')
+
+
+def test_malformed_products_are_left_out_of_their_page(oz_product):
+    spider = OzSpider.from_crawler(get_crawler(OzSpider, {'JSON_BACKEND': 'json'}))
+    products = [
+        oz_product(1, thermolabile=None, rec_need=None, lekforms_url='no separator'),
+        oz_product(2, price={'regularPrice': {'amount': {'value': 'free'}}}),
+        oz_product(3),
+    ]
+
+    batch = spider.normalize(OzPageItem(page=1, items=products))
+
+    # fields that are not stored are not extracted, so 1 is kept
+    assert [drug.id for drug in batch.drugs] == [1, 3]
+    assert spider.crawler.stats.get_value('oz/invalid_products') == 1
@@ -0,0 +1,138 @@
+import logging
+
+import pytest
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.project import get_project_settings
+from scrapy.utils.test import get_crawler
+from sqlalchemy import inspect
+from twisted.internet import defer
+
+from drugs import pipelines
+from drugs.spiders.oz import OzSpider
+
+
+class Stats:
+
+    def __init__(self):
+        self.values = {}
+
+    def inc_value(self, name, count=1, spider=None):
+        self.values[name] = self.values.get(name, 0) + count
+
+
+class SignalManager:
+
+    def __init__(self):
+        self.batches = []
+
+    def send_catch_log_deferred(self, signal, items, spider):
+        self.batches.append([item['id'] for item in items])
+        return defer.succeed(None)
+
+
+class Session:
+
+    def rollback(self):
+        pass
+
+
+class Spider:
+    name = 'test'
+    logger = logging.getLogger('test')
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.db_session = Session()
+        self.saved = []
+
+    def save(self, items):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('db is down')
+        self.saved.extend(item['id'] for item in items)
+        return 'saved {}'.format(len(items))
+
+    @staticmethod
+    def get_item_label(item):
+        return 'item: {}'.format(item['id'])
+
+
+@pytest.fixture(autouse=True)
+def synchronous_threads(monkeypatch):
+    # saves run in line so every deferred has fired by the time process_item returns
+    monkeypatch.setattr(pipelines.threads, 'deferToThread', defer.maybeDeferred)
+
+
+def get_pipeline(save_attempts=3):
+    return pipelines.DrugsPipeline(
+        pg_url='sqlite://',
+        batch_size=2,
+        signal_manager=SignalManager(),
+        save_attempts=save_attempts,
+        stats=Stats()
+    )
+
+
+def run(pipeline, spider, ids):
+    results = []
+    for id_ in ids:
+        result = pipeline.process_item({'id': id_}, spider)
+        if isinstance(result, defer.Deferred):
+            result.addBoth(results.append)
+        else:
+            results.append(result)
+    return results
+
+
+def test_failed_batch_is_retried_with_the_next_flush():
+    pipeline, spider = get_pipeline(), Spider(failures=1)
+
+    results = run(pipeline, spider, [1, 2, 3])
+
+    assert results == ['item: 1', 'item: 2', 'item: 3']
+    assert spider.saved == [1, 2, 3]
+    assert pipeline.signal_manager.batches == [[1, 2, 3]]
+    assert pipeline.stats.values == {'pipeline/failed_saves': 1}
+    assert not pipeline._buffer and not pipeline._failures
+
+
+def test_items_are_dropped_once_out_of_attempts():
+    pipeline, spider = get_pipeline(save_attempts=2), Spider(failures=2)
+
+    run(pipeline, spider, [1, 2, 3, 4])
+
+    # 1 and 2 failed twice, 3 and 4 once before the save came through
+    assert spider.saved == [3, 4]
+    assert pipeline.stats.values == {'pipeline/failed_saves': 2, 'pipeline/dropped_items': 2}
+    assert not pipeline._failures
+
+
+def test_close_retries_until_the_buffer_is_empty():
+    pipeline, spider = get_pipeline(save_attempts=5), Spider(failures=3)
+    pipeline._db = type('Db', (), {'close': lambda self: None})()
+
+    run(pipeline, spider, [1])
+    pipeline.close_spider(spider)
+
+    assert spider.saved == [1]
+    assert pipeline.stats.values == {'pipeline/failed_saves': 3}
+
+
+def test_open_creates_the_tables_of_enabled_features(tmp_path):
+    pipeline = pipelines.DrugsPipeline(
+        pg_url='sqlite:///{}'.format(tmp_path / 'old.sqlite'), price_history=True, category_tree=True
+    )
+    spider = Spider()
+
+    pipeline.open_spider(spider)
+
+    assert set(inspect(pipeline._db.engine).get_table_names()) == {'price_history', 'category', 'drug_category'}
+    assert spider.price_history.source == 'test'
+    pipeline._db.close()
+
+
+def test_fingerprints_need_the_db_sink():
+    settings = {**get_project_settings().copy_to_dict(), 'FINGERPRINTS_ENABLED': True, 'SINK': 'file'}
+
+    with pytest.raises(NotConfigured):
+        pipelines.FingerprintPipeline.from_crawler(get_crawler(OzSpider, settings))
@@ -0,0 +1,26 @@
+import json
+
+import pytest
+
+from drugs.db import models
+from drugs.utils import sinks
+
+pyarrow = pytest.importorskip('pyarrow.parquet')
+
+
+def test_parquet_stores_jsonb_columns_as_json_text(tmp_path, oz_product):
+    product = oz_product()
+    row = {
+        'id': 20, 'data': product, 'price': 100.0, 'is_in_stock': True,
+        'manufacturer_id': 55, 'manufacturer': 'Bayer', 'categories': {'10': 'Allergy'}
+    }
+    writer = sinks.ParquetWriter(str(tmp_path / 'oz'), 'none', list(models.OzDrug.__table__.columns))
+    writer.write([row])
+    writer.close()
+
+    table = pyarrow.read_table(str(tmp_path / 'oz.parquet'))
+    assert str(table.schema.field('price').type) == 'double'
+    stored = table.to_pylist()[0]
+    assert json.loads(stored['data']) == product
+    assert json.loads(stored['categories']) == {'10': 'Allergy'}
+    assert stored['manufacturer_id'] == 55
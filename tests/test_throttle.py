@@ -0,0 +1,53 @@
+from types import SimpleNamespace
+
+import pytest
+from scrapy.http import Request, Response
+from scrapy.utils.project import get_project_settings
+from scrapy.utils.test import get_crawler
+
+from drugs.middlewares import AdaptiveThrottleDownloaderMiddleware
+from drugs.spiders.asna import AsnaSpider
+from drugs.spiders.oz import OzSpider
+
+
+class Spider:
+    logger = SimpleNamespace(debug=lambda *args: None)
+
+
+@pytest.mark.parametrize('spidercls, min_delay, max_concurrency', [
+    (AsnaSpider, 1, 2),
+    (OzSpider, 0.1, 8),
+])
+def test_speeds_up_to_spider_bounds(spidercls, min_delay, max_concurrency):
+    crawler = get_crawler(spidercls, get_project_settings().copy_to_dict())
+    middleware = AdaptiveThrottleDownloaderMiddleware.from_crawler(crawler)
+    slot = SimpleNamespace(
+        delay=crawler.settings.getfloat('DOWNLOAD_DELAY'),
+        concurrency=crawler.settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN')
+    )
+
+    # windows without errors at a steady latency only ever speed the slot up
+    for _ in range(50):
+        for _ in range(middleware.window):
+            middleware._observe('example.com', slot, Spider(), 0.2, False)
+        assert slot.delay >= min_delay
+        assert slot.concurrency <= max_concurrency
+    assert (slot.delay, slot.concurrency) == (min_delay, max_concurrency)
+
+
+@pytest.mark.parametrize('flag', ['cached', 'replayed'])
+def test_responses_not_downloaded_are_left_out(flag):
+    crawler = get_crawler(OzSpider, get_project_settings().copy_to_dict())
+    middleware = AdaptiveThrottleDownloaderMiddleware.from_crawler(crawler)
+    slot = SimpleNamespace(delay=0.5, concurrency=1)
+    crawler.engine = SimpleNamespace(downloader=SimpleNamespace(slots={'example.com': slot}))
+    request = Request('https://example.com', meta={'download_slot': 'example.com', 'download_latency': 0.01})
+    spider = OzSpider()
+
+    for _ in range(middleware.window):
+        middleware.process_response(request, Response(request.url, flags=[flag], request=request), spider)
+    assert (slot.delay, slot.concurrency) == (0.5, 1)
+
+    for _ in range(middleware.window):
+        middleware.process_response(request, Response(request.url, request=request), spider)
+    assert slot.delay == 0.25
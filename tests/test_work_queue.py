@@ -0,0 +1,158 @@
+import pytest
+import scrapy
+from scrapy.exceptions import DontCloseSpider
+from scrapy.http import HtmlResponse
+from scrapy.utils.project import get_project_settings
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from drugs import middlewares
+from drugs.db import db, models
+from drugs.utils import work_queue
+from drugs.utils.work_queue import WorkQueue
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class Spider(scrapy.Spider):
+    name = 'test'
+
+    def parse(self, response):
+        pass
+
+
+class Engine:
+
+    def __init__(self):
+        self.requests = []
+        self.closed = None
+
+    def crawl(self, request):
+        self.requests.append(request)
+
+    def close_spider(self, spider, reason):
+        self.closed = reason
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(work_queue, 'time', clock)
+    return clock
+
+
+@pytest.fixture(autouse=True)
+def synchronous_threads(monkeypatch):
+    # queue calls run in line so every deferred has fired by the time a hook returns
+    monkeypatch.setattr(middlewares.threads, 'deferToThread', defer.maybeDeferred)
+
+
+def seed(db_session, clock, keys):
+    # seeded one by one, so they are leased in this order
+    for key in keys:
+        WorkQueue('test', None).seed(db_session, [(key, {'url': key})])
+        clock.now += 1
+
+
+def test_leases_go_to_one_worker_until_completed_or_released(db_session, clock):
+    first, second = WorkQueue('test', 'a'), WorkQueue('test', 'b')
+    seed(db_session, clock, ['1', '2', '3'])
+
+    assert [key for key, _ in first.lease(db_session, 2)] == ['1', '2']
+    clock.now += 1
+    assert [key for key, _ in second.lease(db_session, 2)] == ['3']
+    clock.now += 1
+    assert first.lease(db_session, 2) == []
+
+    first.complete(db_session, ['1'])
+    first.release(db_session, ['2'])
+    # a worker only releases its own leases
+    first.release(db_session, ['3'])
+    assert first.get_counts(db_session) == {'pending': 1, 'leased': 1, 'done': 1, 'failed': 0}
+    assert first.has_open(db_session) is True
+
+    clock.now += 1
+    assert [key for key, _ in second.lease(db_session, 2)] == ['2']
+    second.complete(db_session, ['2', '3'])
+    assert first.get_counts(db_session) == {'pending': 0, 'leased': 0, 'done': 3, 'failed': 0}
+    assert first.has_open(db_session) is False
+
+
+def test_leases_run_out_and_are_given_up_after_max_attempts(db_session, clock):
+    first, second = WorkQueue('test', 'a', lease_timeout=300, max_attempts=2), WorkQueue('test', 'b', lease_timeout=300)
+    seed(db_session, clock, ['1'])
+
+    assert len(first.lease(db_session, 1)) == 1
+    clock.now += 299
+    assert second.lease(db_session, 1) == []
+    clock.now += 2
+    assert len(second.lease(db_session, 1)) == 1
+    # the lease is the other worker's now, renewing it does not take it back
+    first.renew(db_session, ['1'])
+    clock.now += 301
+    assert first.lease(db_session, 1) == []
+    assert first.get_counts(db_session) == {'pending': 0, 'leased': 0, 'done': 0, 'failed': 1}
+    assert first.has_open(db_session) is False
+
+
+def test_idle_workers_lease_again_until_the_queue_is_empty(tmp_path, clock):
+    url = 'sqlite:///{}'.format(tmp_path / 'queue.sqlite')
+    models.Base.metadata.create_all(db.SQLAlchemy(url).engine)
+    settings = {
+        **get_project_settings().copy_to_dict(),
+        'DB_URL': url,
+        'DISTRIBUTED_ENABLED': True,
+        'DISTRIBUTED_WORKER': 'a',
+        'DISTRIBUTED_LEASE_SIZE': 2,
+        'DISTRIBUTED_LEASE_TIMEOUT': 300,
+    }
+    crawler = get_crawler(Spider, settings)
+    crawler.engine = engine = Engine()
+    middleware = middlewares.DistributedSpiderMiddleware.from_crawler(crawler)
+    queue, session = middleware._queue, middleware._db.session
+    spider = Spider()
+
+    # another worker leases the start request and dies with it
+    assert middleware.process_start_requests([scrapy.Request('https://example.com/1')], spider) == []
+    WorkQueue('test', 'b', lease_timeout=300).lease(session, 1)
+    clock.now += 1
+    with pytest.raises(DontCloseSpider):
+        middleware.spider_idle(spider)
+    assert (engine.requests, engine.closed) == ([], None)
+
+    clock.now += 300
+    with pytest.raises(DontCloseSpider):
+        middleware.spider_idle(spider)
+    [start] = engine.requests
+
+    # the items of a response complete its request once they are committed
+    item = {'id': 1}
+    clock.now += 1
+    output = middleware.process_spider_output(
+        HtmlResponse(start.url, request=start, body=b''), [item, scrapy.Request('https://example.com/2')], spider
+    )
+    assert list(output) == [item]
+    assert queue.get_counts(session)['done'] == 0
+    middleware.batch_saved([item], spider)
+    assert queue.get_counts(session)['done'] == 1
+
+    # the new request was leased right away, a failed download of it is released and leased again
+    clock.now += 1
+    engine.requests[1].errback(Failure(ConnectionRefusedError()))
+    retried = engine.requests[2]
+    assert retried.url == 'https://example.com/2'
+
+    clock.now += 1
+    list(middleware.process_spider_output(HtmlResponse(retried.url, request=retried, body=b''), [], spider))
+    assert engine.closed == 'finished'
+    assert queue.get_counts(session) == {'pending': 0, 'leased': 0, 'done': 2, 'failed': 0}
+    assert middleware.spider_idle(spider) is None
+    middleware.spider_closed(spider)